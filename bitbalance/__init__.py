@@ -1,3 +1,21 @@
-from .core import BitcoinBalanceFacade
-from .database import Session
-from .primitives import bitcoin_to_string
+"""
+The package exports are imported on first access, so importing a single
+module (like rawblock in the block decoding processes) doesn't import core
+and the database, creating the default database file.
+"""
+from importlib import import_module
+
+
+_EXPORTS = {
+    'BitcoinBalanceFacade': '.core',
+    'Session': '.database',
+    'bitcoin_to_string': '.primitives',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    return getattr(import_module(_EXPORTS[name], __name__), name)
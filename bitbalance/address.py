@@ -1,19 +1,47 @@
+"""
+address
+
+Compact address keys, a byte with the address type followed by the pubkey
+hash, script hash or witness program. Keys are obtained directly from the
+standard scriptPubKey templates, and only encoded to base58/bech32 when a
+human-readable address is needed.
+"""
+from functools import lru_cache
+
+import bitcoin
 from bitcoin.base58 import CBase58Data
+from bitcoin.core import Hash160
+from bitcoin.core.script import CScript
+from bitcoin.wallet import CBitcoinAddress, CBitcoinAddressError
 
-# Supported address version bytes
 
-MAIN
+# Address key types
+KEY_P2PKH = 0
+KEY_P2SH = 1
+KEY_P2WPKH = 2
+KEY_P2WSH = 3
+
+# Supported address version bytes
 BITCOIN_VERSION_BYTES = set([
         111, # Testnet pubkey hash
         196, # Testnet script hash
         0,   # MainNet pubkey hash
         5])   # MainNet script hash
 
+# Bech32 human-readable part for each chain
+BECH32_HRP = {
+    'mainnet': 'bc',
+    'testnet': 'tb',
+    'regtest': 'bcrt',
+}
+
+BECH32_CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+
 
 def is_valid_bitcoin_address(address, testnet=True):
     """
     Check the address is a valide P2SH or P2PK bitcoin address
-    
+
     Arguments:
         address(str)
         testnet(bool): True to also accept testnet addresses
@@ -30,3 +58,185 @@ def is_valid_bitcoin_address(address, testnet=True):
     except Exception:
         return False
 
+
+def _bech32_polymod(values):
+    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1ffffff) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+def _bech32_hrp_expand(hrp):
+    return [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+
+
+def _convertbits(data, frombits, tobits, pad=True):
+    """General power-of-2 base conversion"""
+    acc = 0
+    bits = 0
+    ret = []
+    maxv = (1 << tobits) - 1
+    for value in data:
+        acc = (acc << frombits) | value
+        bits += frombits
+        while bits >= tobits:
+            bits -= tobits
+            ret.append((acc >> bits) & maxv)
+
+    if pad:
+        if bits:
+            ret.append((acc << (tobits - bits)) & maxv)
+    elif bits >= frombits or ((acc << (tobits - bits)) & maxv):
+        return None
+
+    return ret
+
+
+def _segwit_encode(hrp, witver, witprog):
+    """Encode a segwit v0 address (bip-0173)"""
+    data = [witver] + _convertbits(witprog, 8, 5)
+    values = _bech32_hrp_expand(hrp) + data
+    polymod = _bech32_polymod(values + [0, 0, 0, 0, 0, 0]) ^ 1
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join(BECH32_CHARSET[d] for d in data + checksum)
+
+
+def _segwit_decode(hrp, address):
+    """Decode a segwit v0 address (bip-0173)
+
+    Returns:
+        (witver, witprog) or (None, None) if it isn't valid
+    """
+    if address.lower() != address and address.upper() != address:
+        return None, None
+
+    address = address.lower()
+    pos = address.rfind('1')
+    if pos < 1 or pos + 7 > len(address) or len(address) > 90:
+        return None, None
+
+    if address[:pos] != hrp:
+        return None, None
+
+    try:
+        data = [BECH32_CHARSET.index(c) for c in address[pos+1:]]
+    except ValueError:
+        return None, None
+
+    if _bech32_polymod(_bech32_hrp_expand(hrp) + data) != 1:
+        return None, None
+
+    witprog = _convertbits(data[1:-6], 5, 8, False)
+    if witprog is None or data[0] != 0:
+        return None, None
+
+    return data[0], bytes(witprog)
+
+
+def script_to_key(script):
+    """
+    Get the address key for a scriptPubKey, standard templates are matched
+    directly, for the rest python-bitcoinlib is used.
+
+    Arguments:
+        script (bytes|CScript|memoryview): scriptPubKey
+
+    Returns:
+        (bytes|None): Address key or None if the script doesn't have one
+    """
+    length = len(script)
+
+    if length == 25:
+        # P2PKH: OP_DUP OP_HASH160 <20 bytes> OP_EQUALVERIFY OP_CHECKSIG
+        if script[:3] == b'\x76\xa9\x14' and script[23:] == b'\x88\xac':
+            return bytes((KEY_P2PKH,)) + script[3:23]
+    elif length == 23:
+        # P2SH: OP_HASH160 <20 bytes> OP_EQUAL
+        if script[:2] == b'\xa9\x14' and script[22] == 0x87:
+            return bytes((KEY_P2SH,)) + script[2:22]
+    elif length == 22:
+        # P2WPKH: OP_0 <20 bytes>
+        if script[:2] == b'\x00\x14':
+            return bytes((KEY_P2WPKH,)) + script[2:22]
+    elif length == 34:
+        # P2WSH: OP_0 <32 bytes>
+        if script[:2] == b'\x00\x20':
+            return bytes((KEY_P2WSH,)) + script[2:34]
+    elif length == 35 or length == 67:
+        # P2PK: <33|65 bytes pubkey> OP_CHECKSIG, credited to the pubkey
+        # P2PKH address.
+        if script[0] == length-2 and script[-1] == 0xac:
+            return bytes((KEY_P2PKH,)) + Hash160(bytes(script[1:-1]))
+
+    # Non standard scripts (non canonical pushes, ...)
+    try:
+        addr = CBitcoinAddress.from_scriptPubKey(CScript(bytes(script)))
+    except (CBitcoinAddressError, ValueError):
+        return None
+
+    if addr.nVersion == bitcoin.params.BASE58_PREFIXES['SCRIPT_ADDR']:
+        return bytes((KEY_P2SH,)) + bytes(addr)
+    else:
+        return bytes((KEY_P2PKH,)) + bytes(addr)
+
+
+@lru_cache(maxsize=65536)
+def key_to_address(key):
+    """
+    Encode address key into a human-readable base58/bech32 address
+
+    Arguments:
+        key (bytes): Address key
+
+    Returns:
+        (str)
+    """
+    key_type = key[0]
+
+    if key_type == KEY_P2PKH:
+        prefix = bitcoin.params.BASE58_PREFIXES['PUBKEY_ADDR']
+    elif key_type == KEY_P2SH:
+        prefix = bitcoin.params.BASE58_PREFIXES['SCRIPT_ADDR']
+    elif key_type in (KEY_P2WPKH, KEY_P2WSH):
+        return _segwit_encode(BECH32_HRP[bitcoin.params.NAME], 0, key[1:])
+    else:
+        raise ValueError("Unknown address key type {}".format(key_type))
+
+    return str(CBase58Data.from_bytes(key[1:], prefix))
+
+
+def address_to_key(address):
+    """
+    Decode base58/bech32 address into its address key
+
+    Arguments:
+        address (str): Bitcoin address
+
+    Returns:
+        (bytes|None): Address key or None if the address isn't valid
+    """
+    witver, witprog = _segwit_decode(BECH32_HRP[bitcoin.params.NAME], address)
+    if witprog is not None:
+        if len(witprog) == 20:
+            return bytes((KEY_P2WPKH,)) + witprog
+        elif len(witprog) == 32:
+            return bytes((KEY_P2WSH,)) + witprog
+        return None
+
+    try:
+        addr = CBase58Data(address)
+    except Exception:
+        return None
+
+    if len(addr) != 20:
+        return None
+    elif addr.nVersion == bitcoin.params.BASE58_PREFIXES['PUBKEY_ADDR']:
+        return bytes((KEY_P2PKH,)) + bytes(addr)
+    elif addr.nVersion == bitcoin.params.BASE58_PREFIXES['SCRIPT_ADDR']:
+        return bytes((KEY_P2SH,)) + bytes(addr)
+
+    return None
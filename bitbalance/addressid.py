@@ -0,0 +1,223 @@
+"""
+addressid
+
+Address dictionaries, assign a dense integer id to each address key the
+first time it's seen. Balances are tracked and stored by id, so the sync
+path hashes and compares small ints instead of address keys, which are
+only needed at the API edge.
+
+Ids are never reused nor changed, and they are persisted before being
+returned so a balance can't be stored for an id that is lost.
+"""
+import logging
+import os
+import threading
+
+from sqlalchemy import func, select
+
+from .bloom import BloomFilter
+from .cache import ShardedClockCache
+from .database import AddressId, QUERY_CHUNK_SIZE, make_session_scope
+
+
+logger = logging.getLogger("Storage")
+
+
+class MemoryAddressDictionary(object):
+    """In-memory address dictionary"""
+
+    def __init__(self):
+        self._ids = {}
+        self._addresses = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def get(self, address):
+        """
+        Returns:
+            (int|None): Address id, None if it was never added
+        """
+        return self._ids.get(address)
+
+    def get_bulk(self, addresses, cached_only=False):
+        """
+        Arguments:
+            addresses (iterable):
+            cached_only (bool): Unused, never reads storage
+
+        Returns:
+            {address: id, ...} for the addresses known
+        """
+        ids = self._ids
+        return {addr: ids[addr] for addr in addresses if addr in ids}
+
+    def add(self, addresses):
+        """Get the ids for several addresses, assigning new ids to the
+        addresses not seen before.
+
+        Returns:
+            {address: id, ...}
+        """
+        with self._lock:
+            ids = self._ids
+            result = {}
+            for addr in addresses:
+                idx = ids.get(addr)
+                if idx is None:
+                    idx = len(self._addresses)
+                    self._addresses.append(addr)
+                    ids[addr] = idx
+                result[addr] = idx
+            return result
+
+    def address(self, address_id):
+        """Address for an id"""
+        return self._addresses[address_id]
+
+    def save(self):
+        pass
+
+
+class SQLAddressDictionary(object):
+    """SQLAlchemy address dictionary.
+
+    Recently used ids are kept in a cache, and a bloom filter of all the
+    addresses avoids querying the database for addresses never seen. The
+    filter is saved together with the number of ids, and rebuilt when
+    the file doesn't match the table.
+    """
+
+    def __init__(self, db_session, cache_size=1000000, filter_path=None):
+        """
+        Arguments:
+            db_session (SQLAlchemy session):
+            cache_size (int): Max number of ids cached
+            filter_path (str|None): Bloom filter file, None to rebuild the
+                filter on start.
+        """
+        self._db_session = db_session
+        self._table = AddressId.__table__
+        self._cache = ShardedClockCache()
+        self._cache_size = cache_size
+        self._filter_path = filter_path
+        self._lock = threading.Lock()
+
+        with make_session_scope(self._db_session) as session:
+            max_id = session.execute(select([func.max(self._table.c.id)])).scalar()
+        self._next_id = 0 if max_id is None else max_id+1
+
+        self._filter = None
+        if filter_path is not None and os.path.exists(filter_path):
+            try:
+                self._filter, count = BloomFilter.load(filter_path)
+            except ValueError as e:
+                logger.warning("Discarding address id filter {}: {}".format(
+                    filter_path, e))
+            else:
+                if count != self._next_id:
+                    self._filter = None
+
+        if self._filter is None:
+            logger.info("Building address id filter")
+            self._filter = BloomFilter(max(self._next_id*2, 1 << 20))
+            self._filter.update(self._iter_addresses())
+
+    def __len__(self):
+        return self._next_id
+
+    def _iter_addresses(self):
+        with make_session_scope(self._db_session) as session:
+            query = session.query(AddressId.address).yield_per(10000)
+            for (address,) in query:
+                yield address
+
+    def _query(self, addresses):
+        """Query the ids of the addresses not cached"""
+        found = {}
+        t = self._table
+        with make_session_scope(self._db_session) as session:
+            for start in range(0, len(addresses), QUERY_CHUNK_SIZE):
+                query = select([t.c.address, t.c.id])\
+                        .where(t.c.address.in_(addresses[start:start+QUERY_CHUNK_SIZE]))
+                for address, idx in session.execute(query):
+                    found[address] = idx
+
+        for addr, idx in found.items():
+            self._cache.set_missing(addr, idx, self._cache_size)
+        return found
+
+    def get(self, address):
+        """
+        Returns:
+            (int|None): Address id, None if it was never added
+        """
+        return self.get_bulk([address]).get(address)
+
+    def get_bulk(self, addresses, cached_only=False):
+        """
+        Arguments:
+            addresses (iterable):
+            cached_only (bool): Return None instead of reading the database
+
+        Returns:
+            {address: id, ...} for the addresses known
+        """
+        result = {}
+        missing = []
+        for addr in addresses:
+            idx = self._cache.get(addr)
+            if idx is not None:
+                result[addr] = idx
+            elif addr in self._filter:
+                missing.append(addr)
+
+        if missing:
+            if cached_only:
+                return None
+            result.update(self._query(missing))
+        return result
+
+    def add(self, addresses):
+        """Get the ids for several addresses, assigning new ids to the
+        addresses not seen before.
+
+        Returns:
+            {address: id, ...}
+        """
+        addresses = list(dict.fromkeys(addresses))
+        with self._lock:
+            result = self.get_bulk(addresses)
+            new = [addr for addr in addresses if addr not in result]
+            if not new:
+                return result
+
+            rows = [{'id': idx, 'address': addr}
+                    for idx, addr in enumerate(new, self._next_id)]
+            with make_session_scope(self._db_session) as session:
+                session.execute(self._table.insert(), rows)
+
+            # Only visible once stored
+            self._filter.update(new)
+            for row in rows:
+                self._cache.set_missing(row['address'], row['id'], self._cache_size)
+                result[row['address']] = row['id']
+            self._next_id += len(new)
+            return result
+
+    def address(self, address_id):
+        """Address for an id"""
+        with make_session_scope(self._db_session) as session:
+            row = session.query(AddressId.address)\
+                         .filter_by(id=address_id)\
+                         .first()
+        if row is None:
+            raise KeyError(address_id)
+        return row[0]
+
+    def save(self):
+        """Save bloom filter"""
+        if self._filter_path is not None:
+            with self._lock:
+                self._filter.save(self._filter_path, self._next_id)
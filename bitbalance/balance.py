@@ -1,38 +1,201 @@
+from array import array
+from bisect import bisect_left
 from collections import deque, defaultdict, namedtuple
-import threading
 import time
 
 from .exceptions import BacktrackError
+from .locks import SeqLock
 from .primitives import COINBASE_TX, bitcoin_to_string
-from .storage import MemoryBalanceStorage, SQLBalanceStorage, BalanceProxyCache
+from .storage import (MemoryBalanceStorage, SQLBalanceStorage, BalanceProxyCache,
+                      UPDATE_SLICE_SIZE)
 from .settings import Settings
 
 
-TxoRecord = namedtuple('TxoRecord', ['tx', 'value', 'height'])
+# Net balance change of an address in a block
+BlockChange = namedtuple('BlockChange', ['block_hash', 'value', 'height'])
+
+# Max number of addresses with fast sync balance changes before they
+# are commited
+FAST_SYNC_BATCH = Settings.get('FAST_SYNC_BATCH', 1000000)
 
 
 from bitcoin.core import str_money_value, b2lx, b2x, x
 
 
 
-def block_record_iter(block):
-    """Iterate through block inputs and outputs"""
-    address_total = 0
-    address_discovered = False
+class BlockDelta(object):
+    """Block reduced to the net balance change of each address, computed
+    once per block and used to add, backtrack and store it."""
+
+    __slots__ = ('block_hash', 'height', 'balance')
+
+    def __init__(self, block, address_ids=None):
+        """
+        Arguments:
+            block (Block):
+            address_ids (AddressDictionary): When provided addresses are
+                replaced by their ids.
+        """
+        self.block_hash = block.block_hash
+        self.height = block.height
+
+        balance = defaultdict(int)
+        for vout in block.vout:
+            if vout.addr:
+                balance[vout.addr] += vout.value
+
+        for vin in block.vin:
+            if vin.addr and vin.tx != COINBASE_TX:
+                balance[vin.addr] -= vin.value
+
+        # {address: net balance change} without 0 changes
+        balance = {addr: value for addr, value in balance.items() if value}
+        if address_ids is not None:
+            ids = address_ids.add(balance)
+            balance = {ids[addr]: value for addr, value in balance.items()}
+        self.balance = balance
+
+
+class BlockJournal(object):
+    """Undo journal of a block added to PendingBalance, the ids of the 
+    addresses changed (sorted) and their balance change."""
+
+    __slots__ = ('block_hash', 'height', 'ids', 'deltas')
+
+    def __init__(self, block_hash, height, ids, deltas):
+        self.block_hash = block_hash
+        self.height = height
+        self.ids = ids
+        self.deltas = deltas
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, address_id, default=None):
+        """Balance change for an address id"""
+        idx = bisect_left(self.ids, address_id)
+        if idx < len(self.ids) and self.ids[idx] == address_id:
+            return self.deltas[idx]
+        return default
+
+
+class PendingBalance(object):
+    """Balance changes of the blocks not yet stored. 
     
-    # First add new unspent outputs so balance is positive
-    for vout in block.vout:
-        if not vout.addr:
-            continue
-        
-        yield (vout.addr, TxoRecord(vout.tx, vout.value, block.height))
+    Each address with changes in any of the blocks has an id, its balance
+    and the number of blocks referencing it are stored in arrays indexed
+    by id. Blocks are kept as BlockJournal, two arrays with the ids and 
+    balance changes, and ids are released when no block references them.
+
+    Writes must be serialized, get() can be called concurrently if the 
+    caller retries reads overlapping with writes (SeqLock).
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._addresses = []
+        self._balance = array('q')
+        self._refs = array('L')
+        self._free = []
+
+    def __len__(self):
+        """Number of addresses with changes"""
+        return len(self._ids)
+
+    def __contains__(self, address):
+        return address in self._ids
+
+    def address_id(self, address):
+        """Id of an address with changes, or None"""
+        return self._ids.get(address)
+
+    def addresses(self, ids):
+        """Addresses for a list of ids"""
+        addresses = self._addresses
+        return [addresses[idx] for idx in ids]
+
+    def get(self, address, default=0):
+        idx = self._ids.get(address)
+        if idx is None:
+            return default
+        return self._balance[idx]
+
+    def items(self):
+        """Iterate (address, balance) for all the addresses with a balance 
+        change"""
+        balance = self._balance
+        for address, idx in self._ids.items():
+            if balance[idx]:
+                yield address, balance[idx]
+
+    def add(self, delta):
+        """Add block balance changes
 
-    # Spend outputs
-    for vin in block.vin:
-        if not vin.addr or vin.tx==COINBASE_TX:
-            continue
+        Arguments:
+            delta (BlockDelta):
 
-        yield (vin.addr, TxoRecord(vin.tx, -vin.value, block.height))
+        Returns:
+            (BlockJournal): Used to remove the block
+        """
+        ids = self._ids
+        balance = self._balance
+        refs = self._refs
+
+        changes = []
+        for address, value in delta.balance.items():
+            idx = ids.get(address)
+            if idx is None:
+                idx = self._allocate(address)
+            balance[idx] += value
+            refs[idx] += 1
+            changes.append((idx, value))
+
+        changes.sort()
+        return BlockJournal(delta.block_hash, delta.height,
+                            array('L', (idx for idx, _ in changes)),
+                            array('q', (value for _, value in changes)))
+
+    def remove(self, journal):
+        """Revert block balance changes
+
+        Arguments:
+            journal (BlockJournal): returned when the block was added
+        """
+        balance = self._balance
+        refs = self._refs
+        for idx, value in zip(journal.ids, journal.deltas):
+            balance[idx] -= value
+            refs[idx] -= 1
+            if not refs[idx]:
+                self._release(idx)
+
+    def discard(self, addresses):
+        """Drop addresses once their balance was moved into storage, the
+        blocks referencing them can't be removed afterwards"""
+        ids = self._ids
+        for address in addresses:
+            idx = ids.pop(address, None)
+            if idx is not None:
+                self._balance[idx] = 0
+
+    def _allocate(self, address):
+        if self._free:
+            idx = self._free.pop()
+            self._addresses[idx] = address
+            self._balance[idx] = 0
+        else:
+            idx = len(self._addresses)
+            self._addresses.append(address)
+            self._balance.append(0)
+            self._refs.append(0)
+        
+        self._ids[address] = idx
+        return idx
+
+    def _release(self, idx):
+        del self._ids[self._addresses[idx]]
+        self._addresses[idx] = None
+        self._free.append(idx)
 
 
 #
@@ -42,13 +205,20 @@ def block_record_iter(block):
 class BalanceProcessor(object):
 
 
-    def __init__(self, backtrack_limit=100, storage=None):
+    def __init__(self, backtrack_limit=100, storage=None, fast_sync_distance=None,
+                 address_ids=None):
         """
         Arguments:
             storage (BalanceProxyCache):
+            fast_sync_distance (int|None): Blocks further than this from
+                the blockchain tip are added in fast sync mode, None to
+                disable it.
+            address_ids (AddressDictionary): Track balances by address id, 
+                balance queries must use ids.
         """
+        self._address_ids = address_ids
 
-        # 
+        # Journal for the blocks not yet stored
         self._blocks = deque()
 
         # Last time a block was added
@@ -60,60 +230,126 @@ class BalanceProcessor(object):
         # Address balance permanent storage
         self._storage = storage
 
-        # Accumulated address balance for the blocks not yet placed into storage
-        self._pending_balance = defaultdict(int)
+        # Accumulated address balance for the blocks not yet placed into 
+        # storage, and their undo journals in self._blocks.
+        self._pending_balance = PendingBalance()
 
-        # Operation records for the blocks not yet stored, (by address)
-        self._pending_records = defaultdict(deque)
+        # Fast sync mode, far from the tip blocks aren't tracked for 
+        # backtracking and only the net balance change of all of them
+        # is kept until it's flushed into storage.
+        self._fast_sync_distance = fast_sync_distance
+        self._fast_deltas = defaultdict(int)
+        self._fast_height = None
 
-        # Main lock
-        self._lock = threading.Lock()
+        # Write lock, get_balance doesn't lock, it retries if there was
+        # a concurrent write.
+        self._lock = SeqLock()
 
  
-    def _add_record(self, address, record):
-        """Add transaction record to address"""
-        self._pending_records[address].append(record)
-        self._pending_balance[address] += record.value
-      
-        # Cleanup
-        if not self._pending_balance[address]:
-            del self._pending_balance[address]
+    def __len__(self):
+        """Number of tracked blocks, the ones that can be backtracked"""
+        return len(self._blocks)
+
+    def _is_fast_sync(self, height, tip):
+        """Return True if the block at height must be added in fast mode"""
+        if self._fast_sync_distance is None or tip is None:
+            return False
+        return tip-height > self._fast_sync_distance
+
+    def _flush_blocks(self):
+        """Move the balance of all the tracked blocks into storage, they 
+        can't be backtracked anymore"""
+        if not self._blocks:
+            return
         
-    def _del_record(self, address, last=True):
-        """Remove first or last record for given address"""
-        if address not in self._pending_records:
+        # Moved in slices like fast sync changes, the blocks are dropped 
+        # once all the addresses are in storage.
+        pending = self._pending_balance
+        changes = list(pending.items())
+        for start in range(0, len(changes), UPDATE_SLICE_SIZE):
+            chunk = changes[start:start+UPDATE_SLICE_SIZE]
+            with self._lock:
+                self._storage.update_bulk(chunk)
+                pending.discard(address for address, _ in chunk)
+
+        with self._lock:
+            height = self._blocks[-1].height
+            self._blocks.clear()
+            self._pending_balance = PendingBalance()
+            self._fast_height = height
+
+        self._storage.commit(height)
+
+    def _flush_fast(self):
+        """Move the fast sync balance changes into storage and commit"""
+        if self._fast_height is None:
             return
+        
+        # Moved in slices so readers don't wait for the whole batch, each
+        # address is moved from fast_deltas into storage atomically.
+        fast_deltas = self._fast_deltas
+        changes = list(fast_deltas.items())
+        for start in range(0, len(changes), UPDATE_SLICE_SIZE):
+            chunk = changes[start:start+UPDATE_SLICE_SIZE]
+            with self._lock:
+                self._storage.update_bulk(chunk)
+                for address, _ in chunk:
+                    del fast_deltas[address]
 
-        records = self._pending_records[address]
+        # Height is still reported by fast_height until commit sets it
+        self._storage.commit(self._fast_height)
+        self._fast_height = None
 
-        record = records.pop() if last else records.popleft()
+    def _add_block_fast(self, block):
+        """Add block in fast sync mode, only the net balance change of each
+        address is kept, and commited in large batches."""
+        if self._blocks:
+            self._flush_blocks()
 
-        self._pending_balance[address] -= record.value
- 
-        # Cleanup
-        if not records:
-            del self._pending_records[address]
+        delta = BlockDelta(block, self._address_ids)
+
+        with self._lock:
+            fast_deltas = self._fast_deltas
+            for address, value in delta.balance.items():
+                fast_deltas[address] += value
+                if not fast_deltas[address]:
+                    del fast_deltas[address]
+            self._fast_height = block.height
+
+        now = time.perf_counter()
+        if len(self._fast_deltas) > FAST_SYNC_BATCH or now-self._last_block_time>30:
+            self._flush_fast()
+
+        self._last_block_time = now
+
+    def add_block(self, block, tip=None): 
+        """Add next block in the chain
         
-        if not self._pending_balance[address]:
-            del self._pending_balance[address]
+        Arguments:
+            block (Block):
+            tip (int|None): Blockchain top block height if known, used to
+                decide if fast sync mode can be used.
+        """
+        if self._is_fast_sync(block.height, tip):
+            self._add_block_fast(block)
+            return
+
+        # Close to the tip, from now on blocks must be tracked
+        self._flush_fast()
+
+        delta = BlockDelta(block, self._address_ids)
 
-    def add_block(self, block): 
-        """Add next block in the chain"""
         # Add newest block 
         with self._lock:
-            self._blocks.append(block) 
-       
-            for address, record in block_record_iter(block):
-                self._add_record(address, record)
+            self._blocks.append(self._pending_balance.add(delta))
 
-        # Commit oldest block to storage if the limit has been reached
+        # Move oldest block to storage if the limit has been reached
         if len(self._blocks) > self._backtrack_limit:
             with self._lock:
-                block = self._blocks.popleft()
-            
-                for address, record in block_record_iter(block):
-                    self._del_record(address, last=False)
-                    self._storage.update(address, record.value)
+                journal = self._blocks.popleft()
+                self._storage.update_bulk(zip(
+                    self._pending_balance.addresses(journal.ids), journal.deltas))
+                self._pending_balance.remove(journal)
 
         # Determine if it's the best time for a storage commit
         # more than 30000 pending updates or more than 30 seconds 
@@ -132,51 +368,122 @@ class BalanceProcessor(object):
             raise BacktrackError("Reached backtrack limit")
 
         with self._lock:
-            block = self._blocks.pop()
-
-            for address, record in block_record_iter(block):
-                self._del_record(address, last=True)
+            self._pending_balance.remove(self._blocks.pop())
 
-    def get_transactions(self, address, confirmations=0): 
-        """Return a list of the unconfirmed incoming/outgoing transactions.
+    def get_block_changes(self, address, confirmations=0): 
+        """Return the unconfirmed balance changes of an address, one for
+        each block. Blocks are tracked as per address deltas, the 
+        transactions that caused them aren't kept.
 
         Arguments:
-            address (str): Bitcoin address
-            confirmations (int): Number of confirmations required for a transaction
+            address: Address key, or address id when tracking by id
+            confirmations (int): Number of confirmations required for a block
                 to be considered confirmed (must be smalled than backtrack_limit)
 
         Returns:
-            (transaction_hash, value, block_height)
+            [BlockChange(block_hash, value, height), ...] newest first, value
+                is the net balance change of the address in the block, blocks
+                without net change aren't included.
         """
-        if address not in self._pending_records:
-            return []
+        lock = self._lock
+        while True:
+            seq = lock.read_begin()
 
-        # transactions from blocks lower than this height are confirmed
-        limit_height = self.height-confirmations
+            # blocks lower than this height are confirmed
+            limit_height = self.height-confirmations
 
-        unconfirmed = [] # Unconfirmed records
+            unconfirmed = []
+            address_id = self._pending_balance.address_id(address)
+            if address_id is not None:
+                # Copied so a concurrent write doesn't break the iteration
+                for journal in reversed(list(self._blocks)):
+                    if journal.height < limit_height:
+                        break
 
-        with self._lock:
-            for record in reversed(self._pending_records[address]):
-                if record.height < limit_height:
-                    break
-
-                unconfirmed.append(record)
-
-        return unconfirmed
+                    value = journal.get(address_id)
+                    if value is not None:
+                        unconfirmed.append(BlockChange(journal.block_hash, value,
+                                                       journal.height))
 
+            if not lock.read_retry(seq):
+                return unconfirmed
 
     def get_balance(self, address):
         """Return bitcoin address balance, can be called concurrently with:
         commit, backtrack, and add_blok"""
-        with self._lock:
-            return self._storage.get(address)+self._pending_balance.get(address, 0)
+        lock = self._lock
+        while True:
+            seq = lock.read_begin()
+            balance = (self._storage.get(address)
+                       + self._pending_balance.get(address, 0)
+                       + self._fast_deltas.get(address, 0))
+            if not lock.read_retry(seq):
+                return balance
+
+    def get_cached_balance(self, address):
+        """Return address balance if it can be obtained without reading 
+        storage, None otherwise"""
+        lock = self._lock
+        while True:
+            seq = lock.read_begin()
+            balance = self._storage.get_cached(address)
+            if balance is not None:
+                balance += (self._pending_balance.get(address, 0)
+                            + self._fast_deltas.get(address, 0))
+            if not lock.read_retry(seq):
+                return balance
+
+    def get_balances(self, addresses, cached_only=False):
+        """Return the balance of several addresses at the same height,
+        can be called concurrently with: commit, backtrack, and add_block
+
+        Arguments:
+            addresses (iterable):
+            cached_only (bool): Return None if storage must be read
+
+        Returns:
+            {address: balance, ...}
+        """
+        addresses = list(addresses)
+        lock = self._lock
+        while True:
+            seq = lock.read_begin()
+            balances = self._storage.get_bulk(addresses, cached_only)
+            if balances is None:
+                return None
+
+            pending = self._pending_balance
+            fast_deltas = self._fast_deltas
+            for addr in balances:
+                balances[addr] += pending.get(addr, 0) + fast_deltas.get(addr, 0)
+            
+            if not lock.read_retry(seq):
+                return balances
 
     def commit(self):
         """Force commit balance to storage"""
-        if self._blocks:
+        if self._fast_height is not None:
+            self._flush_fast()
+        elif self._blocks:
             self._storage.commit(self._blocks[0].height-1)
 
     @property
     def height(self):
-        return self._blocks[-1].height if self._blocks else self._storage.height
+        """Height of the last block added, can be called concurrently with:
+        commit, backtrack, and add_block"""
+        lock = self._lock
+        while True:
+            seq = lock.read_begin()
+            try:
+                if self._blocks:
+                    height = self._blocks[-1].height
+                elif self._fast_height is not None:
+                    height = self._fast_height
+                else:
+                    height = self._storage.height
+            except IndexError:
+                # Blocks removed by a concurrent write
+                continue
+
+            if not lock.read_retry(seq):
+                return height
@@ -0,0 +1,171 @@
+"""
+bloom
+
+Bloom filter of the addresses that ever had a stored balance, so queries
+for unknown addresses can be answered without reading the storage.
+
+The filter is scalable, when a filter reaches its capacity a new one twice
+as large and with a tighter error rate is added, so it never has to be
+rebuilt to grow. Keys are hashed with blake2b so the filter can be saved
+and loaded in another process.
+"""
+import math
+import os
+import struct
+from hashlib import blake2b
+
+
+FILE_MAGIC = b'BLOOMF01'
+
+# magic, height, number of filters
+FILE_HEADER = struct.Struct('<8sqI')
+
+# num_bits, num_hashes, capacity, count
+FILTER_HEADER = struct.Struct('<QIQQ')
+
+# Error rate multiplier for each new filter
+ERROR_TIGHTENING = 0.5
+
+# Capacity multiplier for each new filter
+GROWTH = 2
+
+
+def _key_hashes(key):
+    """Two independent 64bit hashes of the key"""
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    elif isinstance(key, int):
+        key = key.to_bytes(8, 'little')
+    digest = blake2b(key, digest_size=16).digest()
+    return struct.unpack('<QQ', digest)
+
+
+class _Filter(object):
+    """Fixed capacity bloom filter"""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.num_bits = max(int(-capacity*math.log(error_rate) / math.log(2)**2), 64)
+        self.num_hashes = max(int(round(self.num_bits/capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits+7) // 8)
+        self.count = 0
+
+    def _indexes(self, h1, h2):
+        num_bits = self.num_bits
+        return [(h1 + i*h2) % num_bits for i in range(self.num_hashes)]
+
+    def add(self, h1, h2):
+        bits = self.bits
+        for idx in self._indexes(h1, h2):
+            bits[idx >> 3] |= 1 << (idx & 7)
+        self.count += 1
+
+    def contains(self, h1, h2):
+        bits = self.bits
+        for idx in self._indexes(h1, h2):
+            if not bits[idx >> 3] & (1 << (idx & 7)):
+                return False
+        return True
+
+
+class BloomFilter(object):
+    """Scalable bloom filter, there are no false negatives and the
+    false positive rate stays below error_rate as it grows.
+
+    Adding and checking concurrently is safe, a key is found once add()
+    returns.
+    """
+
+    def __init__(self, capacity=1 << 20, error_rate=0.01):
+        """
+        Arguments:
+            capacity (int): Initial number of keys
+            error_rate (float): Max false positive rate
+        """
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._filters = [_Filter(capacity, error_rate*(1-ERROR_TIGHTENING))]
+
+    def __len__(self):
+        """Number of keys added (including duplicates)"""
+        return sum(f.count for f in self._filters)
+
+    def __contains__(self, key):
+        h1, h2 = _key_hashes(key)
+        return any(f.contains(h1, h2) for f in self._filters)
+
+    def add(self, key):
+        h1, h2 = _key_hashes(key)
+        if any(f.contains(h1, h2) for f in self._filters):
+            return
+
+        current = self._filters[-1]
+        if current.count >= current.capacity:
+            error_rate = self._error_rate*(1-ERROR_TIGHTENING) \
+                         * ERROR_TIGHTENING**len(self._filters)
+            current = _Filter(current.capacity*GROWTH, error_rate)
+            self._filters.append(current)
+
+        current.add(h1, h2)
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def save(self, path, height=-1):
+        """Save filter to a file, it's replaced atomically
+
+        Arguments:
+            path (str): file path
+            height (int): Storage height stored with the filter
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(FILE_HEADER.pack(FILE_MAGIC, height, len(self._filters)))
+            for flt in self._filters:
+                f.write(FILTER_HEADER.pack(flt.num_bits, flt.num_hashes,
+                                           flt.capacity, flt.count))
+                f.write(flt.bits)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, error_rate=0.01):
+        """Load filter saved with save()
+
+        Returns:
+            (BloomFilter, height)
+
+        Raises:
+            ValueError: The file isn't a valid filter
+        """
+        with open(path, 'rb') as f:
+            header = f.read(FILE_HEADER.size)
+            if len(header) != FILE_HEADER.size:
+                raise ValueError("Truncated filter file")
+
+            magic, height, num_filters = FILE_HEADER.unpack(header)
+            if magic != FILE_MAGIC or num_filters == 0:
+                raise ValueError("Invalid filter file")
+
+            filters = []
+            for _ in range(num_filters):
+                header = f.read(FILTER_HEADER.size)
+                if len(header) != FILTER_HEADER.size:
+                    raise ValueError("Truncated filter file")
+
+                flt = _Filter.__new__(_Filter)
+                flt.num_bits, flt.num_hashes, flt.capacity, flt.count = \
+                        FILTER_HEADER.unpack(header)
+                flt.bits = bytearray(f.read((flt.num_bits+7) // 8))
+                if len(flt.bits) != (flt.num_bits+7) // 8:
+                    raise ValueError("Truncated filter file")
+                filters.append(flt)
+
+        bloom = cls.__new__(cls)
+        bloom._capacity = filters[0].capacity
+        bloom._error_rate = error_rate
+        bloom._filters = filters
+        return bloom, height
@@ -0,0 +1,367 @@
+"""
+cache
+
+Address balance cache used by BalanceProxyCache, sharded by address hash
+with one lock per shard so concurrent writers don't contend, reads don't 
+take any lock. Each shard uses CLOCK (second-chance) replacement, the 
+values are stored with their reference bit in the shard dict so a hit is 
+a single lookup that only sets the bit instead of moving a linked-list 
+node like an LRU.
+
+Entries loaded for a commit are kept in a per shard staging area and after
+the commit they are only admitted into the cache when they have been
+accessed more frequently than the entry they would evict (TinyLFU), the
+access frequencies are estimated with a count-min sketch. This way the
+addresses updated by each block don't flush the addresses being queried.
+"""
+import threading
+from collections import OrderedDict
+from random import getrandbits
+
+
+# Default number of shards (power of 2)
+CACHE_SHARDS = 16
+
+# Count-min sketch rows
+SKETCH_DEPTH = 4
+
+# Max counter value
+SKETCH_MAX_COUNT = 15
+
+# Default sketch sampling used by caches on the read path, 1 in 
+# SKETCH_SAMPLE accesses are recorded (power of 2)
+SKETCH_SAMPLE = 4
+
+# Multiplicative hashing seed, the row indexes are taken from different 
+# bits of a single hash
+SKETCH_SEED = 0x9E3779B97F4A7C15
+
+_MASK64 = (1 << 64)-1
+
+# Translation table halving all the counters
+_HALVE = bytes(n >> 1 for n in range(256))
+
+# Marks keys not staged
+_MISSING = object()
+
+
+class FrequencySketch(object):
+    """Count-min sketch estimating how many times each key was accessed
+    recently. Counters saturate at SKETCH_MAX_COUNT and are halved every 
+    10*size increments so old accesses are forgotten.
+
+    With sampling only a random 1 in sample increments is recorded, the 
+    estimations are scaled down by the same factor for all the keys so 
+    they can still be compared, but keys accessed a few times may not 
+    be counted at all.
+
+    Increments aren't synchronized, some can be lost with concurrent
+    access but that only makes the estimation less accurate.
+    """
+
+    def __init__(self, size, sample=1):
+        """
+        Arguments:
+            size (int): Number of keys tracked, usually the cache size
+            sample (int): Record 1 in sample increments (power of 2)
+        """
+        assert sample > 0 and sample & (sample-1) == 0
+        bits = max(size-1, 1023).bit_length()
+        self._width = 1 << bits
+        self._mask = self._width-1
+        self._table = bytearray(self._width*SKETCH_DEPTH)
+        self._sample_bits = sample.bit_length()-1
+        self._sample_size = max(10*size // sample, 1)
+        self._additions = 0
+
+        # Row n index is taken from the hash bits starting at _shifts[n],
+        # they only overlap for widths above 2**16.
+        step = (64-bits) // (SKETCH_DEPTH-1)
+        self._shifts = tuple(64-bits-row*step for row in range(SKETCH_DEPTH))
+
+    def increment(self, key):
+        if self._sample_bits and getrandbits(self._sample_bits):
+            return
+
+        h = hash(key) * SKETCH_SEED & _MASK64
+        shift0, shift1, shift2, shift3 = self._shifts
+        mask = self._mask
+        width = self._width
+        table = self._table
+
+        # Rows unrolled, SKETCH_DEPTH == 4
+        idx = h >> shift0
+        if table[idx] < SKETCH_MAX_COUNT:
+            table[idx] += 1
+        idx = width + (h >> shift1 & mask)
+        if table[idx] < SKETCH_MAX_COUNT:
+            table[idx] += 1
+        idx = 2*width + (h >> shift2 & mask)
+        if table[idx] < SKETCH_MAX_COUNT:
+            table[idx] += 1
+        idx = 3*width + (h >> shift3 & mask)
+        if table[idx] < SKETCH_MAX_COUNT:
+            table[idx] += 1
+
+        self._additions += 1
+        if self._additions >= self._sample_size:
+            self._table = table.translate(_HALVE)
+            self._additions //= 2
+
+    def frequency(self, key):
+        h = hash(key) * SKETCH_SEED & _MASK64
+        mask = self._mask
+        width = self._width
+        table = self._table
+        return min(table[row*width + (h >> shift & mask)]
+                   for row, shift in enumerate(self._shifts))
+
+
+class _ClockShard(object):
+    """Single CLOCK cache shard, callers must hold the shard lock to modify
+    it.
+
+    The entries are kept in clock order in an OrderedDict, the first one is
+    under the clock hand. Advancing the hand moves the entry to the end, 
+    so new entries are always inserted right behind the hand.
+    """
+
+    __slots__ = ('lock', 'entries', 'staged')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # key -> [value, reference bit]
+        self.entries = OrderedDict()
+        self.staged = {}
+
+    def insert(self, key, value):
+        self.entries[key] = [value, 0]
+
+    def victim(self, pinned=()):
+        """Find the next entry to evict, the first one without reference 
+        bit found by the clock hand, clearing the bits it passes over.
+
+        Arguments:
+            pinned (container): keys that can't be evicted
+
+        Returns:
+            victim key, None if there isn't any evictable entry
+        """
+        entries = self.entries
+        
+        # Two turns clear all the reference bits
+        for _ in range(2*len(entries)):
+            key, entry = next(iter(entries.items()))
+            if key not in pinned:
+                if not entry[1]:
+                    return key
+                entry[1] = 0
+            entries.move_to_end(key)
+
+        return None
+
+    def evict(self, pinned=()):
+        """Evict one entry
+
+        Returns:
+            (bool): False if there wasn't any entry to evict
+        """
+        key = self.victim(pinned)
+        if key is None:
+            return False
+        del self.entries[key]
+        return True
+
+
+class ShardedClockCache(object):
+    """address -> balance cache, all the methods are thread-safe.
+
+    The cache isn't bounded by itself, entries are evicted when a max_size
+    is provided on insertion or by trim(). Keys in the pinned container are
+    never evicted.
+
+    Staged entries are readable like cached ones but don't count towards the
+    cache size, they are moved into the cache by admit_staged().
+
+    Reads don't take the shard lock, the GIL makes the dict lookups atomic.
+    Staged entries are inserted before being removed from the staging area
+    so a key being admitted is always found by checking the entries again 
+    after the staging area.
+    """
+
+    def __init__(self, shards=CACHE_SHARDS, sketch=None):
+        """
+        Arguments:
+            shards (int): Number of shards (power of 2)
+            sketch (FrequencySketch): Access frequency estimation used to
+                admit staged entries, without it all are admitted.
+        """
+        assert shards > 0 and shards & (shards-1) == 0
+        self._shards = [_ClockShard() for _ in range(shards)]
+        self._mask = shards-1
+        self._sketch = sketch
+
+        # Keys that can't be evicted
+        self.pinned = ()
+
+    def _shard(self, key):
+        return self._shards[hash(key) & self._mask]
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def __contains__(self, key):
+        return key in self._shard(key).entries
+
+    def get(self, key, default=None):
+        """Get cached or staged value, the access is recorded and the entry
+        marked as referenced"""
+        if self._sketch is not None:
+            self._sketch.increment(key)
+
+        shard = self._shards[hash(key) & self._mask]
+        entry = shard.entries.get(key)
+        if entry is None:
+            value = shard.staged.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            entry = shard.entries.get(key)
+            if entry is None:
+                return default
+        
+        entry[1] = 1
+        return entry[0]
+
+    def peek(self, key, default=None):
+        """Get cached or staged value without recording the access"""
+        shard = self._shard(key)
+        entry = shard.entries.get(key)
+        if entry is None:
+            value = shard.staged.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            entry = shard.entries.get(key)
+            if entry is None:
+                return default
+        
+        return entry[0]
+
+    def set(self, key, value):
+        """Set value for a key, cached or not"""
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None:
+                shard.insert(key, value)
+            else:
+                entry[0] = value
+
+    def set_missing(self, key, value, max_size=None, valid=None):
+        """Set value only if the key isn't cached
+
+        Arguments:
+            key:
+            value (int):
+            max_size (int): Evict entries from the key shard while the
+                cache is larger
+            valid (callable): Checked while holding the shard lock, the 
+                value isn't added if it returns False.
+
+        Returns:
+            (bool): True if it was added
+        """
+        shard = self._shard(key)
+        with shard.lock:
+            if key in shard.entries or key in shard.staged or \
+                    (valid is not None and not valid()):
+                return False
+            if max_size is not None:
+                while len(self) >= max_size and shard.evict(self.pinned):
+                    pass
+
+            shard.insert(key, value)
+            return True
+
+    def stage(self, key, value):
+        """Stage value if the key isn't cached or staged
+
+        Returns:
+            (bool): True if it was staged
+        """
+        shard = self._shard(key)
+        with shard.lock:
+            if key in shard.entries or key in shard.staged:
+                return False
+            shard.staged[key] = value
+            return True
+
+    def add(self, key, value):
+        """Add value to a cached or staged key"""
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None:
+                shard.staged[key] += value
+            else:
+                entry[0] += value
+
+    def admit_staged(self, max_size):
+        """Move staged entries into the cache while there is free space, 
+        once full a staged entry replaces the clock victim only if it was
+        accessed more frequently. The rest are discarded.
+
+        Arguments:
+            max_size (int): Cache max size
+        """
+        sketch = self._sketch
+        for shard in self._shards:
+            with shard.lock:
+                for key, value in shard.staged.items():
+                    if len(self) < max_size:
+                        shard.insert(key, value)
+                        continue
+
+                    victim = shard.victim(self.pinned)
+                    if victim is None:
+                        continue
+
+                    if sketch is None or \
+                            sketch.frequency(key) > sketch.frequency(victim):
+                        del shard.entries[victim]
+                        shard.insert(key, value)
+                
+                shard.staged = {}
+
+    def discard_staged(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.staged = {}
+
+    def trim(self, max_size):
+        """Evict entries until there are at most max_size, the entries are
+        evicted from each shard proportionally to its size."""
+        size = len(self)
+        if size <= max_size:
+            return
+
+        excess = size - max_size
+        for shard in self._shards:
+            with shard.lock:
+                for _ in range(excess * len(shard.entries) // size):
+                    if not shard.evict(self.pinned):
+                        break
+
+        # Rounding remainder
+        for shard in self._shards:
+            if len(self) <= max_size:
+                break
+            with shard.lock:
+                shard.evict(self.pinned)
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.reset()
@@ -1,5 +1,7 @@
 from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 import multiprocessing
+import heapq
 import threading
 import time
 import logging
@@ -11,13 +13,21 @@ import bitcoin.rpc
 from bitcoin.core import str_money_value, b2lx, b2x, x
 
 from .primitives import TxOut, Block, BlockFactory
+from .rawblock import deserialize_block
+from .address import address_to_key
 from .balance import BalanceProcessor
-from .exceptions import ChainError, BacktrackError
+from .exceptions import ChainError, BacktrackError, StorageError
 from .logger import LOGGING_FORMAT
-from .storage import MemoryBalanceStorage, SQLBalanceStorage, BalanceProxyCache
-from .database import Session
+from .addressid import MemoryAddressDictionary, SQLAddressDictionary
+from .storage import (MemoryBalanceStorage, SQLBalanceStorage, SQLiteBalanceStorage,
+                      BalanceProxyCache, AddressFilterStorage)
+from .database import check_schema_version, database_file
 from .settings import Settings
-from .proxy import BitcoindProxy
+from .proxy import BitcoindProxy, BitcoindProxyPool
+from .utxo import MemoryUtxoIndex, SQLUtxoIndex
+from .importer import BlockFileReader
+from .snapshot import (import_utxo_snapshot, check_snapshot_height,
+        SNAPSHOT_IMPORT_HEIGHT)
 
 logging.basicConfig(format=LOGGING_FORMAT, level=logging.INFO)
 logger = logging.getLogger("Bitcoin")
@@ -29,138 +39,242 @@ bitcoin.SelectParams(Settings['BITCOIN_CHAIN'])
 # Cache size for pending blocks
 BLOCK_CACHE_SIZE = 10
 
+# Number of concurrent block download workers
+BLOCK_FETCH_WORKERS = Settings.get('BLOCK_FETCH_WORKERS', 1)
 
-class BlockPrefetchingCache(object):
-    """BlockCache is a prefetching cache for sequential blockchain blocks"""
+# Max number of blocks requested by a worker in a single batch
+BLOCK_FETCH_BATCH = Settings.get('BLOCK_FETCH_BATCH', 1)
+
+# Number of processes decoding raw blocks (None for one per CPU)
+BLOCK_DECODE_PROCESSES = Settings.get('BLOCK_DECODE_PROCESSES', 0)
+
+# Max number of failed attempts to decode a block in the decoding processes,
+# then it's downloaded and decoded in the thread calling get_next_block.
+BLOCK_DECODE_RETRIES = 3
 
-    def __init__(self, height, proxy, cache_size=BLOCK_CACHE_SIZE):
+
+class BlockPrefetchingCache(object):
+    """BlockCache is a prefetching cache for sequential blockchain blocks
+
+    Blocks are downloaded by several worker threads, each one checking out
+    its own connection from a BitcoindProxyPool. Workers request different 
+    heights concurrently and place the results into a reorder buffer, so 
+    get_next_block always returns blocks in height order.
+    
+    Raw blocks can be decoded by a process pool, so decoding isn't limited
+    to a single core by the GIL. In that case the reorder buffer holds the
+    decoding futures."""
+
+    def __init__(self, height, proxy, cache_size=BLOCK_CACHE_SIZE, 
+                 workers=BLOCK_FETCH_WORKERS, batch_size=BLOCK_FETCH_BATCH,
+                 raw=False, decode_processes=BLOCK_DECODE_PROCESSES):
         """
         Arguments:
             height (int): Cache starting height, the first time 
                 get_next_block is successful this is the block it
                 will return.
 
-            proxy (proxy.BitcoindProxy|str): initialized BitcoindProxy or 
-                bitcoind_url string
+            proxy (proxy.BitcoindProxyPool|proxy.BitcoindProxy|str): 
+                initialized BitcoindProxyPool, BitcoindProxy or bitcoind_url 
+                string (a pool with one connection per worker is created)
+            cache_size (int): Max number of blocks downloaded ahead of the 
+                next block returned by get_next_block
+            workers (int): Number of download threads (and connections)
+            batch_size (int): Max number of blocks downloaded by a worker
+                with a single batch request
+            raw (bool): Download serialized blocks and decode them with
+                rawblock.deserialize_block instead of python-bitcoinlib,
+                get_next_block returns RawBlocks instead of cBlocks.
+            decode_processes (int|None): Number of processes decoding raw 
+                blocks, None for one per CPU and 0 to decode them in the 
+                download threads.
         """
-        if isinstance(proxy, BitcoindProxy):
+        assert workers > 0
+        assert batch_size > 0
+
+        if isinstance(proxy, (BitcoindProxy, BitcoindProxyPool)):
             self._proxy = proxy
+            self._owns_proxy = False
         else:
-            self._proxy = BitcoindProxy(proxy)
+            self._proxy = BitcoindProxyPool(proxy, workers)
+            self._owns_proxy = True
 
-        # Height for the next block to request from bitcoind
+        # Height for the next block returned by get_next_block
         self._height = height
 
-        # Cached blocks
+        # Height for the next block to request from bitcoind
+        self._fetch_height = height
+
+        # Heights whose download failed and must be requested again
+        self._retry = []
+
+        # Height of the top blockchain block (-1 until the first poll)
+        self._blockchain_height = -1
+
+        # Reorder buffer with the downloaded blocks {height: cblock}
         self._cache_size = cache_size
-        self._cache = queue.Queue(self._cache_size)
+        self._batch_size = batch_size
+        self._raw = raw
+        self._blocks = {}
+
+        # Raw block decoding processes
+        if raw and decode_processes != 0:
+            self._decoder = ProcessPoolExecutor(decode_processes,
+                    mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self._decoder = None
+
+        # Number of failed decodings for each height {height: count}
+        self._decode_errors = {}
+
+        # Incremented each time the cache is purged, downloads started 
+        # before a purge are discarded.
+        self._generation = 0
 
         # lock polling while purging or setting new height
-        self._lock = threading.Lock()
+        self._lock = threading.Condition()
 
         # Event to signal threads to stop
         self._stop_event = threading.Event()
 
-        # Launch polling thread
-        self._fetch_thread = threading.Thread(target=self._fetch_thread_func, 
-                                             daemon=False)
-        self._fetch_thread.start()
+        # Launch polling threads
+        self._fetch_threads = []
+        for _ in range(workers):
+            thread = threading.Thread(target=self._fetch_thread_func, 
+                                      daemon=False)
+            thread.start()
+            self._fetch_threads.append(thread)
 
+    @property
+    def tip(self):
+        """Height of the top blockchain block, -1 until it's known"""
+        return self._blockchain_height
+
+    def _claim_heights(self):
+        """Return the next heights to download (up to batch_size), or an 
+        empty list if there isn't any available. Must be called holding 
+        the lock"""
+        heights = []
+        while self._retry and self._retry[0] <= self._blockchain_height:
+            heights.append(heapq.heappop(self._retry))
+            if len(heights) >= self._batch_size:
+                return heights
+
+        while len(heights) < self._batch_size:
+            height = self._fetch_height
+            if height > self._blockchain_height:
+                break
+
+            if height >= self._height + self._cache_size:
+                break
+
+            self._fetch_height += 1
+            heights.append(height)
+
+        return heights
+
+    def _poll_blockchain_height(self):
+        """Query bitcoind for the top blockchain block height"""
+        with self._proxy as proxy:
+            blockchain_height = proxy.get_blockcount()
 
-    def _fetch_thread_func(self):
-        """Thread polling bitcoind looking for the next block"""
-        # height for the top blockchain block
-        blockchain_height = 1
-       
-        # Initialize height and cache for first iteration
         with self._lock:
-            current_height = self._height - 1
-            cache = self._cache
+            if blockchain_height != self._blockchain_height:
+                self._blockchain_height = blockchain_height
+                self._lock.notify_all()
 
+    def _fetch_thread_func(self):
+        """Thread polling bitcoind looking for the next block"""
         # Flag the connection was lost
         connection_lost = False
         
         # TODO: Log when connection to bitcoind is lost and recovered
         while True:
-            # Check cache wasn't purged
-            with self._lock:
-                if id(cache) != id(self._cache):
-                    cache = self._cache
-                    current_height = self._height-1
-
+            # If the connection to bitcoind was lost wait default poll period
+            # before trying again.
+            if connection_lost:
+                if self._stop_event.wait(timeout=Settings['BITCOIND_POLL_PERIOD']):
+                    break
+            
             # Did an exit signal arrive?
-            if self._stop_event.wait(timeout=0):
+            if self._stop_event.is_set():
                 break
-           
-            # If we are not yet at the top of the blockchain, get the next block
-            # as fast as possible. If it is the top or the connection to bitcoind
-            # was lost, wait default poll period and check for new blocks.
-            if connection_lost or current_height >= blockchain_height:
-                stop = self._stop_event.wait(timeout=Settings['BITCOIND_POLL_PERIOD'])
-                if stop:
-                    break
 
-            
-            with self._proxy as proxy:
+            with self._lock:
+                generation = self._generation
+                heights = self._claim_heights()
 
-                # Already at the top, are there new blocks????
-                if current_height >= blockchain_height:
-                    try:
-                        blockchain_height = proxy.get_blockcount()
-                        connection_lost = False
-                        if current_height >= blockchain_height:
-                            continue
-                    except ConnectionError:
-                        connection_lost = True
-                        continue
+                # The reorder buffer is full, wait until get_next_block
+                # frees some space
+                if not heights and self._fetch_height <= self._blockchain_height:
+                    self._lock.wait(timeout=Settings['BITCOIND_POLL_PERIOD'])
+                    continue
 
+                known_height = self._blockchain_height >= 0
 
-                # Request the next block in the sequence
+            # Already at the top, wait default poll period and check 
+            # for new blocks.
+            if not heights:
+                if known_height:
+                    stop = self._stop_event.wait(timeout=Settings['BITCOIND_POLL_PERIOD'])
+                    if stop:
+                        break
                 try:
-                    cblock = proxy.get_block(current_height+1)
+                    self._poll_blockchain_height()
                     connection_lost = False
                 except ConnectionError:
                     connection_lost = True
-                    continue
+                continue
 
-            # try to add the block at the end of the cache for a reasonable
-            # amount of time, if it fails discard it and try again later.
-            while True:
+            # Request the blocks
+            try:
+                with self._proxy as proxy:
+                    cblocks = proxy.get_blocks(heights, raw=self._raw)
+                connection_lost = False
+            except (ConnectionError, IndexError) as err:
+                connection_lost = isinstance(err, ConnectionError)
+                with self._lock:
+                    if generation == self._generation:
+                        for height in heights:
+                            heapq.heappush(self._retry, height)
+                    
+                    # The chain is shorter than expected (reorg) 
+                    if isinstance(err, IndexError):
+                        self._blockchain_height = min(self._blockchain_height,
+                                                      min(heights)-1)
+                continue
+
+            decoder = self._decoder
+            if decoder is not None:
                 try:
-                    cache.put((current_height, cblock), timeout=3)
-                    current_height +=1
-                    break
-                except queue.Full:
-                    pass
-            
-                if self._stop_event.wait(timeout=0):
-                    break
-                
-        # Clean up before exiting
-        self._proxy.stop()
+                    cblocks = [decoder.submit(deserialize_block, b) for b in cblocks]
+                except RuntimeError:
+                    # Decoder pool shutdown by stop()
+                    if self._stop_event.is_set():
+                        break
+
+                    # The pool is broken, decode in the download threads
+                    logger.error("Block decoding pool failed, decoding in download threads")
+                    self._decoder = decoder = None
 
+            if decoder is None and self._raw:
+                cblocks = [deserialize_block(b) for b in cblocks]
+
+            # Discard the blocks if the cache was purged during the download
+            with self._lock:
+                if generation == self._generation:
+                    self._blocks.update(zip(heights, cblocks))
+                    self._lock.notify_all()
 
     def set_height(self, height):
         """Purge current cache and start caching at a different height"""
-        new_cache = queue.Queue(self._cache_size)
         with self._lock: 
-            old_cache = self._cache
-            self._cache = new_cache
+            self._generation += 1
+            self._blocks = {}
+            self._retry = []
             self._height = height
-
-        # Purge all blocks from the old cache and fill it with None
-        # to assure there isn't a get_next_block call stuck
-        while True:
-            try:
-                old_cache.get(block=False)
-            except queue.Empty:
-                break
-
-        while True:
-            try:
-                old_cache.put((None, None), block=False)
-            except queue.Full:
-                break
+            self._fetch_height = height
+            self._lock.notify_all()
 
     def get_next_block(self, block=True, timeout=None):
         """Get the next block in the chain
@@ -173,25 +287,57 @@ class BlockPrefetchingCache(object):
         
         Exceptions:
             queue.Empty
+            Exception: The block can't be decoded after BLOCK_DECODE_RETRIES
+                tries (only with decode processes)
 
         Returns:
             (int, cBlock)-> block height and block tuple
         """
+        if not block:
+            timeout = 0
+
         while True:
-            cache = self._cache
+            with self._lock:
+                available = self._lock.wait_for(lambda: self._height in self._blocks,
+                                                timeout)
+                if not available:
+                    raise queue.Empty
+
+                height = self._height
+                cblock = self._blocks.pop(height)
+                self._height += 1
+
+                # Wake up workers waiting for free space
+                self._lock.notify_all()
+
+            if not isinstance(cblock, Future):
+                return height, cblock
 
-            height, cblock = cache.get(block, timeout)
-            if cblock is None:
+            # Wait until the block is decoded, if it fails download it again
+            try:
+                block = cblock.result()
+                self._decode_errors.pop(height, None)
+                return height, block
+            except Exception:
+                logger.exception("Error decoding block {}".format(height))
+
+            errors = self._decode_errors.get(height, 0) + 1
+            if errors < BLOCK_DECODE_RETRIES:
+                self._decode_errors[height] = errors
+                self.set_height(height)
                 continue
-       
-            # the previous get call could have blocked for a long time,
-            # check cache wasn't purged meanwhile
-            if id(cache) != id(self._cache):
+
+            # Retries exhausted, download and decode in this thread
+            # so decoding errors are raised.
+            try:
+                with self._proxy as proxy:
+                    rawblock = proxy.get_blocks([height], raw=True)[0]
+            except (ConnectionError, IndexError):
+                self.set_height(height)
                 continue
-            else:
-                break
 
-        return height, cblock
+            self._decode_errors.pop(height, None)
+            return height, deserialize_block(rawblock)
 
     def stop(self, block=False):
         """
@@ -201,8 +347,18 @@ class BlockPrefetchingCache(object):
             block (bool): If true block until thread has exited
         """
         self._stop_event.set()
+        with self._lock:
+            self._lock.notify_all()
+
+        if self._owns_proxy:
+            self._proxy.stop()
+
+        if self._decoder is not None:
+            self._decoder.shutdown(wait=False, cancel_futures=True)
+
         if block:
-            self._fetch_thread.join()
+            for thread in self._fetch_threads:
+                thread.join()
 
 
 
@@ -210,36 +366,124 @@ class BlockPrefetchingCache(object):
 class BitcoinBalanceFacade(object):
     """ """
      
-    def __init__(self, db_session=None, bitcoind_url=None, backtrack_limit=None):
+    def __init__(self, db_session=None, bitcoind_url=None, backtrack_limit=None,
+                 blocks_dir=None, storage=None):
         """
         Arguments:
             db_session (SQLAlchemy.Session)
             bitcoin_url (string):
             backtrack_limit (int):
+            blocks_dir (string): Directory with bitcoind blk*.dat files used
+                for the initial sync before polling bitcoind.
+            storage (BalanceStorage): Balance storage backend, by default
+                SQLBalanceStorage when there is a db_session. With 
+                Settings['ADDRESS_IDS'] it must be created with 
+                address_ids=True (except MemoryBalanceStorage), and a
+                persistent storage requires a db_session to store the ids.
         """
         self._db_session = db_session
         self._bitcoind_url = bitcoind_url or Settings['BITCOIND_URL']
         self._backtrack_limit = backtrack_limit or Settings['MAX_BACKTRACK_BLOCKS']
+        self._blocks_dir = blocks_dir or Settings['BLOCKS_DIR']
+
+        if Settings['UTXO_SNAPSHOT']:
+            check_snapshot_height(Settings['UTXO_SNAPSHOT_HEIGHT'])
+
+        # Refuse to use a database with an incompatible address format
+        if self._db_session:
+            check_schema_version(self._db_session)
         
+        # Address keys are only used by queries, balances are tracked by id
+        address_ids = Settings['ADDRESS_IDS']
+        if self._db_session and storage is None:
+            address_ids = self._stored_address_ids(address_ids)
+
+        # Storages keyed by address would store ids as addresses, and ids
+        # only kept in memory would be assigned again to other addresses
+        # after a restart, reading their stored balances.
+        if address_ids and storage is not None and \
+                not isinstance(storage, MemoryBalanceStorage):
+            if not getattr(storage, 'address_ids', False):
+                raise ValueError("ADDRESS_IDS requires a storage created with address_ids=True")
+            if not self._db_session:
+                raise ValueError("ADDRESS_IDS with a persistent storage requires a "
+                                 "db_session to store the address ids")
+
+        self._address_ids = None
+        if address_ids:
+            if self._db_session:
+                self._address_ids = SQLAddressDictionary(self._db_session,
+                        Settings['ADDRESS_ID_CACHE_SIZE'], 
+                        Settings['ADDRESS_ID_FILTER_FILE'])
+            else:
+                self._address_ids = MemoryAddressDictionary()
+
         # Initialize balance 
         if self._db_session:
-            self._storage = SQLBalanceStorage(Session)
+            self._storage = storage or self._default_storage(
+                    address_ids=self._address_ids is not None)
+            utxo_index = SQLUtxoIndex(self._db_session)
         else:
-            logger.info("No Database available, using memory storage")
-            self._storage = MemoryBalanceStorage()
-
-        self._balance_storage = BalanceProxyCache(self._storage, Settings['BALANCE_CACHE_SIZE'])
+            if storage is None:
+                logger.info("No Database available, using memory storage")
+            self._storage = storage or MemoryBalanceStorage()
+            utxo_index = MemoryUtxoIndex()
+
+        # Local index used to resolve block inputs without bitcoind -txindex
+        if not Settings['UTXO_INDEX']:
+            utxo_index = None
+
+        # Bootstrap an empty storage from a utxo set snapshot, the balances
+        # left by an interrupted import can't be used.
+        if self._storage.height == SNAPSHOT_IMPORT_HEIGHT:
+            raise StorageError("Interrupted utxo snapshot import, the balance "
+                               "storage must be deleted")
+
+        if Settings['UTXO_SNAPSHOT'] and self._storage.height == -1:
+            import_utxo_snapshot(Settings['UTXO_SNAPSHOT'], self._storage,
+                                 Settings['UTXO_SNAPSHOT_HEIGHT'], utxo_index,
+                                 address_ids=self._address_ids)
+
+        # SQLite allows a single writer, committing in the background to the
+        # database the sync thread writes utxos and address ids to would
+        # only make the sync wait for the commit.
+        background = Settings['BACKGROUND_COMMIT']
+        if background and (utxo_index is not None or self._address_ids is not None) \
+                and self._shares_database(self._storage):
+            logger.warning("Balances are stored in the sync database, BACKGROUND_COMMIT disabled")
+            background = False
+
+        # Memory storage reads are already cheap, and address dictionaries
+        # already filter unknown addresses.
+        self._address_filter = None
+        if Settings['ADDRESS_FILTER'] and self._address_ids is None and \
+                not isinstance(self._storage, MemoryBalanceStorage):
+            self._address_filter = AddressFilterStorage(self._storage, 
+                    Settings['ADDRESS_FILTER_FILE'],
+                    error_rate=Settings['ADDRESS_FILTER_ERROR_RATE'])
+            self._storage = self._address_filter
+
+        self._balance_storage = BalanceProxyCache(self._storage, 
+                                                  Settings['BALANCE_CACHE_SIZE'],
+                                                  background=background)
         
         # Load initial balance state from DB with the current height
+        fast_sync_distance = None
+        if Settings['FAST_SYNC']:
+            fast_sync_distance = max(Settings['FAST_SYNC_DISTANCE'], self._backtrack_limit)
         self._balance_processor = BalanceProcessor(backtrack_limit=self._backtrack_limit,
-                                                   storage=self._balance_storage)
+                                                   storage=self._balance_storage,
+                                                   fast_sync_distance=fast_sync_distance,
+                                                   address_ids=self._address_ids)
 
-        # Block cache
-        self._block_cache = BlockPrefetchingCache(self._balance_processor.height+1,
-                                                  self._bitcoind_url) 
+        # Pool of connections to bitcoind rpc shared by block prefetching and
+        # block building, they are initialized by reconnect code.
+        self._bitcoind_proxy = BitcoindProxyPool(self._bitcoind_url, 
+                                                 Settings['BITCOIND_POOL_SIZE'])
 
-        # Connection to bitcoind rpc, it's initialized by reconnect code.
-        self._bitcoind_proxy = BitcoindProxy(self._bitcoind_url)
+        # Block cache, created by the polling thread once the block files
+        # are imported.
+        self._block_cache = None
 
         # Hash and heigh for the last N blocks added to balance processor
         self._block_hash  = deque()
@@ -249,7 +493,11 @@ class BitcoinBalanceFacade(object):
         self._lock = threading.Lock()
 
         # 
-        self._block_factory = BlockFactory(self._bitcoind_proxy)
+        self._block_factory = BlockFactory(self._bitcoind_proxy, 
+                                           utxo_index=utxo_index)
+        
+        # Stored balance height the last time the utxo index was pruned
+        self._pruned_height = self._balance_storage.stored_height
 
         # Event to signal threads to stop
         self._stop_flag = threading.Event()
@@ -259,14 +507,69 @@ class BitcoinBalanceFacade(object):
                                              daemon=False)
         self._poll_thread.start()
 
+    def _stored_address_ids(self, address_ids):
+        """ADDRESS_IDS only applies to new databases, an existing database 
+        keeps the layout its balances were stored with. Otherwise the other
+        layout tables are empty, and the sync would start again from genesis
+        with the utxo index already pruned.
+
+        Arguments:
+            address_ids (bool): Layout requested by Settings['ADDRESS_IDS']
+
+        Returns:
+            (bool): True if balances must be stored by address id
+        """
+        stored_ids = self._default_storage(address_ids=True).height != -1
+        stored_keys = self._default_storage(address_ids=False).height != -1
+        if stored_ids and stored_keys:
+            raise StorageError("Database has balances stored both by address "
+                               "id and by address key")
+        
+        if stored_ids != address_ids and (stored_ids or stored_keys):
+            logger.warning("Database balances are stored by {}, ignoring "
+                           "ADDRESS_IDS".format("address id" if stored_ids else "address key"))
+            return stored_ids
+
+        return address_ids
+
+    def _default_storage(self, address_ids):
+        """Balance storage used when none is provided. Balances are stored 
+        in their own sqlite file Settings['BALANCE_DATABASE_FILE'] so they 
+        can be committed in the background, databases with the balances 
+        already stored in the sync database keep using it.
+
+        Arguments:
+            address_ids (bool): Store balances by address id
+        """
+        storage = SQLBalanceStorage(self._db_session, address_ids=address_ids)
+        if storage.height != -1 or not Settings['BALANCE_DATABASE_FILE']:
+            return storage
+
+        return SQLiteBalanceStorage(Settings['BALANCE_DATABASE_FILE'], 
+                                    address_ids=address_ids)
+
+    def _shares_database(self, storage):
+        """Return True if the balance storage writes to the db_session 
+        database file"""
+        if not self._db_session:
+            return False
+
+        database = getattr(storage, 'database', None)
+        return database is not None and database == database_file(self._db_session)
+
     @property
     def height(self):
         """Return height of top block if there isn't any loaded, used
         stored balance height"""
         return self._balance_processor.height
 
-    def _add_block(self, block):
-        """Add new block to tracked to update balance"""
+    def _add_block(self, block, tip=None):
+        """Add new block to tracked to update balance
+
+        Arguments:
+            block (Block):
+            tip (int|None): Blockchain top block height if known
+        """
         if len(self._block_hash) >= self._backtrack_limit:
             self._block_hash.popleft()
             self._block_height.popleft()
@@ -276,12 +579,26 @@ class BitcoinBalanceFacade(object):
             self._block_height.append(block.height)
 
             # Process record into balance
-            self._balance_processor.add_block(block)
+            self._balance_processor.add_block(block, tip)
+
+            # Blocks moved into storage by fast sync can't be backtracked, 
+            # only the last hash is kept to check the next block follows it.
+            while len(self._block_hash) > max(len(self._balance_processor), 1):
+                self._block_hash.popleft()
+                self._block_height.popleft()
+
+        # Blocks below stored balance height are never replayed, so the 
+        # outputs they spent can be dropped from the utxo index. Only once 
+        # the balance is written, background commits can still fail.
+        stored_height = self._balance_storage.stored_height
+        if stored_height != self._pruned_height:
+            self._pruned_height = stored_height
+            self._block_factory.prune(stored_height)
 
     def _backtrack(self):
         # TODO: Check there are block remainint
         with self._lock:
-            if not self._block_height:
+            if not len(self._balance_processor):
                 logger.error("Backtrack limit reached (height: {})".format(self.height))
                 raise BacktrackError("Backtrack limit reached")
             else:
@@ -293,20 +610,70 @@ class BitcoinBalanceFacade(object):
             # the complete cache each backtrack
             #self._block_factory.purge_cache()
             self._balance_processor.backtrack()
+            self._block_factory.backtrack(current_height)
             self._block_cache.set_height(current_height)
 
+    def _import_block_files(self):
+        """Add the blocks stored in bitcoind block files, on any error the 
+        import stops and the remaining blocks are requested to bitcoind"""
+        reader = BlockFileReader(self._blocks_dir)
+        try:
+            tip = reader.scan()
+            if tip <= self.height:
+                return
+
+            logger.info("Importing block files (height: {})".format(self.height))
+            blocks = reader.iter_blocks(self.height+1, 
+                    decode_processes=Settings['BLOCK_DECODE_PROCESSES'])
+            for height, rawblock in blocks:
+                if self._stop_flag.is_set():
+                    break
+
+                if self._block_hash and rawblock.hashPrevBlock != self._block_hash[-1]:
+                    logger.error("Block file chain doesn't match (height: {})".format(height))
+                    break
+
+                self._add_block(self._block_factory.build_block(rawblock, height), tip)
+
+                if height % 10000 == 0:
+                    logger.info("Block {}".format(height))
+        except Exception:
+            logger.exception("Error importing block files:")
+        finally:
+            reader.close()
+
     def _poll_thread_func(self):
         """Thread polling bitcoind looking for the next block"""
         last_update = time.perf_counter()
+
+        if self._blocks_dir:
+            self._import_block_files()
+            if self._stop_flag.is_set():
+                return
+
+        self._block_cache = BlockPrefetchingCache(self.height+1,
+                                                  self._bitcoind_proxy,
+                                                  workers=Settings['BLOCK_FETCH_WORKERS'],
+                                                  batch_size=Settings['BLOCK_FETCH_BATCH'],
+                                                  raw=Settings['RAW_BLOCKS'],
+                                                  decode_processes=Settings['BLOCK_DECODE_PROCESSES'])
         
         while True:
             if self._stop_flag.is_set():
                 self._block_cache.stop()
                 break
 
-            # Wait until the next block is available
-            height, cblock = self._block_cache.get_next_block()
-         
+            # Wait until the next block is available, a block that can't
+            # be decoded is requested again after a while.
+            try:
+                height, cblock = self._block_cache.get_next_block()
+            except Exception:
+                logger.exception("Unexpected exception getting block {}:".format(self.height+1))
+                if self._stop_flag.wait(timeout=Settings['BITCOIND_POLL_PERIOD']):
+                    return
+                self._block_cache.set_height(self.height+1)
+                continue
+
             # Before building a block check the block follows the current 
             # top block if not backtrack
             if self._block_hash and cblock.hashPrevBlock != self._block_hash[-1]:
@@ -329,25 +696,125 @@ class BitcoinBalanceFacade(object):
             if height % 10000 == 0:
                 logger.info("Block {}".format(height))
 
-            self._add_block(block)
+            # A failed update can leave the block partially added, the 
+            # synchronization is stopped instead of retrying it.
+            tip = self._block_cache.tip
+            try:
+                self._add_block(block, tip if tip >= 0 else None)
+            except Exception:
+                logger.exception("Error adding block {}, stopping synchronization:".format(height))
+                self._stop_flag.set()
+                self._block_cache.stop()
+                return
 
     def stop(self, block=False):
         """Safely stop and record state"""
         self._balance_processor.commit()
+        self._balance_storage.wait()
+        if self._address_filter is not None:
+            self._address_filter.save()
+        if self._address_ids is not None:
+            self._address_ids.save()
         self._stop_flag.set()
         self._bitcoind_proxy.stop()
         if block:
             self._poll_thread.join()
         logger.info("Closing")
 
+    def _balance_keys(self, addresses, cached_only=False):
+        """Keys used to track the balance of several addresses, the address
+        id or the address key.
+
+        Returns:
+            {address: key or None if the address never had a balance}, or
+                None if cached_only and the address dictionary must be read
+        """
+        keys = {address: address_to_key(address) for address in addresses}
+        if self._address_ids is None:
+            return keys
+
+        ids = self._address_ids.get_bulk(
+                set(key for key in keys.values() if key is not None), 
+                cached_only)
+        if ids is None:
+            return None
+
+        return {address: ids.get(key) for address, key in keys.items()}
+
     def get_balance(self, address):
-        """Get current bitcoin address balance"""
-        with self._lock:
-            return self._balance_processor.get_balance(address)
+        """Get current bitcoin address balance
+        
+        Arguments:
+            address (str): base58 or bech32 address
+        """
+        key = self._balance_keys([address])[address]
+        if key is None:
+            return 0
+
+        # Doesn't wait for block updates, BalanceProcessor reads are lock-free
+        return self._balance_processor.get_balance(key)
+
+    def get_cached_balance(self, address):
+        """Get bitcoin address balance if it's available without reading
+        storage, used by the server to answer from the event loop.
+
+        Arguments:
+            address (str): base58 or bech32 address
+
+        Returns:
+            (int|None): balance or None if it requires a storage read
+        """
+        keys = self._balance_keys([address], cached_only=True)
+        if keys is None:
+            return None
+        
+        key = keys[address]
+        if key is None:
+            return 0
+
+        return self._balance_processor.get_cached_balance(key)
+
+    def get_balances(self, addresses, cached_only=False):
+        """Get the balance of several addresses at the same height
+
+        Arguments:
+            addresses (iterable): base58 or bech32 addresses
+            cached_only (bool): Return None if storage must be read
+
+        Returns:
+            {address: balance, ...}
+        """
+        keys = self._balance_keys(list(addresses), cached_only)
+        if keys is None:
+            return None
+
+        balances = self._balance_processor.get_balances(
+                set(key for key in keys.values() if key is not None),
+                cached_only)
+        if balances is None:
+            return None
+
+        return {address: balances.get(key, 0) if key is not None else 0
+                for address, key in keys.items()}
+
+    def get_block_changes(self, address, confirmations=0):
+        """Get the unconfirmed balance changes of an address, the net change
+        in each block (not individual transactions)
+        
+        Arguments:
+            address (str): base58 or bech32 address
+            confirmations (int): Number of confirmations required for a block
+                to be considered confirmed
+
+        Returns:
+            [BlockChange(block_hash, value, height), ...] one for each 
+                unconfirmed block changing the address balance, newest first
+        """
+        key = self._balance_keys([address])[address]
+        if key is None:
+            return []
 
-    def get_transaction(self, address, confirmations=0):
-        #TODO
-        pass
+        return self._balance_processor.get_block_changes(key, confirmations)
 
     def __len__(self):
         return len(self._block_hash)
@@ -1,14 +1,33 @@
+import os
 from contextlib import contextmanager
-from sqlalchemy import Column, Integer, String, create_engine, event
+from sqlalchemy import (Column, Integer, BigInteger, String, LargeBinary, 
+        create_engine, event, func)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from sqlalchemy.engine import Engine
 
 from .settings import Settings
+from .exceptions import StorageError
+
+# Version of the stored data format, increased with incompatible changes:
+#   1: Addresses stored as base58 strings
+#   2: Addresses stored as compact keys (see address.script_to_key)
+SCHEMA_VERSION = 2
+
+# Max number of values in a single IN query, sqlite limits the number of 
+# bound variables in a statement (999 in older versions)
+QUERY_CHUNK_SIZE = 500
 
 Base = declarative_base()
 
+
+class SchemaVersion(Base):
+    __tablename__ = 'schema_version'
+    id =  Column(Integer, primary_key=True, autoincrement=True)
+    version = Column(Integer)
+
+
 class AddressBalance(Base):
     __tablename__ = 'address_balance'
     address = Column(String(32), primary_key=True, index=True)
@@ -21,6 +40,49 @@ class BlockHeight(Base):
     height =  Column(Integer)
 
 
+class AddressId(Base):
+    __tablename__ = 'address_id'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    address = Column(String(32), unique=True, index=True)
+
+
+class IdBalance(Base):
+    """Address balance by address id"""
+    __tablename__ = 'id_balance'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    balance = Column(Integer)
+
+
+class IdBlockHeight(Base):
+    __tablename__ = 'id_blocks'
+    id =  Column(Integer, primary_key=True, autoincrement=True)
+    height =  Column(Integer)
+
+
+class Utxo(Base):
+    __tablename__ = 'utxo'
+    txid = Column(LargeBinary(32), primary_key=True)
+    nout = Column(Integer, primary_key=True, autoincrement=False)
+    address = Column(String(32))
+    value = Column(BigInteger)
+    # Height of the block that created/spent the output
+    height = Column(Integer, index=True)
+    spent = Column(Integer, index=True, nullable=True)
+
+
+class UtxoHeight(Base):
+    __tablename__ = 'utxo_height'
+    id =  Column(Integer, primary_key=True, autoincrement=True)
+    height =  Column(Integer)
+
+
+class UtxoBlock(Base):
+    """Hashes of the utxo index blocks that can still be undone"""
+    __tablename__ = 'utxo_block'
+    height = Column(Integer, primary_key=True, autoincrement=False)
+    block_hash = Column(LargeBinary(32))
+
+
 
 
 @event.listens_for(Engine, 'connect')
@@ -30,21 +92,34 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor.execute('PRAGMA cache_size=10000')
     #cursor.execute('PRAGMA locking_mode=EXCLUSIVE')
     cursor.execute('PRAGMA temp_store=MEMORY')
-    cursor.execute('PRAGMA journal_mode=MEMORY') #TODO: NOT SAFE but faster
-    #cursor.execute('PRAGMA journal_mode=WAL')
+    # With WAL balance queries aren't blocked while the sync thread writes
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
     cursor.close()
 
-engine = create_engine('sqlite:///balance.db')
+# Default database, engine and Session are created on first access so
+# importing the models doesn't create the database file.
+DATABASE_URL = 'sqlite:///balance.db'
+
+
+def _create_default_database():
+    global engine, Session
+    engine = create_engine(DATABASE_URL)
 
+    Base.metadata.create_all(engine)
 
-Base.metadata.create_all(engine)
+    Session = scoped_session(sessionmaker(
+                    autocommit=False,
+                    autoflush=False,
+                    expire_on_commit=False,
+                    bind=engine))
 
 
-Session = scoped_session(sessionmaker(
-                autocommit=False,
-                autoflush=False,
-                expire_on_commit=False,
-                bind=engine))
+def __getattr__(name):
+    if name in ('engine', 'Session'):
+        _create_default_database()
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 @contextmanager
@@ -62,3 +137,43 @@ def make_session_scope(db_session):
         session.close()
 
 
+def database_file(db_session):
+    """Absolute path of the sqlite database file used by a session, None
+    for in-memory databases"""
+    path = db_session.get_bind().url.database
+    if not path or path == ':memory:':
+        return None
+    return os.path.abspath(path)
+
+
+def check_schema_version(db_session):
+    """Check the database stored data format is the current one, a new 
+    database is marked with the current version.
+
+    Databases without version are from before compact address keys, they
+    are only accepted if they don't have any address stored as a base58
+    string, otherwise balances would be silently read as 0. There is no
+    migration, those databases must be deleted and synchronized again.
+
+    Raises:
+        StorageError: The database uses an incompatible format
+    """
+    with make_session_scope(db_session) as session:
+        row = session.query(SchemaVersion.version)\
+                     .order_by(SchemaVersion.id.desc())\
+                     .first()
+        if row is not None:
+            if row[0] != SCHEMA_VERSION:
+                raise StorageError("Database schema version {} (expected {})"\
+                        .format(row[0], SCHEMA_VERSION))
+            return
+
+        for column in (AddressBalance.address, Utxo.address):
+            legacy = session.query(column)\
+                            .filter(func.typeof(column) == 'text')\
+                            .first()
+            if legacy is not None:
+                raise StorageError("Database has base58 addresses from an "
+                        "older version, it must be deleted and synchronized again")
+
+        session.add(SchemaVersion(version=SCHEMA_VERSION))
@@ -11,3 +11,7 @@ class BacktrackError(Exception):
 class ChainError(Exception):
     """The block is not in the current block chain"""
     pass
+
+class StorageError(Exception):
+    """Balance storage is inconsistent"""
+    pass
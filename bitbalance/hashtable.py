@@ -0,0 +1,328 @@
+"""
+hashtable
+
+Memory-mapped on-disk hash table with fixed width slots and linear probing,
+reads go directly to the mapped file so a table can be used right after
+opening it without loading its contents.
+
+Each batch of changes is committed atomically with an undo journal: the
+previous content of every modified slot is written and synced to the
+journal before the table is modified, and the journal is removed once the
+table is flushed. If the process dies in between, the journal is rolled
+back the next time the table is opened.
+
+File layout:
+    header: magic, version, key size, capacity, used slots, filled slots
+            (used + deleted), height
+    slots:  state (1 byte), key length (1 byte), key, value (int64)
+"""
+import hashlib
+import mmap
+import os
+import struct
+import zlib
+
+
+MAGIC = b'BBHT'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sIIQQQq')
+HEADER_SIZE = 64
+
+# Slot states
+SLOT_EMPTY = 0
+SLOT_USED = 1
+SLOT_DELETED = 2
+
+# Max ratio of filled slots before the table is resized
+MAX_LOAD = 0.7
+
+_int64 = struct.Struct('<q')
+_uint64 = struct.Struct('<Q')
+
+
+def _hash(key):
+    """Stable key hash (python hash() is randomized for bytes)"""
+    return _uint64.unpack(hashlib.blake2b(key, digest_size=8).digest())[0]
+
+
+class MmapHashTable(object):
+    """bytes -> int64 hash table stored in a memory-mapped file,
+    it isn't thread-safe"""
+
+    def __init__(self, path, key_size=34, capacity=1<<16):
+        """
+        Arguments:
+            path (str): Table file, created if it doesn't exist
+            key_size (int): Max key length (up to 255), ignored for
+                existing tables.
+            capacity (int): Initial number of slots (power of 2)
+        """
+        assert capacity & (capacity-1) == 0
+        assert 0 < key_size < 256
+        self._path = path
+        self._journal_path = path + '-journal'
+
+        if not os.path.exists(path):
+            self._create(path, key_size, capacity)
+
+        self._open()
+        self._recover()
+
+    @staticmethod
+    def _create(path, key_size, capacity, height=-1):
+        slot_size = 2 + key_size + 8
+        with open(path, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, key_size, capacity, 0, 0, height)
+                    .ljust(HEADER_SIZE, b'\x00'))
+            f.truncate(HEADER_SIZE + capacity*slot_size)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _open(self):
+        self._file = open(self._path, 'r+b')
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        self._load_header()
+
+    def _load_header(self):
+        magic, version, key_size, capacity, used, filled, height = \
+                _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} isn't a hash table file".format(self._path))
+
+        self._key_size = key_size
+        self._slot_size = 2 + key_size + 8
+        self._capacity = capacity
+        self._used = used
+        self._filled = filled
+        self._height = height
+
+    def _write_header(self):
+        _HEADER.pack_into(self._mm, 0, MAGIC, VERSION, self._key_size,
+                          self._capacity, self._used, self._filled, self._height)
+
+    def _recover(self):
+        """Roll back an interrupted commit"""
+        try:
+            with open(self._journal_path, 'rb') as f:
+                journal = f.read()
+        except FileNotFoundError:
+            return
+
+        data, checksum = journal[:-4], journal[-4:]
+        if len(journal) >= HEADER_SIZE+4 and \
+                zlib.crc32(data).to_bytes(4, 'little') == checksum:
+            # The table could have been partially modified
+            self._mm[:HEADER_SIZE] = data[:HEADER_SIZE]
+            record_size = 8 + self._slot_size
+            for pos in range(HEADER_SIZE, len(data), record_size):
+                idx = _uint64.unpack_from(data, pos)[0]
+                offset = HEADER_SIZE + idx*self._slot_size
+                self._mm[offset:offset+self._slot_size] = data[pos+8:pos+record_size]
+            self._mm.flush()
+            self._load_header()
+
+        # A journal without a valid checksum wasn't completely written,
+        # so the table wasn't modified.
+        os.remove(self._journal_path)
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def key_size(self):
+        return self._key_size
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        return self._used
+
+    def _find(self, key, changes=None):
+        """Find the slot for a key
+
+        Arguments:
+            key (bytes):
+            changes (dict): Slots modified but not yet written {idx: slot}
+
+        Returns:
+            (idx, found): Slot index with the key, or the first free slot in
+                the probe sequence if it wasn't found.
+        """
+        mm = self._mm
+        mask = self._capacity-1
+        slot_size = self._slot_size
+        key_len = len(key)
+        idx = _hash(key) & mask
+        free = None
+
+        while True:
+            if changes and idx in changes:
+                slot = changes[idx]
+                offset = 0
+            else:
+                slot = mm
+                offset = HEADER_SIZE + idx*slot_size
+
+            state = slot[offset]
+            if state == SLOT_EMPTY:
+                return (idx if free is None else free), False
+            elif state == SLOT_USED:
+                if slot[offset+1] == key_len and slot[offset+2:offset+2+key_len] == key:
+                    return idx, True
+            elif free is None:
+                free = idx
+
+            idx = (idx+1) & mask
+
+    def get(self, key, default=None):
+        """
+        Arguments:
+            key (bytes):
+
+        Returns:
+            (int): Key value or default if the key isn't in the table
+        """
+        mm = self._mm
+        mask = self._capacity-1
+        slot_size = self._slot_size
+        key_len = len(key)
+        value_offset = 2 + self._key_size
+        idx = _hash(key) & mask
+
+        while True:
+            offset = HEADER_SIZE + idx*slot_size
+            state = mm[offset]
+            if state == SLOT_EMPTY:
+                return default
+            elif state == SLOT_USED and mm[offset+1] == key_len and \
+                    mm[offset+2:offset+2+key_len] == key:
+                return _int64.unpack_from(mm, offset+value_offset)[0]
+            idx = (idx+1) & mask
+
+    def __contains__(self, key):
+        return self._find(key)[1]
+
+    def items(self):
+        """Iterate over all the (key, value) pairs"""
+        mm = self._mm
+        value_offset = 2 + self._key_size
+        for offset in range(HEADER_SIZE, len(mm), self._slot_size):
+            if mm[offset] == SLOT_USED:
+                key_len = mm[offset+1]
+                yield (mm[offset+2:offset+2+key_len],
+                       _int64.unpack_from(mm, offset+value_offset)[0])
+
+    def _pack_slot(self, key, value):
+        return (bytes((SLOT_USED, len(key))) + key.ljust(self._key_size, b'\x00')
+                + _int64.pack(value))
+
+    def _resize(self, capacity):
+        """Rebuild the table with a new capacity, deleted slots are dropped.
+        The new table is written to a temporary file and renamed, so it's
+        replaced atomically."""
+        tmp_path = self._path + '-resize'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        self._create(tmp_path, self._key_size, capacity, self._height)
+        table = MmapHashTable(tmp_path)
+        table.update(put=self.items(), height=self._height, journal=False)
+        table.close()
+
+        self.close()
+        os.replace(tmp_path, self._path)
+        self._open()
+
+    def update(self, put=None, delete=None, height=None, journal=True):
+        """Apply a batch of changes atomically
+
+        Arguments:
+            put (iterable): (key, value) pairs to insert or update
+            delete (iterable): keys to delete
+            height (int): New table height
+            journal (bool): Disable journal for tables nobody else can see
+        """
+        put = list(put or ())
+        delete = list(delete or ())
+
+        for key, _ in put:
+            if len(key) > self._key_size:
+                raise ValueError("Key longer than {} bytes".format(self._key_size))
+
+        # Grow so the table stays below max load after the inserts
+        if self._filled + len(put) > self._capacity*MAX_LOAD:
+            capacity = self._capacity
+            while self._used + len(put) > capacity*MAX_LOAD/2:
+                capacity *= 2
+            self._resize(capacity)
+
+        # Find the modified slots before writing anything
+        changes = {}
+        used = self._used
+        filled = self._filled
+
+        for key in delete:
+            idx, found = self._find(key, changes)
+            if found:
+                changes[idx] = bytes((SLOT_DELETED,)) + bytes(self._slot_size-1)
+                used -= 1
+
+        for key, value in put:
+            idx, found = self._find(key, changes)
+            if not found:
+                used += 1
+                state = changes[idx][0] if idx in changes else self._slot_state(idx)
+                if state == SLOT_EMPTY:
+                    filled += 1
+            changes[idx] = self._pack_slot(key, value)
+
+        if journal:
+            self._write_journal(changes)
+
+        # Apply changes
+        mm = self._mm
+        slot_size = self._slot_size
+        for idx, slot in changes.items():
+            offset = HEADER_SIZE + idx*slot_size
+            mm[offset:offset+slot_size] = slot
+
+        self._used = used
+        self._filled = filled
+        if height is not None:
+            self._height = height
+        self._write_header()
+        mm.flush()
+
+        if journal:
+            os.remove(self._journal_path)
+
+    def _slot_state(self, idx):
+        return self._mm[HEADER_SIZE + idx*self._slot_size]
+
+    def _write_journal(self, changes):
+        """Write and sync undo journal for the slots about to be modified"""
+        mm = self._mm
+        slot_size = self._slot_size
+        parts = [bytes(mm[:HEADER_SIZE])]
+        for idx in changes:
+            offset = HEADER_SIZE + idx*slot_size
+            parts.append(_uint64.pack(idx))
+            parts.append(mm[offset:offset+slot_size])
+
+        data = b''.join(parts)
+        with open(self._journal_path, 'wb') as f:
+            f.write(data)
+            f.write(zlib.crc32(data).to_bytes(4, 'little'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._file.close()
+        self._mm = None
+        self._file = None
@@ -0,0 +1,244 @@
+"""
+importer
+
+Read blocks directly from bitcoind blk*.dat files (or any directory of
+serialized block files) for the initial sync, bypassing the rpc interface.
+
+Each file is a sequence of records: network magic, block size (uint32 le)
+and the serialized block. Blocks are stored in the order they were
+downloaded, so the files are first scanned to index the block headers and
+the best chain is rebuilt following the previous-hash links from genesis.
+Since Bitcoin Core 28 block files may be obfuscated with the key stored in
+xor.dat.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import logging
+import os
+import re
+import struct
+
+import bitcoin
+
+from .rawblock import deserialize_block, sha256d
+
+
+logger = logging.getLogger("Bitcoin")
+
+_BLOCK_FILE_RE = re.compile(r'^blk(\d+)\.dat$')
+
+_unpack_uint32 = struct.Struct('<I').unpack
+
+NULL_HASH = b'\x00'*32
+
+
+def _xor(data, key, offset):
+    """Deobfuscate data read at offset with the xor.dat key"""
+    if not key:
+        return data
+
+    # Rotate the key so it is aligned with the data start
+    shift = offset % len(key)
+    key = key[shift:] + key[:shift]
+    size = len(data)
+    pad = key * (size // len(key) + 1)
+    value = int.from_bytes(data, 'little') ^ int.from_bytes(pad[:size], 'little')
+    return value.to_bytes(size, 'little')
+
+
+class BlockFileReader(object):
+    """Index and read blocks from a directory of blk*.dat files"""
+
+    def __init__(self, path, magic=None):
+        """
+        Arguments:
+            path (str): Directory with the block files
+            magic (bytes): Network magic, by default the one for the
+                selected bitcoin chain.
+        """
+        self._path = path
+        self._magic = magic or bitcoin.params.MESSAGE_START
+        self._files = self._block_files(path)
+
+        try:
+            with open(os.path.join(path, 'xor.dat'), 'rb') as f:
+                self._xor_key = f.read()
+        except FileNotFoundError:
+            self._xor_key = b''
+
+        if not any(self._xor_key):
+            self._xor_key = b''
+
+        # Block hash -> (prev hash, file number, offset, size)
+        self._index = {}
+
+        # Block hashes for the best chain, list position is the height
+        self._chain = []
+
+        # Open file cache
+        self._file_number = None
+        self._file = None
+
+    @staticmethod
+    def _block_files(path):
+        """Block file paths sorted by number"""
+        files = []
+        for name in os.listdir(path):
+            match = _BLOCK_FILE_RE.match(name)
+            if match:
+                files.append((int(match.group(1)), os.path.join(path, name)))
+        return [p for _, p in sorted(files)]
+
+    def __len__(self):
+        """Number of blocks in the best chain"""
+        return len(self._chain)
+
+    @property
+    def height(self):
+        """Best chain height, -1 if there are no blocks"""
+        return len(self._chain)-1
+
+    def _read(self, file_number, offset, size):
+        if self._file_number != file_number:
+            self.close()
+            self._file = open(self._files[file_number], 'rb')
+            self._file_number = file_number
+
+        self._file.seek(offset)
+        data = self._file.read(size)
+        if len(data) != size:
+            raise EOFError("Truncated block file {}".format(self._files[file_number]))
+        return _xor(data, self._xor_key, offset)
+
+    def _scan_file(self, file_number):
+        """Index the block headers in a file"""
+        file_size = os.path.getsize(self._files[file_number])
+        offset = 0
+
+        while offset + 88 <= file_size:
+            record = self._read(file_number, offset, 88)
+
+            # Files are preallocated, the unused space is zeroed
+            if record[:4] != self._magic:
+                break
+
+            size = _unpack_uint32(record[4:8])[0]
+            if offset + 8 + size > file_size:
+                # Partially written block
+                break
+
+            header = record[8:]
+            self._index[sha256d(header)] = (header[4:36], file_number, offset+8, size)
+            offset += 8 + size
+
+    def _build_chain(self):
+        """Find the longest chain starting at genesis"""
+        children = {}
+        for block_hash, (prev_hash, _, _, _) in self._index.items():
+            children.setdefault(prev_hash, []).append(block_hash)
+
+        # Breadth-first walk from genesis, the last block visited has the
+        # greatest height.
+        parent = {}
+        tip = None
+        level = children.get(NULL_HASH, [])
+        while level:
+            tip = level[0]
+            next_level = []
+            for block_hash in level:
+                for child in children.get(block_hash, ()):
+                    parent[child] = block_hash
+                    next_level.append(child)
+            level = next_level
+
+        chain = []
+        while tip is not None:
+            chain.append(tip)
+            tip = parent.get(tip)
+        chain.reverse()
+        return chain
+
+    def scan(self):
+        """Index all the block files and build the best chain
+
+        Returns:
+            (int): Best chain height
+        """
+        self._index = {}
+        for file_number in range(len(self._files)):
+            self._scan_file(file_number)
+
+        self._chain = self._build_chain()
+        logger.info("Indexed {} block files (height: {})".format(len(self._files),
+                                                                 self.height))
+        return self.height
+
+    def block_hash(self, height):
+        return self._chain[height]
+
+    def read_block(self, height):
+        """
+        Arguments:
+            height (int): Best chain block height
+
+        Returns:
+            (bytes): Serialized block
+        """
+        _, file_number, offset, size = self._index[self._chain[height]]
+        return self._read(file_number, offset, size)
+
+    def read_blocks(self, start_height=0, stop_height=None):
+        """Serialized best chain blocks in height order
+
+        Arguments:
+            start_height (int): First block height
+            stop_height (int): Last block height (included)
+
+        Returns:
+            iterator: (height, bytes)
+        """
+        if stop_height is None:
+            stop_height = self.height
+
+        for height in range(start_height, stop_height+1):
+            yield height, self.read_block(height)
+
+    def iter_blocks(self, start_height=0, stop_height=None, decode_processes=0):
+        """Decoded best chain blocks in height order
+
+        Arguments:
+            start_height (int): First block height
+            stop_height (int): Last block height (included)
+            decode_processes (int|None): Number of decoding processes, None
+                for one per CPU and 0 to decode them in this process.
+
+        Returns:
+            iterator: (height, RawBlock)
+        """
+        blocks = self.read_blocks(start_height, stop_height)
+        if decode_processes == 0:
+            for height, data in blocks:
+                yield height, deserialize_block(data)
+            return
+
+        with ProcessPoolExecutor(decode_processes,
+                mp_context=multiprocessing.get_context('spawn')) as executor:
+            # Bounded number of blocks being decoded
+            max_pending = executor._max_workers*4
+            pending = deque()
+            for height, data in blocks:
+                pending.append((height, executor.submit(deserialize_block, data)))
+                if len(pending) >= max_pending:
+                    height, future = pending.popleft()
+                    yield height, future.result()
+
+            while pending:
+                height, future = pending.popleft()
+                yield height, future.result()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+        self._file_number = None
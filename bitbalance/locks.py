@@ -0,0 +1,70 @@
+"""
+locks
+
+Synchronization primitives for structures read much more often than they
+are written.
+"""
+import threading
+import time
+
+
+class SeqLock(object):
+    """Sequence lock, writers are serialized by a mutex and increment a
+    sequence number before and after modifying the protected data. Readers
+    don't take any lock, they read the data and retry if the sequence
+    number changed or was odd (a write was in progress).
+
+    Readers must only do operations that are safe while the data is being
+    modified (single dict lookups, attribute reads, ...), with CPython the
+    GIL makes them atomic.
+
+    Usage:
+        with seqlock:
+            # modify data
+
+        while True:
+            seq = seqlock.read_begin()
+            # read data
+            if not seqlock.read_retry(seq):
+                break
+    """
+
+    def __init__(self):
+        self._seq = 0
+        self._mutex = threading.Lock()
+
+    @property
+    def sequence(self):
+        return self._seq
+
+    def __enter__(self):
+        self._mutex.acquire()
+        self._seq += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._seq += 1
+        self._mutex.release()
+
+    def read_begin(self):
+        """Start read, waits while there is a write in progress
+
+        Returns:
+            (int): sequence number for read_retry
+        """
+        seq = self._seq
+        while seq & 1:
+            # Yield to the writer
+            time.sleep(0)
+            seq = self._seq
+        return seq
+
+    def read_retry(self, seq):
+        """
+        Arguments:
+            seq (int): read_begin sequence number
+
+        Returns:
+            (bool): True if the data was modified and must be read again
+        """
+        return self._seq != seq
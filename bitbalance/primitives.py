@@ -1,11 +1,12 @@
-from collections import OrderedDict
+from array import array
 
 
 from bitcoin.core import str_money_value, b2lx, b2x, x
-from bitcoin.wallet import CBitcoinAddress, CBitcoinAddressError
 from bitcoin.rpc import unhexlify, hexlify
 from bitcoin.core import COutPoint
 
+from .address import script_to_key, key_to_address
+from .rawblock import RawBlock
 from .exceptions import ChainError, BacktrackError
 
 COINBASE_TX = b'\x00'*32
@@ -30,7 +31,7 @@ class TxOut(object):
         Arguments:
             tx (string): Transaction hash
             nout (int): Transaction output number
-            addr (string):
+            addr (bytes): Address key (see address.script_to_key)
             value (int): Output value
         """
         self.tx = tx
@@ -40,13 +41,15 @@ class TxOut(object):
 
     @staticmethod
     def addr_from_script(script):
-        """Generate output addres from scriptPubKey"""
-        try:
-            addr = str(CBitcoinAddress.from_scriptPubKey(script))
-        except CBitcoinAddressError:
-            addr = None
-      
-        return addr
+        """Generate output address key from scriptPubKey"""
+        return script_to_key(script)
+
+    @property
+    def address(self):
+        """Human-readable output address"""
+        if self.addr is None:
+            return None
+        return key_to_address(self.addr)
 
     @classmethod
     def from_tx(cls, tx, nout):
@@ -62,8 +65,6 @@ class TxOut(object):
             Inialized TxOut
 
         Exceptions:
-            CBitcoinAddressError: Couldn't convert transaction output scriptPubKey 
-                to address
             IndexError: The requested output doesn't exist
         """
         # GetTxid instead of GetHash for segwit support (bip-0141)
@@ -91,7 +92,7 @@ class TxOut(object):
         return "TxOut({}, {}, {}, {})".format(
                     b2x(self.tx), 
                     self.nout, 
-                    self.addr, 
+                    self.address, 
                     str_money_value(self.value))
 
 
@@ -147,54 +148,265 @@ class Block(object):
         return input_value == output_value
 
 
+# Outpoint key length, 32 bytes txid + 4 bytes output number
+OUTPOINT_KEY_SIZE = 36
+
+def outpoint_key(txhash, nout):
+    """Fixed width outpoint key (36 bytes), txid followed by the output 
+    number as little-endian uint32"""
+    return txhash + nout.to_bytes(4, 'little')
+
+
 class TxOutCache(object):
+    """
+    Cache for transaction outputs, to keep memory usage low outputs aren't 
+    stored as python objects. A dict maps the 36 bytes outpoint keys to an 
+    entry, the address ids and values are stored in parallel arrays and the 
+    entries linked in insertion order, so the oldest are discarded first 
+    when the cache is full.
+    """
     
-    def __init__(self, proxy, size=500000):
+    def __init__(self, proxy, size=500000, utxo_index=None):
         """
         Arguments:
             size (int): max cache size
             proxy (proxy.BitcoindProxy)
+            utxo_index (utxo.MemoryUtxoIndex|utxo.SQLUtxoIndex|None): Local
+                output index checked before querying bitcoind
         """
         self._proxy = proxy
         self._max_size = size
-
-        self._txout_cache = OrderedDict()
+        self._utxo_index = utxo_index
+        
+        self._init_entries()
 
         self._cache_miss = 0
         self._cache_hit = 0
 
+    def _init_entries(self):
+        """Create empty entry arrays, index and address table"""
+        # Outpoint key -> entry
+        self._index = {}
+        
+        # Entry columns, _keys[n] is None for free entries
+        self._keys = []
+        self._addr_ids = array('I')
+        self._values = array('Q')
+        
+        # Doubly linked list in insertion order, _next also links the 
+        # free list with the entries deleted.
+        self._prev = array('i')
+        self._next = array('i')
+        self._head = -1
+        self._tail = -1
+        self._free = -1
+        
+        # Address table, id 0 is reserved for outputs without address. Ids
+        # are reference counted and reused once no cached output uses them.
+        self._addresses = [None]
+        self._address_ids = {}
+        self._address_refs = array('I', [0])
+        self._free_address_ids = []
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, outpoint):
+        """
+        Arguments:
+            outpoint (tuple): (txhash, nout)
+        """
+        return outpoint_key(*outpoint) in self._index
+
+    def _address_id(self, addr):
+        """Return the address id adding a reference to it, a new id is 
+        assigned if the address is unknown"""
+        if addr is None:
+            return 0
+
+        addr_id = self._address_ids.get(addr)
+        if addr_id is None:
+            if self._free_address_ids:
+                addr_id = self._free_address_ids.pop()
+                self._addresses[addr_id] = addr
+            else:
+                addr_id = len(self._addresses)
+                self._addresses.append(addr)
+                self._address_refs.append(0)
+            self._address_ids[addr] = addr_id
+        
+        self._address_refs[addr_id] += 1
+        return addr_id
+
+    def _release_address(self, addr_id):
+        """Remove a reference to the address id, and free it when it's no 
+        longer used by any cached output"""
+        if not addr_id:
+            return
+
+        self._address_refs[addr_id] -= 1
+        if not self._address_refs[addr_id]:
+            del self._address_ids[self._addresses[addr_id]]
+            self._addresses[addr_id] = None
+            self._free_address_ids.append(addr_id)
+
+    def _remove(self, entry):
+        """Remove entry from the index and insertion order list, and add it
+        to the free list"""
+        del self._index[self._keys[entry]]
+        self._keys[entry] = None
+        self._release_address(self._addr_ids[entry])
+        
+        prev, nxt = self._prev[entry], self._next[entry]
+        if prev >= 0:
+            self._next[prev] = nxt
+        else:
+            self._head = nxt
+        if nxt >= 0:
+            self._prev[nxt] = prev
+        else:
+            self._tail = prev
+
+        self._next[entry] = self._free
+        self._free = entry
+
+    def _add(self, txhash, nout, addr, value):
+        """Add output to cache"""
+        key = outpoint_key(txhash, nout)
+        
+        entry = self._index.get(key)
+        if entry is not None:
+            addr_id = self._address_id(addr)
+            self._release_address(self._addr_ids[entry])
+            self._addr_ids[entry] = addr_id
+            self._values[entry] = value
+            return
+
+        if len(self._index) >= self._max_size:
+            if not self._max_size:
+                return
+            while len(self._index) >= self._max_size:
+                self._remove(self._head)
+
+        addr_id = self._address_id(addr)
+        
+        if self._free >= 0:
+            entry = self._free
+            self._free = self._next[entry]
+            self._keys[entry] = key
+            self._addr_ids[entry] = addr_id
+            self._values[entry] = value
+        else:
+            entry = len(self._values)
+            self._keys.append(key)
+            self._addr_ids.append(addr_id)
+            self._values.append(value)
+            self._prev.append(-1)
+            self._next.append(-1)
+
+        # Append to insertion order list
+        self._prev[entry] = self._tail
+        self._next[entry] = -1
+        if self._tail >= 0:
+            self._next[self._tail] = entry
+        else:
+            self._head = entry
+        self._tail = entry
+
+        self._index[key] = entry
+
     def del_txout(self, txout):
         """Remove txout from cache"""
-        self._txout_cache.pop(txout, None)
+        entry = self._index.get(outpoint_key(txout.tx, txout.nout))
+        if entry is not None:
+            self._remove(entry)
     
     def add_txout(self, txout):
         """Add TxOut to cache"""
-        if len(self._txout_cache)>=self._max_size:
-            self._txout_cache.popitem(last=False)
-        
-        self._txout_cache[txout] = txout
+        self._add(txout.tx, txout.nout, txout.addr, txout.value)
 
     def purge_cache(self):
         """Purge complete cache"""
-        self._txout_cache = OrderedDict()
+        self._init_entries()
+
+    def _add_transaction(self, txhash, tx):
+        """Add all transaction outputs to cache"""
+        # Manually initilize TxOut so there is no need to generate the transaction
+        # hash a second time. (faster than:txout = TxOut.from_tx(rawtx, nout))
+        for out, cout in enumerate(tx.vout):
+            addr = TxOut.addr_from_script(cout.scriptPubKey)
+            self._add(txhash, out, addr, cout.nValue)
+
+    def _load_from_index(self, outpoints):
+        """Load outpoints from the utxo index into cache
+        
+        Returns:
+            List with the outpoints not found
+        """
+        if self._utxo_index is None or not outpoints:
+            return outpoints
+
+        found = self._utxo_index.get_bulk(outpoints)
+        for (txhash, nout), (addr, value) in found.items():
+            self._add(txhash, nout, addr, value)
+
+        return [op for op in outpoints if op not in found]
+
+    def prefetch(self, outpoints):
+        """
+        Load into the cache the outputs for all the outpoints not already
+        cached, first from the utxo index and then the missing transactions
+        are requested to bitcoind using batch requests.
+
+        Arguments:
+            outpoints (iterable): (txhash, nout) tuples
+        """
+        uncached = [(txhash, nout) for txhash, nout in outpoints 
+                    if outpoint_key(txhash, nout) not in self._index]
+        
+        missing = []
+        missing_set = set()
+
+        for txhash, nout in self._load_from_index(uncached):
+            if txhash not in missing_set:
+                missing.append(txhash)
+                missing_set.add(txhash)
+
+        if not missing:
+            return
+
+        with self._proxy as proxy:
+            try:
+                txs = proxy.get_transactions(missing)
+            except ConnectionError:
+                raise
+            except Exception:
+                raise ChainError("Unknown Txout in {}".format(missing))
+
+        for txhash, tx in zip(missing, txs):
+            self._add_transaction(txhash, tx)
 
     def get_txout(self, txhash, nout):
         """
         Get TxOut from cache or if not available query bitcoind_proxy
         
         Arguments:
-            txhash (str): Transactions hash
+            txhash (bytes): Transactions hash
             nout (int): Output number
         """
-        try:
-            txout = self._txout_cache[TxOut(txhash, nout)]
+        entry = self._index.get(outpoint_key(txhash, nout))
+        if entry is not None:
             self._cache_hit += 1
-            return txout
-        except KeyError:
-            pass
+            return TxOut(txhash, nout, 
+                         self._addresses[self._addr_ids[entry]], 
+                         self._values[entry])
 
         self._cache_miss += 1
 
+        if not self._load_from_index([(txhash, nout)]):
+            self._cache_hit -= 1 # Fix hit/miss counter
+            return self.get_txout(txhash, nout)
+
         with self._proxy as proxy: 
             try:
                 tx = proxy.get_transaction(txhash)
@@ -203,11 +415,7 @@ class TxOutCache(object):
             except Exception:
                 raise ChainError("Unknown Txout {} {}".format(txhash, nout))
  
-        # Manually initilize TxOut so there is no need to generate the transaction
-        # hash a second time. (faster than:txout = TxOut.from_tx(rawtx, nout))
-        for out, cout in enumerate(tx.vout):
-            addr = TxOut.addr_from_script(cout.scriptPubKey)
-            self.add_txout(TxOut(txhash, out, addr, value=cout.nValue))
+        self._add_transaction(txhash, tx)
 
         # Now txout must be in cache
         self._cache_hit -= 1 # Fix hit/miss counter
@@ -216,95 +424,97 @@ class TxOutCache(object):
 
 class BlockFactory(object):
 
-    def __init__(self, proxy, size=1000000):
+    def __init__(self, proxy, size=1000000, utxo_index=None):
         """
         Arguments:
             size (int): max cache size
             proxy (proxy.BitcoindProxy)
+            utxo_index (utxo.MemoryUtxoIndex|utxo.SQLUtxoIndex|None): Local
+                output index updated with each built block
         """
         self._proxy = proxy
         self._max_size = size
+        self._utxo_index = utxo_index
        
-        self._cache = TxOutCache(proxy, size)
+        self._cache = TxOutCache(proxy, size, utxo_index)
 
     def purge_cache(self):
         """Completely purge cache"""
         self._cache.purge()
 
-    def _transaction_inputs(self, tx):
-        """Generate transaction inputs from source transaction outputs""" 
-        inputs = []
-        txhash = tx.GetTxid()
-       
-        for vin in tx.vin:
-            txin = vin.prevout
-            
-            if txin.hash == COINBASE_TX:
-                continue
-
-            txout = self._cache.get_txout(txin.hash, txin.n)
-            if txout is None:
-                logger.error("Unable to find TxOut {} {}".format(
-                        txin_hash, txin_n))
-            else:
-                inputs.append(txout)
-
-        return inputs
-
-    def _transaction_outputs(self, tx):
-        """Generate transaction TxOut""" 
-        outputs = []
+    def backtrack(self, height):
+        """Remove the block at height from the utxo index"""
+        if self._utxo_index is not None:
+            self._utxo_index.undo(height)
 
-        # GetTxid instead of GetHash for segwit support (bip-0141)
-        txhash = tx.GetTxid()
+    def prune(self, height):
+        """Remove from the utxo index the outputs spent up to height,
+        blocks below it won't be built again"""
+        if self._utxo_index is not None:
+            self._utxo_index.prune(height)
 
-        for n, utxo in enumerate(tx.vout):  
-            
-            addr = TxOut.addr_from_script(utxo.scriptPubKey)
-            out = TxOut(txhash, n, addr, value=utxo.nValue)
-            outputs.append(out)
+    @staticmethod
+    def _transactions(block):
+        """Iterate block transactions as (txid, prevouts, outputs) tuples"""
+        if isinstance(block, RawBlock):
+            return block.vtx
+
+        # GetTxid instead of GetHash for segwit support (bip-0141), it
+        # doesn't cache the result so it is only called once.
+        return ((tx.GetTxid(),
+                 [(vin.prevout.hash, vin.prevout.n) for vin in tx.vin],
+                 [(TxOut.addr_from_script(cout.scriptPubKey), cout.nValue) 
+                    for cout in tx.vout]) for tx in block.vtx)
 
-        return outputs
+    def build_block(self, block, height=None):
+        """Build Block from bitcoin.CBlock or rawblock.RawBlock
+        
+        The block transactions are processed in a single pass, hashing each 
+        one once. Inputs spending outputs from the same block are resolved
+        during the pass, the rest are requested to the cache afterwards.
+        """
+        blockhash = block.GetHash()
+        
+        inputs = []
+        outputs = []
 
-    def _block_outputs(self, block):
-        """Generate the TxOut for all the block outputs"""
-        block_txouts = []
+        # Outputs created in this block not yet spent {(txhash, nout): TxOut}
+        block_txouts = {}
 
-        for tx in block.vtx:
-            block_txouts.extend(self._transaction_outputs(tx))
-            
-        return block_txouts
+        # Inputs from previous blocks [(position in inputs, txhash, nout), ...]
+        pending = []
 
-    def _block_inputs(self, block):
-        """Generate the TxOut for all the block inputs"""
-        block_inputs = []
+        for txhash, prevouts, txouts in self._transactions(block):
+            # A transaction can only spend outputs from previous transactions
+            for prevout in prevouts:
+                if prevout[0] == COINBASE_TX:
+                    continue
 
-        for tx in block.vtx:
-            block_inputs.extend(self._transaction_inputs(tx))
+                txout = block_txouts.pop(prevout, None)
+                if txout is None:
+                    pending.append((len(inputs), prevout[0], prevout[1]))
+                inputs.append(txout)
 
-        return block_inputs
+            for n, (addr, value) in enumerate(txouts):
+                txout = TxOut(txhash, n, addr, value=value)
+                outputs.append(txout)
+                block_txouts[(txhash, n)] = txout
 
-    def build_block(self, block, height=None):
-        """Build Block from bitcoin.CBlock"""
-        blockhash = block.GetHash()
+        # Request all the missing input transactions in batches, instead of 
+        # one request per input.
+        self._cache.prefetch((txhash, nout) for _, txhash, nout in pending)
         
-        
-        outputs = self._block_outputs(block)
-        
-        # Add outputs to cache, because the outputs from a transaction
-        # can be used as inputs for other transactions in the same block
-        for txout in outputs:
+        for pos, txhash, nout in pending:
+            inputs[pos] = self._cache.get_txout(txhash, nout)
+
+        # Add outputs not spent in this block to cache, for the next blocks
+        for txout in block_txouts.values():
             if txout.value > 0:
                 self._cache.add_txout(txout)
 
-        # Generate inputs 
-        inputs = self._block_inputs(block)
-        #TODO: Remove outputs added to cache if input generations fails???
-
-
-        # With the complete block remove used inputs from cache to save space
-        #for txout in inputs:
-        #    self._cache.del_txout(txout)
-
         block = Block(blockhash, height, inputs, outputs)
+        
+        if self._utxo_index is not None:
+            self._utxo_index.add_block(block)
+
         return block
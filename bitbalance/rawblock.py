@@ -0,0 +1,150 @@
+"""
+rawblock
+
+Lightweight deserializer for raw serialized blocks (getblock verbosity 0).
+It works over a memoryview of the block and only extracts the data needed
+to build a primitives.Block: txids, prevouts, output addresses and values,
+without creating python-bitcoinlib's full object graph.
+"""
+import hashlib
+import struct
+
+from .address import script_to_key
+
+
+_unpack_uint32 = struct.Struct('<I').unpack_from
+_unpack_int64 = struct.Struct('<q').unpack_from
+_unpack_uint16 = struct.Struct('<H').unpack_from
+_unpack_uint64 = struct.Struct('<Q').unpack_from
+
+
+class RawBlock(object):
+    """Decoded block, a CBlock replacement for BlockFactory.build_block"""
+
+    __slots__ = ('block_hash', 'hashPrevBlock', 'vtx')
+
+    def __init__(self, block_hash, prev_hash, vtx):
+        """
+        Arguments:
+            block_hash (bytes): Block hash
+            prev_hash (bytes): Previous block hash
+            vtx (list): Transactions (txid, prevouts, outputs) tuples
+                txid (bytes)
+                prevouts (list): [(txhash, nout), ...]
+                outputs (list): [(address_key, value), ...]
+        """
+        self.block_hash = block_hash
+        self.hashPrevBlock = prev_hash
+        self.vtx = vtx
+
+    def GetHash(self):
+        return self.block_hash
+
+    def __repr__(self):
+        return "{}({}, {} txs)".format(self.__class__.__name__,
+                                       self.block_hash,
+                                       len(self.vtx))
+
+
+def sha256d(*parts):
+    """Double sha256 of the concatenated parts"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part)
+    return hashlib.sha256(h.digest()).digest()
+
+
+def read_varint(view, pos):
+    """Read bitcoin CompactSize integer
+
+    Returns:
+        (value, next position)
+    """
+    size = view[pos]
+    if size < 0xfd:
+        return size, pos+1
+    elif size == 0xfd:
+        return _unpack_uint16(view, pos+1)[0], pos+3
+    elif size == 0xfe:
+        return _unpack_uint32(view, pos+1)[0], pos+5
+    else:
+        return _unpack_uint64(view, pos+1)[0], pos+9
+
+
+def deserialize_transaction(view, pos):
+    """
+    Decode the transaction starting at pos
+
+    Arguments:
+        view (memoryview): serialized data
+        pos (int): transaction start
+
+    Returns:
+        ((txid, prevouts, outputs), next position)
+    """
+    start = pos
+    pos += 4 # nVersion
+
+    # bip-0144 marker and flag
+    segwit = view[pos] == 0 and view[pos+1] != 0
+    if segwit:
+        pos += 2
+    body_start = pos
+
+    nin, pos = read_varint(view, pos)
+    prevouts = []
+    for _ in range(nin):
+        prevouts.append((bytes(view[pos:pos+32]), _unpack_uint32(view, pos+32)[0]))
+        script_len, pos = read_varint(view, pos+36)
+        pos += script_len + 4 # scriptSig + nSequence
+
+    nout, pos = read_varint(view, pos)
+    outputs = []
+    for _ in range(nout):
+        value = _unpack_int64(view, pos)[0]
+        script_len, pos = read_varint(view, pos+8)
+        outputs.append((script_to_key(view[pos:pos+script_len]), value))
+        pos += script_len
+
+    body_end = pos
+
+    if segwit:
+        for _ in range(nin):
+            nitems, pos = read_varint(view, pos)
+            for _ in range(nitems):
+                item_len, pos = read_varint(view, pos)
+                pos += item_len
+
+    pos += 4 # nLockTime
+
+    # The txid doesn't include the witness data
+    if segwit:
+        txid = sha256d(view[start:start+4], view[body_start:body_end], view[pos-4:pos])
+    else:
+        txid = sha256d(view[start:pos])
+
+    return (txid, prevouts, outputs), pos
+
+
+def deserialize_block(data):
+    """
+    Decode serialized block
+
+    Arguments:
+        data (bytes): serialized block
+
+    Returns:
+        RawBlock
+    """
+    view = memoryview(data)
+
+    block_hash = sha256d(view[:80])
+    prev_hash = bytes(view[4:36])
+
+    ntx, pos = read_varint(view, 80)
+    vtx = []
+    for _ in range(ntx):
+        tx, pos = deserialize_transaction(view, pos)
+        vtx.append(tx)
+
+    return RawBlock(block_hash, prev_hash, vtx)
@@ -0,0 +1,263 @@
+"""
+server
+
+asyncio HTTP/JSON balance query server on top of BitcoinBalanceFacade.
+
+    GET  /balance/<address>  -> {"address": address, "balance": satoshis}
+    POST /balances           -> {"balances": {address: satoshis, ...}}
+         body: ["address1", "address2", ...]
+    GET  /height             -> {"height": height}
+
+Invalid addresses, or addresses of another network, are answered with 
+400 (listing all the invalid ones for /balances). Connections are kept 
+alive and pipelined requests are answered in order.
+Balances available in memory are answered from the event loop, only the
+ones requiring a storage read are run in a worker thread.
+"""
+import asyncio
+import json
+import logging
+from urllib.parse import unquote
+
+from .address import address_to_key
+from .settings import Settings
+
+
+logger = logging.getLogger("Server")
+
+SERVER_HOST = Settings.get('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = Settings.get('SERVER_PORT', 8080)
+
+# Max number of addresses in a single /balances request
+SERVER_MAX_BATCH = Settings.get('SERVER_MAX_BATCH', 1000)
+
+# Max request header and body sizes
+MAX_HEADER_SIZE = 16*1024
+MAX_BODY_SIZE = 1024*1024
+
+HTTP_STATUS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def http_response(status, body, keep_alive=True):
+    """Serialize JSON response"""
+    data = json.dumps(body, separators=(',', ':')).encode('utf-8')
+    head = ('HTTP/1.1 {} {}\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: {}\r\n'
+            '{}\r\n').format(status, HTTP_STATUS[status], len(data),
+                             '' if keep_alive else 'Connection: close\r\n')
+    return head.encode('latin-1') + data
+
+
+class BalanceServer(object):
+    """HTTP server answering balance queries"""
+
+    def __init__(self, facade, host=SERVER_HOST, port=SERVER_PORT,
+                 executor=None):
+        """
+        Arguments:
+            facade (BitcoinBalanceFacade):
+            host (str): Listening address
+            port (int): Listening port, 0 for any free port
+            executor (Executor): Runs queries that read storage, by default
+                the event loop default executor.
+        """
+        self._facade = facade
+        self._host = host
+        self._port = port
+        self._executor = executor
+        self._server = None
+
+    @property
+    def port(self):
+        """Listening port"""
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection,
+                                                  self._host, self._port,
+                                                  limit=MAX_HEADER_SIZE)
+        logger.info("Listening on {}:{}".format(self._host, self.port))
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+
+    async def wait_closed(self):
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    async def _read_request(self, reader):
+        """
+        Returns:
+            (method, path, headers, body) or None if the connection was
+                closed.
+        """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise HTTPError(431, "Request header too large")
+
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ')
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+        headers[':version'] = version
+
+        # Only Content-Length bodies are supported, a chunked body left in
+        # the stream would be read as the next request.
+        if 'transfer-encoding' in headers:
+            raise HTTPError(501, "Transfer-Encoding not supported")
+
+        body = b''
+        length = headers.get('content-length')
+        if length:
+            try:
+                length = int(length)
+            except ValueError:
+                raise HTTPError(400, "Invalid Content-Length")
+            if length > MAX_BODY_SIZE:
+                raise HTTPError(413, "Request body too large")
+            try:
+                body = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                return None
+
+        return method, target, headers, body
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _get_balance(self, address):
+        if address_to_key(address) is None:
+            raise HTTPError(400, "Invalid address: {}".format(address))
+
+        balance = self._facade.get_cached_balance(address)
+        if balance is None:
+            balance = await self._run(self._facade.get_balance, address)
+        return {'address': address, 'balance': balance}
+
+    async def _get_balances(self, body):
+        try:
+            addresses = json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise HTTPError(400, "Invalid JSON body")
+
+        if not isinstance(addresses, list) or \
+                not all(isinstance(addr, str) for addr in addresses):
+            raise HTTPError(400, "Body must be a list of addresses")
+        if len(addresses) > SERVER_MAX_BATCH:
+            raise HTTPError(400, "Max {} addresses per request".format(SERVER_MAX_BATCH))
+
+        invalid = [addr for addr in addresses if address_to_key(addr) is None]
+        if invalid:
+            raise HTTPError(400, "Invalid addresses: {}".format(', '.join(invalid)))
+
+        balances = self._facade.get_balances(addresses, cached_only=True)
+        if balances is None:
+            balances = await self._run(self._facade.get_balances, addresses)
+        return {'balances': balances}
+
+    async def _dispatch(self, method, target, body):
+        path = target.split('?', 1)[0]
+
+        if path.startswith('/balance/'):
+            if method != 'GET':
+                raise HTTPError(405, "Method not allowed")
+            return await self._get_balance(unquote(path[len('/balance/'):]))
+        elif path == '/balances':
+            if method != 'POST':
+                raise HTTPError(405, "Method not allowed")
+            return await self._get_balances(body)
+        elif path == '/height':
+            if method != 'GET':
+                raise HTTPError(405, "Method not allowed")
+            return {'height': self._facade.height}
+
+        raise HTTPError(404, "Not found")
+
+    async def _handle_connection(self, reader, writer):
+        """Answer requests until the client closes the connection, pipelined
+        requests are buffered by the reader and answered in order."""
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                    if request is None:
+                        break
+
+                    method, target, headers, body = request
+                    connection = headers.get('connection', '').lower()
+                    if headers[':version'] == 'HTTP/1.0':
+                        keep_alive = connection == 'keep-alive'
+                    else:
+                        keep_alive = connection != 'close'
+
+                    response = http_response(200,
+                            await self._dispatch(method, target, body),
+                            keep_alive)
+                except HTTPError as e:
+                    # The request stream can't be trusted after an error
+                    keep_alive = False
+                    response = http_response(e.status, {'error': e.message}, False)
+                except Exception:
+                    logger.exception("Error processing request")
+                    keep_alive = False
+                    response = http_response(500, {'error': "Internal error"}, False)
+
+                writer.write(response)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            # Cancellation during shutdown is propagated after closing
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+def run_server(facade, host=SERVER_HOST, port=SERVER_PORT):
+    """Run balance server until interrupted"""
+    server = BalanceServer(facade, host, port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
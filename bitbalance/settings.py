@@ -21,8 +21,93 @@ Settings = {
     # during first sync.
     'FAST_SYNC': True,
 
+    # Blocks further than this from the blockchain tip are synchronized 
+    # in fast mode, must be larger than MAX_BACKTRACK_BLOCKS.
+    'FAST_SYNC_DISTANCE': 1000,
+
+    # Max number of addresses with balance changes accumulated by fast
+    # sync before a commit.
+    'FAST_SYNC_BATCH': 1000000,
+
+    # Number of connections to bitcoind shared by all the threads
+    'BITCOIND_POOL_SIZE': 6,
+
+    # Time without use after which a bitcoind connection is checked
+    'BITCOIND_HEALTH_CHECK_PERIOD': 30,
+
+    # Number of threads downloading blocks concurrently
+    'BLOCK_FETCH_WORKERS': 4,
+
+    # Max number of blocks requested by each download thread
+    # in a single batch request
+    'BLOCK_FETCH_BATCH': 4,
+
+    # Download blocks serialized and decode only the data needed, instead
+    # of using python-bitcoinlib CBlock (faster and uses less memory)
+    'RAW_BLOCKS': True,
+
+    # Number of processes decoding raw blocks, None for one per CPU
+    # and 0 to decode them in the download threads.
+    'BLOCK_DECODE_PROCESSES': None,
+
+    # Directory with bitcoind block files (blk*.dat) read directly
+    # during the initial sync, None to request all blocks by rpc.
+    'BLOCKS_DIR': None,
+
+    # bitcoind dumptxoutset file used to bootstrap an empty balance 
+    # storage, and the height of the snapshot base block.
+    'UTXO_SNAPSHOT': None,
+    'UTXO_SNAPSHOT_HEIGHT': None,
+
+    # Max number of calls sent to bitcoind in a single batch request
+    'BITCOIND_BATCH_SIZE': 500,
+
+    # Keep a local index of transaction outputs to resolve block inputs, 
+    # instead of requesting them to bitcoind (which requires -txindex)
+    'UTXO_INDEX': True,
+
+    # sqlite file where balances are stored, apart from the database with
+    # the utxo index and address ids so they can be committed in the 
+    # background. None stores them in that database, which databases with
+    # balances already stored there keep doing.
+    'BALANCE_DATABASE_FILE': 'balance_storage.db',
+
     # Size of in-memory address->balance cache
     'BALANCE_CACHE_SIZE': 500000,
+
+    # Track and store balances by integer address ids assigned by a 
+    # persistent address dictionary, instead of address keys. The ids 
+    # recently used are cached and a bloom filter of all the addresses 
+    # (saved into ADDRESS_ID_FILTER_FILE) avoids database reads for 
+    # addresses never seen. Only used for new databases, existing ones
+    # keep the layout their balances were stored with.
+    'ADDRESS_IDS': True,
+    'ADDRESS_ID_CACHE_SIZE': 1000000,
+    'ADDRESS_ID_FILTER_FILE': 'address_id.filter',
+
+    # Keep a bloom filter of all the addresses stored, so balance reads
+    # for unknown addresses don't access the storage. The filter is saved 
+    # into ADDRESS_FILTER_FILE on exit, otherwise it's rebuilt on start.
+    # Not used with ADDRESS_IDS, the address dictionary filters them.
+    'ADDRESS_FILTER': True,
+    'ADDRESS_FILTER_FILE': 'balance.filter',
+    'ADDRESS_FILTER_ERROR_RATE': 0.01,
+
+    # Balance query HTTP server address
+    'SERVER_HOST': '127.0.0.1',
+    'SERVER_PORT': 8080,
+
+    # Max number of addresses in a single batch balance request
+    'SERVER_MAX_BATCH': 1000,
+
+    # Write balance updates to storage in a background thread, while
+    # new blocks keep being processed. Not used when the balances are 
+    # stored in the database file where the sync thread writes the utxo
+    # index and address ids (BALANCE_DATABASE_FILE is None), sqlite only
+    # allows one writer so the sync would wait for the commit anyway. A failed
+    # commit is retried with the next block, the sync stops on storage
+    # errors or after storage.COMMIT_MAX_RETRIES consecutive failures.
+    'BACKGROUND_COMMIT': True,
 }
 
 
@@ -0,0 +1,281 @@
+"""
+snapshot
+
+Bootstrap balance storage from a utxo set snapshot written by bitcoind
+dumptxoutset, instead of replaying all the blocks from genesis.
+
+Two snapshot formats are supported:
+
+    - Bitcoin Core >= 28: 'utxo\\xff' magic, version, network magic, base
+      block hash and coin count, followed by the coins grouped by txid.
+    - Bitcoin Core < 28: base block hash and coin count, followed by
+      one (outpoint, coin) record per coin.
+
+Coins are stored with bitcoind compressed amount and script encodings.
+"""
+import io
+import logging
+import struct
+
+import bitcoin
+from bitcoin.core import Hash160, b2lx
+
+from .address import KEY_P2PKH, KEY_P2SH, script_to_key
+from .exceptions import StorageError
+
+
+logger = logging.getLogger("Bitcoin")
+
+SNAPSHOT_MAGIC = b'utxo\xff'
+
+# Max number of addresses aggregated in memory before flushing them to storage
+SNAPSHOT_FLUSH_SIZE = 1000000
+
+# Number of coins added to the utxo index in a single call
+SNAPSHOT_UTXO_BATCH = 100000
+
+# Max number of addresses read from storage in a single get_bulk call
+SNAPSHOT_READ_BATCH = 500
+
+# Storage height while an import is in progress, an interrupted import
+# leaves the storage with this height and partial balances.
+SNAPSHOT_IMPORT_HEIGHT = -2
+
+# secp256k1 field prime
+_SECP256K1_P = 2**256 - 2**32 - 977
+
+_unpack_uint16 = struct.Struct('<H').unpack
+_unpack_uint32 = struct.Struct('<I').unpack
+_unpack_uint64 = struct.Struct('<Q').unpack
+
+
+def decompress_amount(x):
+    """Inverse of bitcoind CompressAmount"""
+    if x == 0:
+        return 0
+
+    x -= 1
+    e = x % 10
+    x //= 10
+    if e < 9:
+        d = (x % 9) + 1
+        x //= 9
+        n = x*10 + d
+    else:
+        n = x + 1
+
+    return n * 10**e
+
+
+def decompress_pubkey(prefix, x):
+    """Uncompressed secp256k1 public key from its compressed form
+
+    Arguments:
+        prefix (int): 2 for even y, 3 for odd
+        x (bytes): x coordinate
+
+    Returns:
+        (bytes): 65 bytes public key
+    """
+    p = _SECP256K1_P
+    xn = int.from_bytes(x, 'big')
+    # p % 4 == 3 so the square root is a single exponentiation
+    y = pow((pow(xn, 3, p) + 7) % p, (p+1)//4, p)
+    if y & 1 != prefix & 1:
+        y = p - y
+    return b'\x04' + x + y.to_bytes(32, 'big')
+
+
+class UtxoSnapshotReader(object):
+    """Iterate over the coins in a dumptxoutset snapshot file"""
+
+    def __init__(self, fileobj):
+        """
+        Arguments:
+            fileobj (file): Snapshot file opened in binary mode
+        """
+        self._file = fileobj
+
+        header = self._read(5)
+        if header == SNAPSHOT_MAGIC:
+            self.version = _unpack_uint16(self._read(2))[0]
+            network_magic = self._read(4)
+            if network_magic != bitcoin.params.MESSAGE_START:
+                raise ValueError("Snapshot is for a different network")
+            self.base_hash = self._read(32)
+        else:
+            # Old format without magic
+            self.version = 0
+            self.base_hash = header + self._read(27)
+
+        self.coins_count = _unpack_uint64(self._read(8))[0]
+
+    def _read(self, size):
+        data = self._file.read(size)
+        if len(data) != size:
+            raise ValueError("Truncated snapshot file")
+        return data
+
+    def _read_compact_size(self):
+        size = self._read(1)[0]
+        if size < 0xfd:
+            return size
+        elif size == 0xfd:
+            return _unpack_uint16(self._read(2))[0]
+        elif size == 0xfe:
+            return _unpack_uint32(self._read(4))[0]
+        else:
+            return _unpack_uint64(self._read(8))[0]
+
+    def _read_varint(self):
+        """bitcoind VARINT (serialize.h) MSB base-128 encoding"""
+        n = 0
+        while True:
+            ch = self._read(1)[0]
+            n = (n << 7) | (ch & 0x7f)
+            if ch & 0x80:
+                n += 1
+            else:
+                return n
+
+    def _read_address(self):
+        """Decompress script and return its address key"""
+        size = self._read_varint()
+        if size == 0:
+            return bytes((KEY_P2PKH,)) + self._read(20)
+        elif size == 1:
+            return bytes((KEY_P2SH,)) + self._read(20)
+        elif size in (2, 3):
+            return bytes((KEY_P2PKH,)) + Hash160(bytes((size,)) + self._read(32))
+        elif size in (4, 5):
+            pubkey = decompress_pubkey(size-2, self._read(32))
+            return bytes((KEY_P2PKH,)) + Hash160(pubkey)
+        else:
+            return script_to_key(self._read(size-6))
+
+    def _read_coin(self):
+        """
+        Returns:
+            (address_key, value, height)
+        """
+        code = self._read_varint()
+        value = decompress_amount(self._read_varint())
+        return self._read_address(), value, code >> 1
+
+    def __iter__(self):
+        """
+        Returns:
+            iterator: (txhash, nout, address_key, value, height)
+        """
+        remaining = self.coins_count
+        if self.version:
+            while remaining:
+                txhash = self._read(32)
+                for _ in range(self._read_compact_size()):
+                    nout = self._read_compact_size()
+                    yield (txhash, nout) + self._read_coin()
+                    remaining -= 1
+        else:
+            while remaining:
+                txhash = self._read(32)
+                nout = _unpack_uint32(self._read(4))[0]
+                yield (txhash, nout) + self._read_coin()
+                remaining -= 1
+
+
+def _flush_balances(storage, balances, height=SNAPSHOT_IMPORT_HEIGHT, 
+                    address_ids=None):
+    """Add aggregated balances to the ones already stored"""
+    if address_ids is not None:
+        ids = address_ids.add(balances)
+        balances = {ids[addr]: value for addr, value in balances.items()}
+
+    address = list(balances)
+    stored = {}
+    for start in range(0, len(address), SNAPSHOT_READ_BATCH):
+        stored.update(storage.get_bulk(address[start:start+SNAPSHOT_READ_BATCH]))
+
+    to_insert = {}
+    to_update = {}
+    for addr, value in balances.items():
+        if addr in stored:
+            to_update[addr] = stored[addr] + value
+        else:
+            to_insert[addr] = value
+
+    storage.update(insert=to_insert, update=to_update, height=height)
+
+
+def check_snapshot_height(height):
+    """Raise ValueError unless height is a valid snapshot base block height"""
+    if isinstance(height, bool) or not isinstance(height, int) or height < 0:
+        raise ValueError("Invalid utxo snapshot height {!r}, it must be the "
+                         "snapshot base block height".format(height))
+
+
+def import_utxo_snapshot(path, storage, height, utxo_index=None,
+                         flush_size=SNAPSHOT_FLUSH_SIZE, address_ids=None):
+    """
+    Load address balances from a utxo set snapshot into an empty storage.
+    Until the import finishes the storage height is SNAPSHOT_IMPORT_HEIGHT,
+    if it's interrupted the storage must be discarded.
+
+    Arguments:
+        path (str): Snapshot file path
+        storage (BalanceStorage): Empty balance storage
+        height (int): Snapshot base block height
+        utxo_index (UtxoIndex): Seeded with the snapshot coins when provided
+        flush_size (int): Max number of addresses aggregated in memory
+        address_ids (AddressDictionary): Store balances by address id
+
+    Returns:
+        (int): Number of coins imported
+
+    Raises:
+        StorageError: The storage has a partial import
+        ValueError: The storage isn't empty, or the height is invalid
+    """
+    check_snapshot_height(height)
+
+    if storage.height == SNAPSHOT_IMPORT_HEIGHT:
+        raise StorageError("Interrupted utxo snapshot import, the balance "
+                           "storage must be discarded")
+    if storage.height != -1:
+        raise ValueError("Snapshots can only be imported into an empty storage")
+
+    balances = {}
+    coins = []
+    count = 0
+
+    with io.open(path, 'rb', buffering=1024*1024) as f:
+        reader = UtxoSnapshotReader(f)
+        logger.info("Importing utxo snapshot {} (height: {}, coins: {})".format(
+            b2lx(reader.base_hash), height, reader.coins_count))
+
+        for coin in reader:
+            _, _, addr, value, _ = coin
+            count += 1
+            if count % 1000000 == 0:
+                logger.info("Imported {} coins".format(count))
+
+            if utxo_index is not None:
+                coins.append(coin)
+                if len(coins) >= SNAPSHOT_UTXO_BATCH:
+                    utxo_index.add_outputs(coins)
+                    coins = []
+
+            if addr is None or value == 0:
+                continue
+
+            balances[addr] = balances.get(addr, 0) + value
+            if len(balances) >= flush_size:
+                _flush_balances(storage, balances, address_ids=address_ids)
+                balances = {}
+
+    if utxo_index is not None:
+        utxo_index.add_outputs(coins)
+        utxo_index.set_height(height)
+
+    # The last update sets the snapshot height
+    _flush_balances(storage, balances, height, address_ids)
+    return count
@@ -1,7 +1,29 @@
+import logging
+import os
+import sqlite3
 import threading
-from collections import OrderedDict, defaultdict
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 
-from .database import AddressBalance, BlockHeight, Session, make_session_scope
+from .database import (AddressBalance, BlockHeight, IdBalance, IdBlockHeight,
+                       Session, QUERY_CHUNK_SIZE, database_file, make_session_scope)
+from .bloom import BloomFilter
+from .cache import ShardedClockCache, FrequencySketch, SKETCH_SAMPLE
+from .exceptions import StorageError
+from .hashtable import MmapHashTable
+from .locks import SeqLock
+
+
+logger = logging.getLogger("Storage")
+
+# Max number of balance updates applied in a single write section, larger
+# updates are split so readers don't wait for them.
+UPDATE_SLICE_SIZE = 10000
+
+# Consecutive failed background commits retried before raising the error
+COMMIT_MAX_RETRIES = 3
 
 
 class MemoryBalanceStorage(object):
@@ -48,6 +70,12 @@ class MemoryBalanceStorage(object):
         with self._lock:
             return [(a, self._balance[a]) for a in address if a in self._balance]
 
+    def addresses(self):
+        """Iterate all stored addresses"""
+        with self._lock:
+            address = list(self._balance)
+        return iter(address)
+
     def update(self, insert=None, update=None, delete=None, height=-1):
         """Update Balance by inserting/updating/deleting in a single transaction
         
@@ -72,21 +100,32 @@ class MemoryBalanceStorage(object):
 class SQLBalanceStorage(object):
     """SQLAlchemy balance storage"""
     
-    def __init__(self, db_session):
+    def __init__(self, db_session, address_ids=False):
         """
         Arguments:
             db_session (SQLAlchemy session):
+            address_ids (bool): Addresses are integer ids from an address
+                dictionary, they are stored in their own tables.
         """
         # TODO: Add Force initial height
         self._height = -1
         self._db_session = db_session
 
+        self.address_ids = address_ids
+        if address_ids:
+            self._model, self._height_model = IdBalance, IdBlockHeight
+            self._key = 'id'
+        else:
+            self._model, self._height_model = AddressBalance, BlockHeight
+            self._key = 'address'
+        self._key_column = getattr(self._model, self._key)
+
         # Load initial height from db 
         with make_session_scope(self._db_session) as session:
 
             # If there is no block height the db is empty
-            block_height = session.query(BlockHeight).order_by(
-                    BlockHeight.id.desc()).first()
+            block_height = session.query(self._height_model).order_by(
+                    self._height_model.id.desc()).first()
         
         if block_height is not None:
             self._height = block_height.height
@@ -95,14 +134,19 @@ class SQLBalanceStorage(object):
     def height(self):
         return self._height
 
+    @property
+    def database(self):
+        """Database file path, None for in-memory databases"""
+        return database_file(self._db_session)
+
     def get(self, address, default=None):
         """
         Arguments:
             address (str):
         """
         with make_session_scope(self._db_session) as session:
-            addr_bal = session.query(AddressBalance.balance)\
-                              .filter_by(address=address)\
+            addr_bal = session.query(self._model.balance)\
+                              .filter(self._key_column == address)\
                               .first()
 
         if addr_bal is not None:
@@ -124,13 +168,25 @@ class SQLBalanceStorage(object):
             not stored are ignored
             [('address', balance), ('address', balance), ....]
         """
+        address = list(address)
+        results = []
+
         with make_session_scope(self._db_session) as session:
-            query = session.query(AddressBalance.address, AddressBalance.balance)\
-                           .filter(AddressBalance.address.in_(address))
-            results = query.all()
+            for start in range(0, len(address), QUERY_CHUNK_SIZE):
+                chunk = address[start:start+QUERY_CHUNK_SIZE]
+                query = session.query(self._key_column, self._model.balance)\
+                               .filter(self._key_column.in_(chunk))
+                results.extend(query.all())
 
         return results
 
+    def addresses(self):
+        """Iterate all stored addresses"""
+        with make_session_scope(self._db_session) as session:
+            query = session.query(self._key_column).yield_per(10000)
+            for (address,) in query:
+                yield address
+
     def update(self, insert=None, update=None, delete=None, height=-1):
         """Update Balance by inserting/updating/deleting in a single transaction
         
@@ -151,52 +207,540 @@ class SQLBalanceStorage(object):
         with make_session_scope(self._db_session) as session:
             
             if insert:
-                in_map = [{"address": a, "balance":b } for a, b in insert.items()]
-                session.bulk_insert_mappings(AddressBalance, in_map, 
+                in_map = [{self._key: a, "balance":b } for a, b in insert.items()]
+                session.bulk_insert_mappings(self._model, in_map, 
                                              return_defaults=False)
 
             if update:
-                up_map = [{"address": a, "balance":b } for a, b in update.items()]
-                session.bulk_update_mappings(AddressBalance, up_map)
+                up_map = [{self._key: a, "balance":b } for a, b in update.items()]
+                session.bulk_update_mappings(self._model, up_map)
 
 
-            if delete:
-                session.query(AddressBalance)\
-                       .filter(AddressBalance.address.in_(delete))\
+            delete = list(delete or ())
+            for start in range(0, len(delete), QUERY_CHUNK_SIZE):
+                session.query(self._model)\
+                       .filter(self._key_column.in_(delete[start:start+QUERY_CHUNK_SIZE]))\
                        .delete(synchronize_session=False)
 
-            session.query(BlockHeight).delete()
-            session.add(BlockHeight(height=height))
+            session.query(self._height_model).delete()
+            session.add(self._height_model(height=height))
+
+        self._height = height
+
+
+class SQLiteBalanceStorage(object):
+    """sqlite3 balance storage, updates use prepared statements with 
+    executemany which is much faster than SQLAlchemy ORM bulk operations.
+
+    It uses the same tables as SQLBalanceStorage so both can share the
+    database file.
+    """
+
+    def __init__(self, path=':memory:', address_ids=False):
+        """
+        Arguments:
+            path (str): sqlite database file
+            address_ids (bool): Addresses are integer ids from an address
+                dictionary, they are stored in their own INTEGER keyed 
+                tables.
+        """
+        self._height = -1
+        self._lock = threading.Lock()
+
+        self.address_ids = address_ids
+        if address_ids:
+            self._table, self._key, self._blocks = 'id_balance', 'id', 'id_blocks'
+            key_type = 'INTEGER'
+        else:
+            self._table, self._key, self._blocks = 'address_balance', 'address', 'blocks'
+            key_type = 'VARCHAR(32)'
+
+        # Database file path, None for in-memory databases
+        self.database = None if path == ':memory:' else os.path.abspath(path)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA temp_store=MEMORY')
+
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS {} ('
+                               '{} {} NOT NULL PRIMARY KEY, '
+                               'balance INTEGER)'.format(self._table, self._key, 
+                                                         key_type))
+            self._conn.execute('CREATE TABLE IF NOT EXISTS {} ('
+                               'id INTEGER NOT NULL PRIMARY KEY, '
+                               'height INTEGER)'.format(self._blocks))
+        
+        # Load initial height from db
+        row = self._conn.execute('SELECT height FROM {} '
+                                 'ORDER BY id DESC LIMIT 1'.format(self._blocks)).fetchone()
+        if row is not None:
+            self._height = row[0]
+
+    @property
+    def height(self):
+        return self._height
+
+    def get(self, address, default=None):
+        """
+        Arguments:
+            address (str|bytes|int):
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT balance FROM {} WHERE {}=?'.format(
+                                     self._table, self._key), (address,)).fetchone()
+        
+        if row is not None:
+            return row[0]
+        elif default is not None:
+            return default
+
+        raise KeyError
+
+    def get_bulk(self, address):
+        """ 
+        Obtain the stored balance of a set of address in a single call
+
+        Arguments:
+            address (iterable): Set of address to retrieve
+
+        Returns: 
+            Address and balance for the address stored in the db, the ones
+            not stored are ignored
+            [('address', balance), ('address', balance), ....]
+        """
+        address = list(address)
+        results = []
+
+        with self._lock:
+            for start in range(0, len(address), QUERY_CHUNK_SIZE):
+                chunk = address[start:start+QUERY_CHUNK_SIZE]
+                query = 'SELECT {key}, balance FROM {table} WHERE {key} IN ({args})'\
+                        .format(key=self._key, table=self._table, 
+                                args=','.join('?'*len(chunk)))
+                results.extend(self._conn.execute(query, chunk))
+
+        return results
+
+    def addresses(self):
+        """Iterate all stored addresses"""
+        with self._lock:
+            cursor = self._conn.execute('SELECT {} FROM {}'.format(self._key, self._table))
+            address = [row[0] for row in cursor]
+        return iter(address)
+
+    def update(self, insert=None, update=None, delete=None, height=-1):
+        """Update Balance by inserting/updating/deleting in a single transaction
+        
+        Arguments:
+            Insert (dict): Insert new address balance
+                {"address1": balance1, "address2": balance2, ...}
+            Update (dict): Update existing address balance
+                {"address3": balance3, ...}
+            Delete (iterable): Remove esisting address
+                ['address4', 'address5', ...]
+        """ 
+        with self._lock, self._conn:
+            # Inserts and updates are merged into a single upsert
+            upsert = chain((insert or {}).items(), (update or {}).items())
+            self._conn.executemany('INSERT INTO {table}({key}, balance) '
+                                   'VALUES (?, ?) ON CONFLICT({key}) '
+                                   'DO UPDATE SET balance=excluded.balance'.format(
+                                       table=self._table, key=self._key), upsert)
+
+            if delete:
+                self._conn.executemany('DELETE FROM {} WHERE {}=?'.format(
+                                           self._table, self._key),
+                                       ((addr,) for addr in delete))
+            
+            self._conn.execute('DELETE FROM {}'.format(self._blocks))
+            self._conn.execute('INSERT INTO {}(height) VALUES (?)'.format(self._blocks),
+                               (height,))
 
         self._height = height
 
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class MmapBalanceStorage(object):
+    """Balance storage on a memory-mapped hash table file, reads don't need
+    any parsing or copying besides the value, and each update is committed
+    atomically. Addresses are stored as bytes, str addresses are utf-8 
+    encoded and integer address ids as 8 bytes little-endian."""
+
+    def __init__(self, path, key_size=34, address_ids=False):
+        """
+        Arguments:
+            path (str): Hash table file
+            key_size (int): Max address length in bytes
+            address_ids (bool): Addresses are integer ids from an address
+                dictionary. It isn't recorded in the file, it must be the 
+                same every time the file is opened.
+        """
+        self.address_ids = address_ids
+        self._table = MmapHashTable(path, key_size=key_size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(address):
+        if isinstance(address, str):
+            return address.encode('utf-8')
+        elif isinstance(address, int):
+            return address.to_bytes(8, 'little')
+        return address
+
+    @property
+    def height(self):
+        return self._table.height
+
+    def get(self, address, default=None):
+        """Get address balance"""
+        with self._lock:
+            balance = self._table.get(self._key(address))
+
+        if balance is not None:
+            return balance
+        elif default is not None:
+            return default
+
+        raise KeyError
+
+    def get_bulk(self, address):
+        """ 
+        Obtain the stored balance of a set of address in a single call
+
+        Arguments:
+            address (iterable): Set of address to retrieve
+
+        Returns: 
+            Address and balance for the address stored, the ones
+            not stored are ignored
+            [('address', balance), ('address', balance), ....]
+        """
+        results = []
+        with self._lock:
+            for addr in address:
+                balance = self._table.get(self._key(addr))
+                if balance is not None:
+                    results.append((addr, balance))
+        return results
+
+    def addresses(self):
+        """Iterate all stored addresses (as bytes)"""
+        with self._lock:
+            address = [key for key, _ in self._table.items()]
+        return iter(address)
+
+    def update(self, insert=None, update=None, delete=None, height=-1):
+        """Update Balance by inserting/updating/deleting in a single transaction
+        
+        Arguments:
+            Insert (dict): Insert new address balance
+                {"address1": balance1, "address2": balance2, ...}
+            Update (dict): Update existing address balance
+                {"address3": balance3, ...}
+            Delete (iterable): Remove esisting address
+                ['address4', 'address5', ...]
+        """
+        put = [(self._key(a), b) for a, b in chain((insert or {}).items(), 
+                                                   (update or {}).items())]
+        with self._lock:
+            self._table.update(put=put, 
+                               delete=[self._key(a) for a in delete or ()],
+                               height=height)
+
+    def close(self):
+        with self._lock:
+            self._table.close()
+
+
+class ShardedBalanceStorage(object):
+    """Spread addresses over several balance storages by address hash, 
+    updates and bulk reads run in parallel on all the shards.
+
+    Every shard stores the same height with each update, if an update is
+    interrupted the shards are left with different heights and the storage
+    can't be used. The same happens when any shard fails an update, retrying
+    it would apply the changes twice on the shards that didn't fail, so all
+    later calls raise StorageError.
+    """
+
+    def __init__(self, shards):
+        """
+        Arguments:
+            shards (list): Balance storages, always in the same order
+        """
+        assert shards
+        self._shards = list(shards)
+        self._executor = ThreadPoolExecutor(len(self._shards))
+
+        heights = set(shard.height for shard in self._shards)
+        if len(heights) != 1:
+            raise StorageError("Inconsistent shard heights {}".format(
+                [shard.height for shard in self._shards]))
+
+        self._height = heights.pop()
+        self._failed = False
+
+        # Addresses are integer ids, all the shards must agree
+        address_ids = set(getattr(shard, 'address_ids', False) for shard in self._shards)
+        if len(address_ids) != 1:
+            raise ValueError("Shards with and without address_ids")
+        self.address_ids = address_ids.pop()
+
+    @property
+    def height(self):
+        return self._height
+
+    def _check_failed(self):
+        if self._failed:
+            raise StorageError("Shard update failed, storage is inconsistent")
+
+    def _shard_number(self, address):
+        if isinstance(address, int):
+            return address % len(self._shards)
+        elif isinstance(address, str):
+            address = address.encode('utf-8')
+        return zlib.crc32(address) % len(self._shards)
+
+    def _split(self, address):
+        """Split addresses by shard"""
+        split = [[] for _ in self._shards]
+        for addr in address:
+            split[self._shard_number(addr)].append(addr)
+        return split
+
+    def _split_dict(self, balances):
+        split = [{} for _ in self._shards]
+        for addr, balance in (balances or {}).items():
+            split[self._shard_number(addr)][addr] = balance
+        return split
+
+    def get(self, address, default=None):
+        """Get address balance"""
+        self._check_failed()
+        return self._shards[self._shard_number(address)].get(address, default)
+
+    def get_bulk(self, address):
+        """ 
+        Obtain the stored balance of a set of address in a single call
+
+        Arguments:
+            address (iterable): Set of address to retrieve
+
+        Returns: 
+            Address and balance for the address stored, the ones
+            not stored are ignored
+            [('address', balance), ('address', balance), ....]
+        """
+        self._check_failed()
+        split = self._split(address)
+        futures = [self._executor.submit(shard.get_bulk, addrs) 
+                   for shard, addrs in zip(self._shards, split) if addrs]
+
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def addresses(self):
+        """Iterate all stored addresses"""
+        self._check_failed()
+        return chain.from_iterable(shard.addresses() for shard in self._shards)
+
+    def update(self, insert=None, update=None, delete=None, height=-1):
+        """Update Balance by inserting/updating/deleting, each shard is
+        updated in a single transaction.
+        
+        Arguments:
+            Insert (dict): Insert new address balance
+                {"address1": balance1, "address2": balance2, ...}
+            Update (dict): Update existing address balance
+                {"address3": balance3, ...}
+            Delete (iterable): Remove esisting address
+                ['address4', 'address5', ...]
+        """
+        self._check_failed()
+        inserts = self._split_dict(insert)
+        updates = self._split_dict(update)
+        deletes = self._split(delete or ())
+
+        # All shards are updated even without changes to store the height
+        futures = [self._executor.submit(shard.update, insert=i, update=u, 
+                                         delete=d, height=height)
+                   for shard, i, u, d in zip(self._shards, inserts, updates, deletes)]
+
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            self._failed = True
+            raise errors[0]
+
+        self._height = height
+
+
+class AddressFilterStorage(object):
+    """Balance storage wrapper with a bloom filter of all the addresses 
+    that were ever inserted, reads for addresses not in the filter are
+    answered without accessing the storage.
+
+    The filter is loaded from a file saved with the same storage height, 
+    otherwise it's rebuilt from all the stored addresses.
+    """
+
+    def __init__(self, storage, path=None, capacity=1 << 20, error_rate=0.01):
+        """
+        Arguments:
+            storage (BalanceStorage): Wrapped storage, must implement 
+                addresses() to rebuild the filter.
+            path (str|None): Filter file, None to always rebuild
+            capacity (int): Initial filter capacity when rebuilt
+            error_rate (float): Filter false positive rate
+        """
+        self._storage = storage
+        self._path = path
+        self._filter = None
+
+        if path is not None and os.path.exists(path):
+            try:
+                self._filter, height = BloomFilter.load(path, error_rate)
+            except ValueError as e:
+                logger.warning("Discarding address filter {}: {}".format(path, e))
+            else:
+                if height != storage.height:
+                    logger.info("Address filter outdated ({} != {})".format(
+                        height, storage.height))
+                    self._filter = None
+
+        if self._filter is None:
+            logger.info("Building address filter")
+            self._filter = BloomFilter(capacity, error_rate)
+            self._filter.update(storage.addresses())
+
+        # Stats
+        self.filtered_count = 0
+
+    @property
+    def height(self):
+        return self._storage.height
+
+    def __contains__(self, address):
+        """False if the address was never stored"""
+        return address in self._filter
+
+    def get(self, address, default=None):
+        """Get address balance"""
+        if address not in self._filter:
+            self.filtered_count += 1
+            if default is None:
+                raise KeyError(address)
+            return default
+
+        return self._storage.get(address, default)
+
+    def get_bulk(self, address):
+        """ 
+        Obtain the stored balance of a set of address in a single call,
+        only the addresses in the filter are read from storage.
+
+        Arguments:
+            address (iterable): Set of address to retrieve
+
+        Returns: 
+            Address and balance for the address stored, the ones
+            not stored are ignored
+            [('address', balance), ('address', balance), ....]
+        """
+        address = list(address)
+        to_read = [addr for addr in address if addr in self._filter]
+        self.filtered_count += len(address) - len(to_read)
+
+        if not to_read:
+            return []
+        return self._storage.get_bulk(to_read)
+
+    def addresses(self):
+        return self._storage.addresses()
+
+    def update(self, insert=None, update=None, delete=None, height=-1):
+        """Update Balance by inserting/updating/deleting in a single transaction
+        
+        Arguments:
+            Insert (dict): Insert new address balance
+                {"address1": balance1, "address2": balance2, ...}
+            Update (dict): Update existing address balance
+                {"address3": balance3, ...}
+            Delete (iterable): Remove esisting address
+                ['address4', 'address5', ...]
+        """
+        # Added before the storage update so concurrent reads for the
+        # new addresses aren't filtered once they are stored.
+        if insert:
+            self._filter.update(insert)
+
+        self._storage.update(insert=insert, update=update, delete=delete,
+                             height=height)
+
+    def save(self):
+        """Save filter with the current storage height"""
+        if self._path is not None:
+            self._filter.save(self._path, self._storage.height)
+
 
 class BalanceProxyCache(object):
     """
-    update and commit can't be calladed concurrently
+    Address balance cache in front of a balance storage, updates are 
+    accumulated until they are commited.
+
+    With background commits the pending updates are frozen, and their 
+    stored balances loaded and the new ones written to storage by a 
+    committer thread, while new updates keep accumulating in a fresh 
+    buffer. Balances are the sum of the cached stored value, the 
+    updates being committed and the new updates.
+
+    Reads don't take the main lock, they use the SeqLock protecting the 
+    buffers and retry if there was a concurrent modification. The cache 
+    itself is a ShardedClockCache with a lock per shard, the addresses being
+    committed are pinned so they aren't evicted until the commit finishes.
+
+    Addresses read are always cached, but the ones loaded only for a commit
+    are staged and afterwards admitted into the cache only if they are read
+    more frequently than the entries they would replace.
+
+    update and commit can't be called concurrently
     """
-    def __init__(self, balance_storage, max_cache_size):
+    def __init__(self, balance_storage, max_cache_size, background=False):
         """
         Arguments:
             balance_storage (BalanceStorage)
             max_cache_size (int): Max cached addresses, 
                 WARNING: during commits the cache_size can be larger
+            background (bool): Commit in a background thread
         """
-        self._cache = OrderedDict()
+        self._cache = ShardedClockCache(
+            sketch=FrequencySketch(max_cache_size, SKETCH_SAMPLE))
         self._max_cache = max_cache_size
         self._storage = balance_storage
         self._height = self._storage.height
+        self._background = background
 
         # Updates received but not yet commited
         self._updates = defaultdict(int)
+
+        # Updates being commited
+        self._committing = {}
+        self._commit_thread = None
+        self._commit_error = None
+        self._commit_failures = 0
         
-        # When disabled cache can't be trimed, this way is
-        # possible to call get() without removing from cache
-        # a value placed by commit()
-        self._trim_cache = True
+        # Write lock, readers retry if there was a concurrent write
+        self._lock = SeqLock()
 
-        # Read and write locks
-        self._lock = threading.Lock() 
+        # Incremented each time committed updates are merged into cache,
+        # values loaded from storage before a merge are discarded.
+        self._commit_seq = 0
         
         # Cache Hit/miss stats
         self._cache_hit_count = 0
@@ -206,6 +750,12 @@ class BalanceProxyCache(object):
     def height(self):
         return self._height
 
+    @property
+    def stored_height(self):
+        """Height of the updates already written to storage, lower than 
+        height while a background commit is running"""
+        return self._storage.height
+
     def __len__(self):
         """Number of updates since last commit"""
         return len(self._updates)
@@ -216,54 +766,150 @@ class BalanceProxyCache(object):
         Arguments:
             address (str): Address for the balance to load
         """
-        if address in self._cache:
-            self._cache.move_to_end(address)
-            self._cache_hit_count += 1
-            return
+        commit_seq = self._commit_seq
+        balance = self._storage.get(address, 0)
 
-        self._cache_miss_count += 1
-        self._cache[address] = self._storage.get(address, 0)
-
-        if self._trim_cache and len(self._cache) > self._max_cache:
-            self._cache.popitem(last=False)
+        # The value is stale if a commit finished during the load
+        valid = lambda: commit_seq == self._commit_seq
+        if self._cache.set_missing(address, balance, self._max_cache, valid):
+            self._cache_miss_count += 1
 
     def _load_to_cache_bulk(self, address):
-        """Load several addresses from storage into cache
+        """Stage the addresses not cached, the cached ones must be pinned 
+        so they are not discarded before the commit.
         
         Arguments:
             address (set|dict|list): addresses to load
         """
-        to_load = []
+        to_load = [addr for addr in address if addr not in self._cache]
 
-        for addr in address:
-            if addr not in self._cache:
-                to_load.append(addr)
-            else:
-                self._cache.move_to_end(addr)
-
-        # to_load = [addr for addr in address if addres not in self._cache]
         self._cache_hit_count += len(address) - len(to_load)
         self._cache_miss_count += len(to_load)
         
         stored = dict(self._storage.get_bulk(to_load))
-    
-        for addr in to_load:
-            self._cache[addr] = stored.get(addr, 0)
-
-        while self._trim_cache and len(self._cache) > self._max_cache:
-            self._cache.popitem(last=False)
 
+        # Storage isn't modified until the commit, so addresses loaded
+        # meanwhile by get() have the same value.
+        for addr in to_load:
+            self._cache.stage(addr, stored.get(addr, 0))
 
     def get(self, address):
         """Get address balanced"""
-        with self._lock:
-            try:
-                return self._cache[address] + self._updates.get(address, 0)
-            except KeyError:
-                # balance not cached, load from storage   
+        lock = self._lock
+        while True:
+            seq = lock.read_begin()
+            stored = self._cache.get(address)
+            if stored is None:
+                # balance not cached, load from storage
                 self._load_to_cache(address)
+                continue
+
+            balance = (stored
+                       + self._committing.get(address, 0)
+                       + self._updates.get(address, 0))
+
+            if not lock.read_retry(seq):
+                self._cache_hit_count += 1
+                return balance
+
+    def get_cached(self, address):
+        """Get address balance only if it doesn't require a storage read
+        
+        Returns:
+            (int|None): balance or None if the address isn't cached
+        """
+        lock = self._lock
+        while True:
+            seq = lock.read_begin()
+            stored = self._cache.get(address)
+            if stored is None:
+                return None
+
+            balance = (stored
+                       + self._committing.get(address, 0)
+                       + self._updates.get(address, 0))
+            
+            if not lock.read_retry(seq):
+                return balance
+
+    def _load_to_cache_missing(self, address):
+        """Load addresses missing from cache for a bulk read
+
+        Arguments:
+            address (list): addresses to load
+
+        Returns:
+            (commit_seq, {address: balance}) or (None, None) if a commit
+                finished during the load and the values are stale
+        """
+        commit_seq = self._commit_seq
+        stored = dict(self._storage.get_bulk(address))
+        stored.update((addr, 0) for addr in address if addr not in stored)
+
+        valid = lambda: commit_seq == self._commit_seq
+        for addr in address:
+            self._cache.set_missing(addr, stored[addr], self._max_cache, valid)
+        
+        if commit_seq != self._commit_seq:
+            return None, None
+
+        self._cache_miss_count += len(address)
+        return commit_seq, stored
 
-        return self.get(address)
+    def get_bulk(self, address, cached_only=False):
+        """Get the balance of several addresses, the balances are all for
+        the same set of updates. Addresses not cached are loaded from
+        storage with a single get_bulk call.
+
+        Arguments:
+            address (iterable): addresses
+            cached_only (bool): Return None instead of reading storage
+
+        Returns:
+            {address: balance, ...}
+        """
+        address = list(address)
+        lock = self._lock
+
+        # Values loaded from storage, valid until the next commit finishes
+        loaded = {}
+        loaded_seq = None
+
+        while True:
+            if loaded_seq != self._commit_seq:
+                loaded = {}
+
+            seq = lock.read_begin()
+            cache = self._cache
+            committing = self._committing
+            updates = self._updates
+
+            balances = {}
+            missing = []
+            for addr in address:
+                stored = cache.get(addr)
+                if stored is None:
+                    stored = loaded.get(addr)
+                    if stored is None:
+                        missing.append(addr)
+                        continue
+
+                balances[addr] = (stored 
+                                  + committing.get(addr, 0)
+                                  + updates.get(addr, 0))
+
+            if missing:
+                if cached_only:
+                    return None
+
+                loaded_seq, stored = self._load_to_cache_missing(missing)
+                if stored is not None:
+                    loaded.update(stored)
+                continue
+
+            if not lock.read_retry(seq):
+                self._cache_hit_count += len(address)
+                return balances
 
     def update(self, address, value):
         """Update address balance by adding or substracting an ammount,
@@ -278,75 +924,167 @@ class BalanceProxyCache(object):
             if self._updates[address] == 0:
                 self._updates.pop(address, None)
 
+    def update_bulk(self, updates):
+        """Apply several balance updates at once, readers see all or none
+        of them.
+
+        Arguments:
+            updates (dict|iterable): {address: value, ...} or 
+                [(address, value), ...]
+        """
+        if isinstance(updates, dict):
+            updates = updates.items()
+
+        with self._lock:
+            pending = self._updates
+            for address, value in updates:
+                if not value:
+                    continue
+                
+                pending[address] += value
+                if pending[address] == 0:
+                    del pending[address]
+
     def _commit(self, height):
-        """Commit to storage all updates since last commit.
+        """Commit to storage the frozen updates.
 
         This code tries to lock the minimum time possible so get 
-        request are responsive even during a big commit.
-
-        WARNING: CAN'T CALL UPDATE() WHILE COMMITING... GET() IS OKAY
+        request are responsive even during a big commit. The committing
+        addresses must be pinned.
         
         Arguments:
             height (int): Block height for the
         """
-        assert height >= self.height
-        if height == self.height:
-            return
+        # Preload the balance for all the committing addresses into cache 
+        # or staging, they are kept until the commit is finished.
+        self._load_to_cache_bulk(self._committing)
 
         to_insert = {}
         to_update = {}
         to_delete = set()
        
-        self._height = height
+        # Convert updates into insert/update/delete operations, all the 
+        # committing addresses were cached or staged above.
+        for addr, value in self._committing.items():
+            stored_value = self._cache.peek(addr)
 
-        # Preload balance for all updated address into cache
-        with self._lock:
-            
-            self._load_to_cache_bulk(self._updates)
-
-            # Convert updates into insert/update/delete operations
-            for addr, value in self._updates.items():
-                stored_value = self._cache[addr]
-
-                if stored_value == 0:
-                    to_insert[addr] = value
-                elif stored_value + value == 0:
-                    to_delete.add(addr)
-                else:
-                    to_update[addr] = stored_value + value
+            if stored_value == 0:
+                to_insert[addr] = value
+            elif stored_value + value == 0:
+                to_delete.add(addr)
+            else:
+                to_update[addr] = stored_value + value
            
-        # Merge updates into cache.
-        with self._lock:
-            for addr, update in self._updates.items():
-                self._cache[addr] += update
- 
-            self._updates = defaultdict(int)
-        
-        # Can update without a lock because update isn't called until
-        # the commit is finished, and all get requests for any of the
-        # updated address are cached.
+        # Can update without a lock because the cached values for the
+        # committing addresses don't change until the merge below.
         self._storage.update(insert=to_insert,
-                                 update=to_update,
-                                 delete=to_delete,
-                                 height=height)
+                             update=to_update,
+                             delete=to_delete,
+                             height=height)
+        
+        # Merge updates into cache, values loaded from storage from now on
+        # are discarded. It's merged in slices so readers don't wait for 
+        # all of it, each address is moved from committing into cache 
+        # atomically.
+        committing = self._committing
+        merge = list(committing.items())
+        with self._lock:
+            self._commit_seq += 1
 
-        # Trim cache to correct size
-        while len(self._cache) > self._max_cache:
+        for start in range(0, len(merge), UPDATE_SLICE_SIZE):
             with self._lock:
-                self._cache.popitem(last=False)
+                for addr, update in merge[start:start+UPDATE_SLICE_SIZE]:
+                    self._cache.add(addr, update)
+                    del committing[addr]
 
+        with self._lock:
+            self._committing = {}
+            self._cache.pinned = ()
 
-    def commit(self, height):
-        """Wrapper to disable cache trim before calling commit"""
+        # Admit frequently read staged addresses, and trim cache to
+        # correct size
+        self._cache.admit_staged(self._max_cache)
+        self._cache.trim(self._max_cache)
+
+    def _rollback(self, height):
+        """Restore the frozen updates after a failed commit so they 
+        aren't lost"""
+        with self._lock:
+            for addr, value in self._committing.items():
+                self._updates[addr] += value
+            self._committing = {}
+            self._cache.pinned = ()
+            self._cache.discard_staged()
+            self._height = height
+
+    def _commit_thread_func(self, height, prev_height):
         try:
-            self._trim_cache = False
             self._commit(height)
-        except:
+        except Exception as e:
+            self._commit_error = e
+            self._rollback(prev_height)
+
+    def wait(self):
+        """Wait until the background commit finishes, and raise its 
+        exception if it failed"""
+        if self._commit_thread is not None:
+            self._commit_thread.join()
+            self._commit_thread = None
+
+        error, self._commit_error = self._commit_error, None
+        if error is not None:
+            raise error
+
+    def commit(self, height):
+        """Commit to storage all updates since last commit.
+
+        Arguments:
+            height (int): Block height for the
+        """
+        assert height >= self.height
+        
+        # Only one commit at a time, the updates of a failed background
+        # commit were restored so they are committed again now. Storage
+        # errors and repeated failures are raised.
+        try:
+            self.wait()
+        except StorageError:
             raise
-        finally:
-            self._trim_cache = True
+        except Exception:
+            self._commit_failures += 1
+            if self._commit_failures > COMMIT_MAX_RETRIES:
+                raise
+            logger.exception("Background commit failed, retrying (height: {})".format(height))
+        else:
+            self._commit_failures = 0
+
+        if height == self.height:
+            return
+
+        # Freeze current updates, the cached ones are pinned until the 
+        # commit is finished.
+        prev_height = self._height
+        with self._lock:
+            self._committing = self._updates
+            self._cache.pinned = self._committing
+            self._updates = defaultdict(int)
+            self._height = height
+
+        if not self._background:
+            try:
+                self._commit(height)
+            except:
+                self._rollback(prev_height)
+                raise
+            return
+
+        self._commit_thread = threading.Thread(target=self._commit_thread_func,
+                                               args=(height, prev_height), 
+                                               daemon=True)
+        self._commit_thread.start()
 
     def cache_clear(self):
         """Clear balance cache"""
+        self.wait()
         with self._lock:
-            self._cache = OrderedDict()
+            self._cache.clear()
@@ -0,0 +1,278 @@
+"""
+utxo
+
+Local transaction output index, so block inputs can be resolved without
+requesting the source transactions to bitcoind (it doesn't require -txindex
+and works with pruned nodes).
+
+Spent outputs are not removed until prune() is called with a height above
+the spending block, this way blocks can be backtracked, and replayed after 
+a restart from the balance storage height. The hash of each block not yet
+pruned is kept, so a replayed block from another branch (a reorg while 
+the balance storage was behind) undoes the index down to the fork point.
+"""
+import threading
+from collections import defaultdict
+
+from sqlalchemy import and_, bindparam, select
+
+from .database import (Utxo, UtxoBlock, UtxoHeight, QUERY_CHUNK_SIZE, 
+                       make_session_scope)
+
+
+def _indexed_outputs(block):
+    """Block outputs that can be spent"""
+    return [txout for txout in block.vout if txout.value > 0 or txout.addr]
+
+
+class MemoryUtxoIndex(object):
+    """In-Memory transaction output index"""
+
+    def __init__(self):
+        # (txhash, nout) -> [addr, value]
+        self._utxo = {}
+
+        # Outputs created and spent by each block
+        self._created = defaultdict(list)
+        self._spent = defaultdict(list)
+
+        # height -> block hash
+        self._hashes = {}
+
+        self._height = -1
+        self._lock = threading.Lock()
+
+    @property
+    def height(self):
+        return self._height
+
+    def __len__(self):
+        return len(self._utxo)
+
+    def get_bulk(self, outpoints):
+        """
+        Get the outputs for a set of outpoints
+
+        Arguments:
+            outpoints (iterable): (txhash, nout) tuples
+
+        Returns:
+            {(txhash, nout): (addr, value), ...} for the outpoints found
+        """
+        with self._lock:
+            return {op: self._utxo[op] for op in outpoints if op in self._utxo}
+
+    def add_block(self, block):
+        """Add block outputs to the index and mark its inputs as spent,
+        blocks already in the index are ignored. If there is a different
+        block at the same height, it and the blocks above are undone 
+        before adding it."""
+        with self._lock:
+            if block.height <= self._height:
+                if self._hashes.get(block.height, block.block_hash) == block.block_hash:
+                    return
+                self._undo(block.height)
+
+            for txout in _indexed_outputs(block):
+                outpoint = (txout.tx, txout.nout)
+                self._utxo[outpoint] = (txout.addr, txout.value)
+                self._created[block.height].append(outpoint)
+
+            self._spent[block.height] = [(txin.tx, txin.nout) for txin in block.vin]
+            self._hashes[block.height] = block.block_hash
+            self._height = block.height
+
+    def add_outputs(self, outputs):
+        """Add unspent outputs not linked to any block, used to seed the 
+        index from a utxo set snapshot, they can't be undone.
+
+        Arguments:
+            outputs (iterable): (txhash, nout, addr, value, height) tuples
+        """
+        with self._lock:
+            for txhash, nout, addr, value, _ in outputs:
+                self._utxo[(txhash, nout)] = (addr, value)
+
+    def set_height(self, height):
+        with self._lock:
+            self._height = height
+
+    def _undo(self, height):
+        for h in range(self._height, height-1, -1):
+            for outpoint in self._created.pop(h, ()):
+                self._utxo.pop(outpoint, None)
+            
+            self._spent.pop(h, None)
+            self._hashes.pop(h, None)
+        
+        self._height = height-1
+
+    def undo(self, height):
+        """Remove the blocks from height up to the last added block
+        
+        Arguments:
+            height (int): height of the first block to remove, nothing 
+                is removed if it's above the last added block.
+        """
+        with self._lock:
+            if height <= self._height:
+                self._undo(height)
+
+    def prune(self, height):
+        """Permanently remove the outputs spent by blocks up to height"""
+        with self._lock:
+            for h in [h for h in self._spent if h <= height]:
+                for outpoint in self._spent.pop(h):
+                    self._utxo.pop(outpoint, None)
+
+            for h in [h for h in self._created if h <= height]:
+                del self._created[h]
+
+            for h in [h for h in self._hashes if h <= height]:
+                del self._hashes[h]
+
+
+class SQLUtxoIndex(object):
+    """SQLAlchemy transaction output index"""
+
+    def __init__(self, db_session):
+        """
+        Arguments:
+            db_session (SQLAlchemy session):
+        """
+        self._height = -1
+        self._db_session = db_session
+        self._table = Utxo.__table__
+
+        with make_session_scope(self._db_session) as session:
+            utxo_height = session.query(UtxoHeight).order_by(
+                    UtxoHeight.id.desc()).first()
+        
+        if utxo_height is not None:
+            self._height = utxo_height.height
+
+    @property
+    def height(self):
+        return self._height
+
+    def _set_height(self, session, height):
+        session.query(UtxoHeight).delete()
+        session.add(UtxoHeight(height=height))
+
+    def get_bulk(self, outpoints):
+        """
+        Get the outputs for a set of outpoints
+
+        Arguments:
+            outpoints (iterable): (txhash, nout) tuples
+
+        Returns:
+            {(txhash, nout): (addr, value), ...} for the outpoints found
+        """
+        outpoints = set(outpoints)
+        txids = list({txid for txid, _ in outpoints})
+        found = {}
+
+        t = self._table
+        with make_session_scope(self._db_session) as session:
+            for start in range(0, len(txids), QUERY_CHUNK_SIZE):
+                query = select([t.c.txid, t.c.nout, t.c.address, t.c.value])\
+                        .where(t.c.txid.in_(txids[start:start+QUERY_CHUNK_SIZE]))
+                
+                for txid, nout, address, value in session.execute(query):
+                    if (txid, nout) in outpoints:
+                        found[(txid, nout)] = (address, value)
+
+        return found
+
+    def _block_hash(self, height):
+        """Hash of the indexed block at height, None if unknown"""
+        with make_session_scope(self._db_session) as session:
+            block = session.query(UtxoBlock).get(height)
+            return block.block_hash if block is not None else None
+
+    def add_block(self, block):
+        """Add block outputs to the index and mark its inputs as spent,
+        blocks already in the index are ignored. If there is a different
+        block at the same height, it and the blocks above are undone 
+        before adding it."""
+        if block.height <= self._height:
+            if self._block_hash(block.height) in (None, block.block_hash):
+                return
+            self.undo(block.height)
+
+        t = self._table
+        outputs = [{'txid': txout.tx, 
+                    'nout': txout.nout, 
+                    'address': txout.addr,
+                    'value': txout.value,
+                    'height': block.height} for txout in _indexed_outputs(block)]
+        
+        inputs = [{'b_txid': txin.tx, 'b_nout': txin.nout} for txin in block.vin]
+
+        with make_session_scope(self._db_session) as session:
+            # OR REPLACE for duplicated transactions (BIP30)
+            if outputs:
+                session.execute(t.insert().prefix_with('OR REPLACE'), outputs)
+            
+            if inputs:
+                spend = t.update()\
+                         .where(and_(t.c.txid == bindparam('b_txid'),
+                                     t.c.nout == bindparam('b_nout')))\
+                         .values(spent=block.height)
+                session.execute(spend, inputs)
+
+            session.merge(UtxoBlock(height=block.height, block_hash=block.block_hash))
+            self._set_height(session, block.height)
+
+        self._height = block.height
+
+    def add_outputs(self, outputs):
+        """Add unspent outputs not linked to any block, used to seed the 
+        index from a utxo set snapshot.
+
+        Arguments:
+            outputs (iterable): (txhash, nout, addr, value, height) tuples
+        """
+        outputs = [{'txid': txhash,
+                    'nout': nout,
+                    'address': addr,
+                    'value': value,
+                    'height': height} for txhash, nout, addr, value, height in outputs]
+        if not outputs:
+            return
+
+        with make_session_scope(self._db_session) as session:
+            session.execute(self._table.insert().prefix_with('OR REPLACE'), outputs)
+
+    def set_height(self, height):
+        with make_session_scope(self._db_session) as session:
+            self._set_height(session, height)
+
+        self._height = height
+
+    def undo(self, height):
+        """Remove the blocks from height up to the last added block
+        
+        Arguments:
+            height (int): height of the first block to remove, nothing 
+                is removed if it's above the last added block.
+        """
+        if height > self._height:
+            return
+
+        t = self._table
+        with make_session_scope(self._db_session) as session:
+            session.execute(t.delete().where(t.c.height >= height))
+            session.execute(t.update().where(t.c.spent >= height).values(spent=None))
+            session.query(UtxoBlock).filter(UtxoBlock.height >= height).delete()
+            self._set_height(session, height-1)
+
+        self._height = height-1
+
+    def prune(self, height):
+        """Permanently remove the outputs spent by blocks up to height"""
+        t = self._table
+        with make_session_scope(self._db_session) as session:
+            session.execute(t.delete().where(t.c.spent <= height))
+            session.query(UtxoBlock).filter(UtxoBlock.height <= height).delete()
@@ -0,0 +1,77 @@
+from unittest import TestCase
+
+import bitcoin
+from bitcoin.core import x
+from bitcoin.core.script import CScript, OP_CHECKSIG
+
+from bitbalance.address import (script_to_key, key_to_address, address_to_key,
+        KEY_P2PKH, KEY_P2SH, KEY_P2WPKH, KEY_P2WSH)
+from bitbalance.settings import Settings
+
+
+class TestAddressKey(TestCase):
+
+    def setUp(self):
+        bitcoin.SelectParams('mainnet')
+        key_to_address.cache_clear()
+
+    def tearDown(self):
+        bitcoin.SelectParams(Settings['BITCOIN_CHAIN'])
+        key_to_address.cache_clear()
+
+    def check_script(self, script, key_type, address):
+        key = script_to_key(script)
+        self.assertEqual(key[0], key_type)
+        self.assertEqual(key_to_address(key), address)
+        self.assertEqual(address_to_key(address), key)
+
+    def test_p2pkh(self):
+        script = x('76a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac')
+        self.check_script(script, KEY_P2PKH, '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')
+        self.check_script(CScript(script), KEY_P2PKH, '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')
+
+    def test_p2sh(self):
+        script = x('a914e9c3dd0c07aac76179ebc76a6c78d4d67c6c160a87')
+        self.check_script(script, KEY_P2SH, '3P14159f73E4gFr7JterCCQh9QjiTjiZrG')
+
+    def test_segwit(self):
+        script = x('0014751e76e8199196d454941c45d1b3a323f1433bd6')
+        self.check_script(script, KEY_P2WPKH, 'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4')
+        self.assertEqual(address_to_key('BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4'),
+                         script_to_key(script))
+
+        script = x('00201863143c14c5166804bd19203356da136c985678cd4d27a1b8c6329604903262')
+        self.check_script(script, KEY_P2WSH, 
+                'bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3')
+
+    def test_testnet(self):
+        bitcoin.SelectParams('testnet')
+        key_to_address.cache_clear()
+        script = x('0014751e76e8199196d454941c45d1b3a323f1433bd6')
+        self.check_script(script, KEY_P2WPKH, 'tb1qw508d6qejxtdg4y5r3zarvary0c5xw7kxpjzsx')
+
+        # Mainnet addresses aren't valid
+        self.assertIsNone(address_to_key('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'))
+        self.assertIsNone(address_to_key('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa'))
+
+    def test_p2pk(self):
+        """Test P2PK outputs are credited to the pubkey P2PKH address"""
+        pubkey = x('0496b538e853519c726a2c91e61ec11600ae1390813a627c66fb8be7947be63c52'
+                   'da7589379515d4e0a604f8141781e62294721166bf621e73a82cbf2342c858ee')
+        script = CScript([pubkey, OP_CHECKSIG])
+        self.check_script(script, KEY_P2PKH, '12c6DSiU4Rq3P4ZxziKxzrL5LmMBrzjrJX')
+
+    def test_fallback(self):
+        """Test non-standard scripts are handled by python-bitcoinlib"""
+        # P2PKH with a non canonical push
+        script = x('76a94c1462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac')
+        self.check_script(script, KEY_P2PKH, '1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa')
+
+        # Unknown scripts
+        self.assertIsNone(script_to_key(x('6a0401020304'))) # OP_RETURN
+        self.assertIsNone(script_to_key(b''))
+
+    def test_invalid_address(self):
+        self.assertIsNone(address_to_key('address'))
+        self.assertIsNone(address_to_key('1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNb'))
+        self.assertIsNone(address_to_key('bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t5'))
@@ -0,0 +1,84 @@
+import os
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from bitbalance.addressid import MemoryAddressDictionary, SQLAddressDictionary
+from .database import create_memory_db
+
+
+class TestMemoryAddressDictionary(TestCase):
+
+    def test_add(self):
+        ids = MemoryAddressDictionary()
+        self.assertEqual(len(ids), 0)
+        self.assertEqual(ids.get(b'addr1'), None)
+
+        self.assertEqual(ids.add([b'addr1', b'addr2']), {b'addr1': 0, b'addr2': 1})
+        self.assertEqual(ids.add([b'addr3', b'addr1']), {b'addr3': 2, b'addr1': 0})
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids.get(b'addr2'), 1)
+        self.assertEqual(ids.get_bulk([b'addr3', b'addr4']), {b'addr3': 2})
+        self.assertEqual(ids.address(2), b'addr3')
+
+
+class TestSQLAddressDictionary(TestCase):
+
+    def setUp(self):
+        self.db_engine, self.db_session = create_memory_db()
+
+    def tearDown(self):
+        self.db_session.close()
+        self.db_engine.dispose()
+
+    def test_add(self):
+        ids = SQLAddressDictionary(self.db_session)
+        self.assertEqual(ids.add([b'addr1']), {b'addr1': 0})
+        self.assertEqual(ids.add([b'addr1', b'addr2', b'addr2']), {b'addr1': 0, b'addr2': 1})
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(ids.get(b'addr2'), 1)
+        self.assertEqual(ids.get(b'addr3'), None)
+        self.assertEqual(ids.address(1), b'addr2')
+        with self.assertRaises(KeyError):
+            ids.address(5)
+
+        # Ids are persistent
+        ids = SQLAddressDictionary(self.db_session, cache_size=1)
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(ids.get_bulk([b'addr1', b'addr2', b'addr3']), 
+                         {b'addr1': 0, b'addr2': 1})
+        self.assertEqual(ids.add([b'addr3', b'addr1']), {b'addr3': 2, b'addr1': 0})
+
+    def test_cached_only(self):
+        ids = SQLAddressDictionary(self.db_session)
+        ids.add([b'addr1', b'addr2'])
+
+        ids = SQLAddressDictionary(self.db_session)
+        ids._query = MagicMock(wraps=ids._query)
+
+        # Addresses never seen don't read the database
+        self.assertEqual(ids.get_bulk([b'unknown'], cached_only=True), {})
+        self.assertEqual(ids.get(b'unknown'), None)
+        ids._query.assert_not_called()
+
+        self.assertEqual(ids.get_bulk([b'addr1'], cached_only=True), None)
+        self.assertEqual(ids.get_bulk([b'addr1']), {b'addr1': 0})
+        self.assertEqual(ids.get_bulk([b'addr1'], cached_only=True), {b'addr1': 0})
+
+    def test_filter_file(self):
+        with tempfile.TemporaryDirectory() as path:
+            filter_path = os.path.join(path, 'filter')
+            ids = SQLAddressDictionary(self.db_session, filter_path=filter_path)
+            ids.add([b'addr1'])
+            ids.save()
+
+            # Filter loaded from file
+            ids = SQLAddressDictionary(self.db_session, filter_path=filter_path)
+            self.assertIn(b'addr1', ids._filter)
+            ids.add([b'addr2'])
+
+            # Rebuilt when outdated
+            ids = SQLAddressDictionary(self.db_session, filter_path=filter_path)
+            self.assertIn(b'addr2', ids._filter)
+            self.assertEqual(ids.get(b'addr2'), 1)
@@ -1,12 +1,75 @@
 from unittest import TestCase
+from unittest.mock import MagicMock, patch
 
 from bitbalance.storage import MemoryBalanceStorage, BalanceProxyCache
 from bitbalance.primitives import TxOut, Block, COINBASE_TX
-from bitbalance.balance import BalanceProcessor
+from bitbalance.addressid import MemoryAddressDictionary
+from bitbalance.balance import BalanceProcessor, BlockDelta, BlockChange, PendingBalance
 
 from bitbalance.exceptions import BitcoinError, BacktrackError, ChainError
 
 
+class TestBlockDelta(TestCase):
+
+    def test_delta(self):
+        vout = [TxOut(tx="tx", nout=n, addr="busy", value=10) for n in range(500)]
+        vout.append(TxOut(tx="tx", nout=500, addr="other", value=5))
+        vin = [TxOut(tx="prev", nout=n, addr="busy", value=3) for n in range(500)]
+        vin.append(TxOut(tx="prev", nout=500, addr="zero", value=7))
+        vin.append(TxOut(tx=COINBASE_TX, nout=0, addr="coinbase", value=1))
+        block = Block(block_hash="hash", height=7, vin=vin, 
+                      vout=vout+[TxOut(tx="tx", nout=501, addr="zero", value=7)])
+
+        delta = BlockDelta(block)
+        self.assertEqual(delta.height, 7)
+        self.assertEqual(delta.block_hash, "hash")
+        self.assertEqual(delta.balance, {"busy": 3500, "other": 5})
+
+
+class TestPendingBalance(TestCase):
+
+    def delta(self, height, balance):
+        block = Block(block_hash="hash{}".format(height), height=height)
+        delta = BlockDelta(block)
+        delta.balance = balance
+        return delta
+
+    def test_add_remove(self):
+        pending = PendingBalance()
+        journal1 = pending.add(self.delta(1, {"a": 5, "b": 3}))
+        journal2 = pending.add(self.delta(2, {"a": -5, "c": 1}))
+
+        self.assertEqual(len(pending), 3)
+        self.assertEqual(pending.get("a"), 0)
+        self.assertEqual(pending.get("b"), 3)
+        self.assertEqual(pending.get("d"), 0)
+        self.assertEqual(dict(pending.items()), {"b": 3, "c": 1})
+
+        # Journal only keeps ids and changes
+        self.assertEqual(len(journal2), 2)
+        self.assertEqual(list(journal2.ids), sorted(journal2.ids))
+        self.assertEqual(journal2.get(pending.address_id("a")), -5)
+        self.assertEqual(journal2.get(pending.address_id("b")), None)
+        self.assertEqual(sorted(zip(pending.addresses(journal2.ids), journal2.deltas)),
+                         [("a", -5), ("c", 1)])
+
+        # Ids are released when no block references them
+        pending.remove(journal1)
+        self.assertEqual(pending.get("a"), -5)
+        self.assertNotIn("b", pending)
+        self.assertEqual(len(pending), 2)
+
+        # and reused
+        journal3 = pending.add(self.delta(3, {"d": 8}))
+        self.assertEqual(pending.get("d"), 8)
+        self.assertEqual(len(pending._addresses), 3)
+
+        pending.remove(journal3)
+        pending.remove(journal2)
+        self.assertEqual(len(pending), 0)
+        self.assertEqual(list(pending.items()), [])
+
+
 class TestBalanceProcessor(TestCase):
 
     def setUp(self):
@@ -121,6 +184,171 @@ class TestBalanceProcessor(TestCase):
         with self.assertRaises(BacktrackError):
             balance_processor.backtrack()
 
+    def test_get_balances(self):
+        """Test bulk balance query with pending and stored balances"""
+        balance_processor = BalanceProcessor(backtrack_limit=2, 
+                                             storage=self.balance_storage)
+        for height in range(5):
+            txout = TxOut(tx="tx{}".format(height), nout=0, 
+                          addr="addr{}".format(height % 2), value=10)
+            balance_processor.add_block(Block(block_hash="hash{}".format(height),
+                                              height=height, vout=[txout]))
+
+        self.assertEqual(balance_processor.get_balances(["addr0", "addr1", "addr2"]),
+                         {"addr0": 30, "addr1": 20, "addr2": 0})
+
+    def test_fast_sync(self):
+        """Test blocks far from the tip aren't tracked for backtracking"""
+        balance_processor = BalanceProcessor(backtrack_limit=5,
+                                             storage=self.balance_storage,
+                                             fast_sync_distance=10)
+        def block(height):
+            txout = TxOut(tx="tx{}".format(height), nout=0, 
+                          addr="addr{}".format(height % 2), value=10)
+            vin = [TxOut(tx="tx{}".format(height-2), nout=0,
+                         addr="addr{}".format(height % 2), value=10)] if height >= 2 else []
+            return Block(block_hash="hash{}".format(height), height=height, 
+                         vin=vin, vout=[txout])
+
+        for height in range(20):
+            balance_processor.add_block(block(height), tip=50)
+        
+        # Balance includes the blocks not yet commited
+        self.assertEqual(balance_processor.height, 19)
+        self.assertEqual(balance_processor.get_balances(["addr0", "addr1"]),
+                         {"addr0": 10, "addr1": 10})
+        self.assertEqual(balance_processor.get_cached_balance("addr0"), 10)
+        self.assertEqual(self.balance_storage.height, -1)
+        self.assertEqual(len(balance_processor), 0)
+        with self.assertRaises(BacktrackError):
+            balance_processor.backtrack()
+
+        # Close to the tip fast sync balance is commited and blocks tracked
+        for height in range(20, 45):
+            balance_processor.add_block(block(height), tip=50)
+        self.assertEqual(self.balance_storage.height, 39)
+        self.assertEqual(balance_processor.height, 44)
+        self.assertEqual(len(balance_processor), 5)
+        self.assertEqual(balance_processor.get_balance("addr0"), 10)
+        self.assertEqual(balance_processor.get_balance("addr1"), 10)
+        
+        # Block 44 output replaced the one from block 42
+        balance_processor.backtrack()
+        self.assertEqual(balance_processor.get_balance("addr0"), 10)
+        self.assertEqual(balance_processor.get_block_changes("addr0"), [])
+        self.assertEqual(balance_processor.height, 43)
+
+        # The tip moved far away, tracked blocks are flushed
+        for height in range(44, 50):
+            balance_processor.add_block(block(height), tip=100)
+        self.assertEqual(balance_processor.height, 49)
+        balance_processor.commit()
+        self.assertEqual(self.balance_storage.height, 49)
+        self.assertEqual(self.balance_storage.get("addr0"), 10)
+        self.assertEqual(self.balance_storage.get("addr1"), 10)
+
+    @patch('bitbalance.balance.UPDATE_SLICE_SIZE', 2)
+    def test_fast_sync_slices(self):
+        """Test fast sync balance changes are moved into storage in slices"""
+        balance_processor = BalanceProcessor(backtrack_limit=5,
+                                             storage=self.balance_storage,
+                                             fast_sync_distance=10)
+        self.balance_storage.update_bulk = MagicMock(wraps=self.balance_storage.update_bulk)
+
+        txouts = [TxOut(tx="tx", nout=n, addr="addr{}".format(n), value=n+1) 
+                  for n in range(5)]
+        balance_processor.add_block(Block(block_hash="hash0", height=0, vout=txouts), 
+                                    tip=50)
+        balance_processor.commit()
+
+        self.assertEqual(self.balance_storage.update_bulk.call_count, 3)
+        for args, _ in self.balance_storage.update_bulk.call_args_list:
+            self.assertLessEqual(len(args[0]), 2)
+
+        self.balance_storage.wait()
+        for n in range(5):
+            self.assertEqual(balance_processor.get_balance("addr{}".format(n)), n+1)
+            self.assertEqual(self.balance_storage.get("addr{}".format(n)), n+1)
+
+    @patch('bitbalance.balance.UPDATE_SLICE_SIZE', 2)
+    def test_flush_blocks_slices(self):
+        """Test tracked blocks are moved into storage in slices when fast
+        sync starts"""
+        balance_processor = BalanceProcessor(backtrack_limit=5,
+                                             storage=self.balance_storage,
+                                             fast_sync_distance=10)
+
+        txouts = [TxOut(tx="tx", nout=n, addr="addr{}".format(n), value=n+1)
+                  for n in range(5)]
+        balance_processor.add_block(Block(block_hash="hash0", height=0, vout=txouts),
+                                    tip=5)
+        self.assertEqual(len(balance_processor), 1)
+
+        self.balance_storage.update_bulk = MagicMock(wraps=self.balance_storage.update_bulk)
+        balance_processor.add_block(Block(block_hash="hash1", height=1), tip=50)
+        self.assertEqual(len(balance_processor), 0)
+
+        self.assertEqual(self.balance_storage.update_bulk.call_count, 3)
+        for args, _ in self.balance_storage.update_bulk.call_args_list:
+            self.assertLessEqual(len(args[0]), 2)
+
+        for n in range(5):
+            self.assertEqual(balance_processor.get_balance("addr{}".format(n)), n+1)
+            self.assertEqual(balance_processor.get_block_changes("addr{}".format(n)), [])
+
+        balance_processor.commit()
+        self.balance_storage.wait()
+        for n in range(5):
+            self.assertEqual(self.balance_storage.get("addr{}".format(n)), n+1)
+
+    def test_busy_address(self):
+        """Test each block is stored with a single bulk update"""
+        self.balance_storage.update = MagicMock(wraps=self.balance_storage.update)
+        self.balance_storage.update_bulk = MagicMock(wraps=self.balance_storage.update_bulk)
+        balance_processor = BalanceProcessor(backtrack_limit=2, 
+                                             storage=self.balance_storage)
+        for height in range(5):
+            vout = [TxOut(tx="tx{}".format(height), nout=n, addr="busy", value=1)
+                    for n in range(500)]
+            balance_processor.add_block(Block(block_hash="hash{}".format(height),
+                                              height=height, vout=vout))
+
+        self.assertEqual(balance_processor.get_balance("busy"), 2500)
+        
+        # Reads don't take the write lock
+        seq = balance_processor._lock.sequence
+        self.assertEqual(balance_processor.get_block_changes("busy", 1),
+                         [BlockChange("hash4", 500, 4), BlockChange("hash3", 500, 3)])
+        self.assertEqual(balance_processor._lock.sequence, seq)
+        self.balance_storage.update.assert_not_called()
+        self.assertEqual(self.balance_storage.update_bulk.call_count, 3)
+        
+        balance_processor.backtrack()
+        self.assertEqual(balance_processor.get_balance("busy"), 2000)
+        self.assertEqual(balance_processor.get_block_changes("busy"), 
+                         [BlockChange("hash3", 500, 3)])
+        self.assertEqual(balance_processor.get_block_changes("other"), [])
+
+    def test_address_ids(self):
+        """Test balances are tracked by address id"""
+        address_ids = MemoryAddressDictionary()
+        balance_processor = BalanceProcessor(backtrack_limit=2, 
+                                             storage=self.balance_storage,
+                                             address_ids=address_ids)
+        for height in range(5):
+            txout = TxOut(tx="tx{}".format(height), nout=0, 
+                          addr="addr{}".format(height % 2), value=10)
+            balance_processor.add_block(Block(block_hash="hash{}".format(height),
+                                              height=height, vout=[txout]))
+        balance_processor.commit()
+
+        addr0 = address_ids.get("addr0")
+        addr1 = address_ids.get("addr1")
+        self.assertEqual(sorted([addr0, addr1]), [0, 1])
+        self.assertEqual(balance_processor.get_balances([addr0, addr1]), {addr0: 30, addr1: 20})
+        self.assertEqual(self.balance_storage.get(addr0), 20)
+        self.assertEqual(self.balance_storage.get("addr0"), 0)
+
     def test_balance_tracking(self):
         """Test balance with more complex blocks"""
         # TODO
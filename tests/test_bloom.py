@@ -0,0 +1,61 @@
+import os
+import tempfile
+
+from unittest import TestCase
+
+from bitbalance.bloom import BloomFilter
+
+
+class TestBloomFilter(TestCase):
+
+    def test_contains(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        for n in range(1000):
+            bloom.add('addr{}'.format(n))
+        bloom.add(b'bytes')
+
+        for n in range(1000):
+            self.assertIn('addr{}'.format(n), bloom)
+        self.assertIn(b'bytes', bloom)
+        self.assertIn('bytes', bloom)
+        
+        false_positives = sum('other{}'.format(n) in bloom for n in range(10000))
+        self.assertLess(false_positives, 200)
+
+    def test_growth(self):
+        """Adding more keys than the capacity keeps the error rate"""
+        bloom = BloomFilter(capacity=100, error_rate=0.01)
+        bloom.update('addr{}'.format(n) for n in range(5000))
+        # False positives aren't added
+        added = len(bloom)
+        self.assertGreater(added, 4900)
+        self.assertGreater(len(bloom._filters), 1)
+
+        for n in range(5000):
+            self.assertIn('addr{}'.format(n), bloom)
+        false_positives = sum('other{}'.format(n) in bloom for n in range(10000))
+        self.assertLess(false_positives, 200)
+
+        # Duplicates aren't counted
+        bloom.add('addr1')
+        self.assertEqual(len(bloom), added)
+
+    def test_save_load(self):
+        bloom = BloomFilter(capacity=100)
+        bloom.update(str(n) for n in range(300))
+
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'filter')
+            bloom.save(filename, 33)
+            loaded, height = BloomFilter.load(filename)
+            self.assertEqual(height, 33)
+            self.assertEqual(len(loaded), len(bloom))
+            for n in range(300):
+                self.assertIn(str(n), loaded)
+            self.assertNotIn('abc', loaded)
+
+            # Truncated file
+            with open(filename, 'r+b') as f:
+                f.truncate(100)
+            with self.assertRaises(ValueError):
+                BloomFilter.load(filename)
@@ -0,0 +1,209 @@
+from unittest import TestCase
+import timeit
+
+from bitbalance.cache import ShardedClockCache, FrequencySketch, \
+    SKETCH_MAX_COUNT, SKETCH_SAMPLE
+
+
+class TestShardedClockCache(TestCase):
+
+    def test_get_set(self):
+        cache = ShardedClockCache(shards=4)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 0), 0)
+
+        cache.set('a', 1)
+        cache.set('b', -2)
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), -2)
+
+        cache.add('a', 10)
+        cache.set('b', 5)
+        self.assertEqual(cache.get('a'), 11)
+        self.assertEqual(cache.get('b'), 5)
+
+        self.assertEqual(cache.peek('a'), 11)
+        self.assertEqual(cache.peek('c', 0), 0)
+
+        with self.assertRaises(KeyError):
+            cache.add('c', 1)
+
+        # Reads don't take the shard lock
+        with cache._shard('a').lock:
+            self.assertEqual(cache.get('a'), 11)
+            self.assertEqual(cache.peek('a'), 11)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertNotIn('a', cache)
+
+    def test_set_missing(self):
+        cache = ShardedClockCache(shards=1)
+        self.assertTrue(cache.set_missing('a', 1))
+        self.assertFalse(cache.set_missing('a', 2))
+        self.assertEqual(cache.get('a'), 1)
+
+        # Invalid values aren't added
+        self.assertFalse(cache.set_missing('b', 2, valid=lambda: False))
+        self.assertNotIn('b', cache)
+        self.assertTrue(cache.set_missing('b', 2, valid=lambda: True))
+
+        # Max size evicts other entries
+        for n in range(100):
+            cache.set_missing(n, n, max_size=10)
+        self.assertEqual(len(cache), 10)
+        for n in range(90, 100):
+            self.assertEqual(cache.get(n), n)
+
+    def test_second_chance(self):
+        """Referenced entries are evicted after unreferenced ones"""
+        cache = ShardedClockCache(shards=1)
+        for n in range(10):
+            cache.set(n, n)
+
+        for n in range(0, 10, 2):
+            cache.get(n)
+
+        cache.trim(5)
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(sorted(k for k in range(10) if k in cache), [0, 2, 4, 6, 8])
+
+    def test_pinned(self):
+        cache = ShardedClockCache(shards=2)
+        for n in range(100):
+            cache.set(n, n)
+
+        cache.pinned = set(range(50, 100))
+        cache.trim(0)
+        self.assertEqual(len(cache), 50)
+        for n in range(50, 100):
+            self.assertEqual(cache.get(n), n)
+
+        cache.pinned = ()
+        cache.trim(0)
+        self.assertEqual(len(cache), 0)
+
+    def test_trim(self):
+        cache = ShardedClockCache(shards=16)
+        for n in range(10000):
+            cache.set(str(n), n)
+
+        cache.trim(20000)
+        self.assertEqual(len(cache), 10000)
+
+        cache.trim(999)
+        self.assertEqual(len(cache), 999)
+        
+        for n in range(10000, 20000):
+            cache.set_missing(str(n), n, max_size=999)
+        self.assertEqual(len(cache), 999)
+        self.assertEqual(cache.get('19999'), 19999)
+
+    def test_staged(self):
+        cache = ShardedClockCache(shards=1)
+        cache.set('a', 1)
+        self.assertFalse(cache.stage('a', 2))
+        self.assertTrue(cache.stage('b', 2))
+        self.assertFalse(cache.set_missing('b', 3))
+
+        # Staged entries are readable but not cached
+        self.assertEqual(cache.get('b'), 2)
+        self.assertNotIn('b', cache)
+        self.assertEqual(len(cache), 1)
+        cache.add('b', 5)
+        self.assertEqual(cache.peek('b'), 7)
+
+        cache.discard_staged()
+        self.assertEqual(cache.get('b'), None)
+
+        # Without sketch all are admitted, replacing other entries when full
+        cache.stage('b', 2)
+        cache.stage('c', 3)
+        cache.admit_staged(2)
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_admission(self):
+        """Staged entries only replace less frequently accessed ones"""
+        cache = ShardedClockCache(shards=1, sketch=FrequencySketch(100))
+        for n in range(100):
+            cache.set(n, n)
+        for _ in range(3):
+            for n in range(100):
+                cache.get(n)
+
+        # One-off entries are not admitted
+        for n in range(100, 1000):
+            cache.stage(n, n)
+        cache.admit_staged(100)
+        self.assertEqual(sorted(k for k in range(1000) if k in cache), list(range(100)))
+        self.assertEqual(cache.get(500), None)
+
+        # Frequently accessed entries are
+        for _ in range(5):
+            cache.get('hot')
+        cache.stage('hot', 1)
+        cache.admit_staged(100)
+        self.assertIn('hot', cache)
+        self.assertEqual(len(cache), 100)
+
+    def test_hit_latency(self):
+        """Benchmark cache hits recording the access in a sampled sketch 
+        against hits without sketch"""
+        keys = ['addr{:030d}'.format(n) for n in range(10000)]
+
+        def hit_time(sketch):
+            cache = ShardedClockCache(sketch=sketch)
+            for key in keys:
+                cache.set(key, 1)
+            get = cache.get
+            return min(timeit.repeat(lambda: [get(k) for k in keys], 
+                                     number=1, repeat=5))
+        
+        plain = hit_time(None)
+        sampled = hit_time(FrequencySketch(len(keys), SKETCH_SAMPLE))
+        self.assertLess(sampled, 5*plain)
+
+
+class TestFrequencySketch(TestCase):
+
+    def test_frequency(self):
+        sketch = FrequencySketch(1000)
+        self.assertEqual(sketch.frequency('a'), 0)
+        for n in range(5):
+            sketch.increment('a')
+        sketch.increment('b')
+        self.assertEqual(sketch.frequency('a'), 5)
+        self.assertEqual(sketch.frequency('b'), 1)
+
+        # Counters saturate
+        for n in range(100):
+            sketch.increment('c')
+        self.assertEqual(sketch.frequency('c'), SKETCH_MAX_COUNT)
+
+    def test_aging(self):
+        sketch = FrequencySketch(1000)
+        for n in range(8):
+            sketch.increment('a')
+
+        # Counters are halved after 10*size increments
+        for n in range(10000-8):
+            sketch.increment('b')
+        self.assertEqual(sketch.frequency('a'), 4)
+        self.assertEqual(sketch.frequency('b'), SKETCH_MAX_COUNT // 2)
+
+    def test_sampling(self):
+        sketch = FrequencySketch(1000, sample=4)
+        for n in range(400):
+            sketch.increment('a')
+        for n in range(12):
+            sketch.increment('b')
+
+        self.assertEqual(sketch.frequency('a'), SKETCH_MAX_COUNT)
+        self.assertLess(sketch.frequency('b'), SKETCH_MAX_COUNT)
+        self.assertEqual(sketch.frequency('c'), 0)
@@ -0,0 +1,370 @@
+import os
+import random
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+
+from bitcoin.core import CBlock
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from bitbalance.core import BlockPrefetchingCache, BitcoinBalanceFacade
+from bitbalance.database import Base
+from bitbalance.exceptions import StorageError
+from bitbalance.settings import Settings
+from bitbalance.storage import (SQLBalanceStorage, SQLiteBalanceStorage,
+        MemoryBalanceStorage, MmapBalanceStorage, ShardedBalanceStorage)
+from .database import create_memory_db
+
+
+class FakeBitcoindProxyPool(object):
+    """BitcoindProxyPool replacement returning the height as the block with 
+    random download delays, so blocks arrive out of order. Raw blocks are
+    empty blocks with the height as nonce."""
+
+    def __init__(self, bitcoind_url, size=1, blockcount=200):
+        self._bitcoind_url = bitcoind_url
+        self._blockcount = blockcount
+
+    @property
+    def url(self):
+        return self._bitcoind_url
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def get_blockcount(self):
+        return self._blockcount
+
+    def get_blocks(self, heights, raw=False):
+        time.sleep(random.random()*0.005)
+        if raw:
+            return [CBlock(nNonce=h).serialize() for h in heights]
+        return ["block_{}".format(h) for h in heights]
+
+    def stop(self):
+        pass
+
+
+@patch('bitbalance.core.BitcoindProxyPool', FakeBitcoindProxyPool)
+class TestBlockPrefetchingCache(TestCase):
+
+    def test_ordered_blocks(self):
+        """Test blocks downloaded by several workers are returned in order"""
+        cache = BlockPrefetchingCache(10, 'url', cache_size=20, workers=8,
+                                      batch_size=3)
+        try:
+            for height in range(10, 201):
+                self.assertEqual(cache.get_next_block(timeout=5), 
+                                 (height, "block_{}".format(height)))
+        finally:
+            cache.stop(block=True)
+
+    def test_set_height(self):
+        """Test purging cache with set_height"""
+        cache = BlockPrefetchingCache(0, 'url', cache_size=10, workers=4)
+        try:
+            for height in range(50):
+                self.assertEqual(cache.get_next_block(timeout=5)[0], height)
+
+            cache.set_height(20)
+            for height in range(20, 40):
+                self.assertEqual(cache.get_next_block(timeout=5)[0], height)
+            
+            cache.set_height(100)
+            self.assertEqual(cache.get_next_block(timeout=5)[0], 100)
+        finally:
+            cache.stop(block=True)
+
+    def test_decode_processes(self):
+        """Test raw blocks decoded by a process pool are returned in order"""
+        cache = BlockPrefetchingCache(0, 'url', cache_size=20, workers=4,
+                                      raw=True, decode_processes=2)
+        try:
+            for height in range(100):
+                next_height, block = cache.get_next_block(timeout=30)
+                self.assertEqual(next_height, height)
+                self.assertEqual(block.GetHash(), CBlock(nNonce=height).GetHash())
+        finally:
+            cache.stop(block=True)
+
+
+class FakeDecoderPool(object):
+    """ProcessPoolExecutor replacement decoding in the caller thread, 
+    blocks with a hash in fail_hashes always fail to decode, and after 
+    broken_after submits the pool is broken."""
+
+    fail_hashes = set()
+    broken_after = None
+
+    def __init__(self, processes, mp_context=None):
+        self._submits = 0
+
+    def submit(self, fn, rawblock):
+        self._submits += 1
+        if self.broken_after is not None and self._submits > self.broken_after:
+            raise BrokenProcessPool("broken")
+
+        future = Future()
+        block = fn(rawblock)
+        if block.GetHash() in self.fail_hashes:
+            future.set_exception(ValueError("decode error"))
+        else:
+            future.set_result(block)
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+@patch('bitbalance.core.BitcoindProxyPool', FakeBitcoindProxyPool)
+@patch('bitbalance.core.ProcessPoolExecutor', FakeDecoderPool)
+class TestBlockDecodeErrors(TestCase):
+
+    def tearDown(self):
+        FakeDecoderPool.fail_hashes = set()
+        FakeDecoderPool.broken_after = None
+
+    def test_decode_error(self):
+        """Test a block that always fails in the pool is decoded in the 
+        caller thread after the retries"""
+        FakeDecoderPool.fail_hashes = set([CBlock(nNonce=5).GetHash()])
+        cache = BlockPrefetchingCache(0, 'url', cache_size=10, workers=2,
+                                      raw=True, decode_processes=2)
+        try:
+            for height in range(20):
+                next_height, block = cache.get_next_block(timeout=5)
+                self.assertEqual(next_height, height)
+                self.assertEqual(block.GetHash(), CBlock(nNonce=height).GetHash())
+        finally:
+            cache.stop(block=True)
+
+    def test_broken_pool(self):
+        """Test blocks are decoded by the download threads once the pool
+        is broken"""
+        FakeDecoderPool.broken_after = 10
+        cache = BlockPrefetchingCache(0, 'url', cache_size=10, workers=2,
+                                      raw=True, decode_processes=2)
+        try:
+            for height in range(50):
+                next_height, block = cache.get_next_block(timeout=5)
+                self.assertEqual(next_height, height)
+                self.assertEqual(block.GetHash(), CBlock(nNonce=height).GetHash())
+        finally:
+            cache.stop(block=True)
+
+
+class FakeBlockCache(object):
+    """BlockPrefetchingCache replacement, the first block requested fails
+    to decode and the rest are returned in order"""
+
+    def __init__(self, height, proxy, **kwargs):
+        self.height = height
+        self.requested = []
+        self.tip = -1
+
+    def get_next_block(self, block=True, timeout=None):
+        self.requested.append(self.height)
+        self.height += 1
+        if len(self.requested) == 1:
+            raise ValueError("decode error")
+        return self.height-1, SimpleNamespace(hashPrevBlock=None)
+
+    def set_height(self, height):
+        self.height = height
+
+    def stop(self):
+        pass
+
+
+@patch('bitbalance.core.BlockPrefetchingCache', FakeBlockCache)
+class TestPollThread(TestCase):
+
+    def test_block_error(self):
+        """Test a block that can't be obtained is requested again instead
+        of stopping the poll thread"""
+        added = []
+        def add_block(block, tip=None):
+            added.append(block)
+            facade._stop_flag.set()
+
+        facade = SimpleNamespace(_blocks_dir=None, _stop_flag=threading.Event(),
+                                 height=9, _bitcoind_proxy=None, _block_hash=[],
+                                 _block_factory=MagicMock(), _add_block=add_block)
+        facade._block_factory.build_block.side_effect = lambda cblock, height: height
+        
+        with patch.dict(Settings, {'BITCOIND_POLL_PERIOD': 0}):
+            BitcoinBalanceFacade._poll_thread_func(facade)
+
+        self.assertEqual(facade._block_cache.requested, [10, 10])
+        self.assertEqual(added, [10])
+
+    def test_add_block_error(self):
+        """Test the synchronization is stopped when a block can't be added"""
+        facade = SimpleNamespace(_blocks_dir=None, _stop_flag=threading.Event(),
+                                 height=9, _bitcoind_proxy=None, _block_hash=[],
+                                 _block_factory=MagicMock(), 
+                                 _add_block=MagicMock(side_effect=IOError))
+        
+        with patch.dict(Settings, {'BITCOIND_POLL_PERIOD': 0}):
+            BitcoinBalanceFacade._poll_thread_func(facade)
+
+        facade._add_block.assert_called_once()
+        self.assertTrue(facade._stop_flag.is_set())
+
+
+class TestSnapshotHeight(TestCase):
+    
+    def test_invalid_height(self):
+        """Test the snapshot height is checked before starting"""
+        for height in (None, -1, '100'):
+            settings = {'UTXO_SNAPSHOT': 'utxo.dat', 'UTXO_SNAPSHOT_HEIGHT': height}
+            with patch.dict(Settings, settings):
+                with self.assertRaises(ValueError):
+                    BitcoinBalanceFacade()
+
+
+class TestAddressIdsStorage(TestCase):
+    """Test ADDRESS_IDS is refused with storages that can't use them"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'balance.ht')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_storage_without_ids(self):
+        storage = MmapBalanceStorage(self.path)
+        with patch.dict(Settings, {'ADDRESS_IDS': True}):
+            with self.assertRaises(ValueError):
+                BitcoinBalanceFacade(storage=storage)
+        storage.close()
+
+        shards = [SQLiteBalanceStorage() for _ in range(2)]
+        with patch.dict(Settings, {'ADDRESS_IDS': True}):
+            with self.assertRaises(ValueError):
+                BitcoinBalanceFacade(storage=ShardedBalanceStorage(shards))
+
+    def test_ids_not_persisted(self):
+        """Test ids from an in-memory dictionary aren't used with a 
+        persistent storage"""
+        storage = MmapBalanceStorage(self.path, address_ids=True)
+        with patch.dict(Settings, {'ADDRESS_IDS': True}):
+            with self.assertRaises(ValueError):
+                BitcoinBalanceFacade(storage=storage)
+        storage.close()
+
+        shards = [SQLiteBalanceStorage(address_ids=True) for _ in range(2)]
+        with patch.dict(Settings, {'ADDRESS_IDS': True}):
+            with self.assertRaises(ValueError):
+                BitcoinBalanceFacade(storage=ShardedBalanceStorage(shards))
+
+
+class TestStoredAddressIds(TestCase):
+    """Test ADDRESS_IDS is only used for new databases"""
+
+    def setUp(self):
+        self.db_engine, self.db_session = create_memory_db()
+        self.facade = SimpleNamespace(_db_session=self.db_session)
+        self.facade._default_storage = lambda address_ids: \
+            BitcoinBalanceFacade._default_storage(self.facade, address_ids)
+        
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'balance_storage.db')
+        self.settings = patch.dict(Settings, {'BALANCE_DATABASE_FILE': self.path})
+        self.settings.start()
+
+    def tearDown(self):
+        self.settings.stop()
+        self.tmpdir.cleanup()
+        self.db_session.close()
+        self.db_engine.dispose()
+
+    def stored_address_ids(self, address_ids):
+        return BitcoinBalanceFacade._stored_address_ids(self.facade, address_ids)
+
+    def test_new_database(self):
+        self.assertTrue(self.stored_address_ids(True))
+        self.assertFalse(self.stored_address_ids(False))
+
+    def test_existing_database(self):
+        SQLBalanceStorage(self.db_session).update(insert={b'key': 1}, height=10)
+        self.assertFalse(self.stored_address_ids(True))
+        self.assertFalse(self.stored_address_ids(False))
+
+        SQLBalanceStorage(self.db_session, address_ids=True).update(insert={1: 1}, height=10)
+        with self.assertRaises(StorageError):
+            self.stored_address_ids(True)
+
+    def test_existing_id_database(self):
+        SQLBalanceStorage(self.db_session, address_ids=True).update(insert={1: 1}, height=10)
+        self.assertTrue(self.stored_address_ids(True))
+        self.assertTrue(self.stored_address_ids(False))
+
+    def test_balance_database_file(self):
+        SQLiteBalanceStorage(self.path, address_ids=True).update(insert={1: 1}, height=10)
+        self.assertTrue(self.stored_address_ids(True))
+        self.assertTrue(self.stored_address_ids(False))
+
+        SQLBalanceStorage(self.db_session).update(insert={b'key': 1}, height=10)
+        with self.assertRaises(StorageError):
+            self.stored_address_ids(True)
+
+    def test_default_storage(self):
+        """Balances are stored in their own file, unless the sync database
+        already has them"""
+        storage = BitcoinBalanceFacade._default_storage(self.facade, True)
+        self.assertIsInstance(storage, SQLiteBalanceStorage)
+        self.assertEqual(storage.database, self.path)
+        self.assertTrue(storage.address_ids)
+
+        SQLBalanceStorage(self.db_session).update(insert={b'key': 1}, height=10)
+        storage = BitcoinBalanceFacade._default_storage(self.facade, False)
+        self.assertIsInstance(storage, SQLBalanceStorage)
+        self.assertEqual(storage.height, 10)
+
+        with patch.dict(Settings, {'BALANCE_DATABASE_FILE': None}):
+            storage = BitcoinBalanceFacade._default_storage(self.facade, True)
+            self.assertIsInstance(storage, SQLBalanceStorage)
+
+
+class TestSharesDatabase(TestCase):
+    """Test balance storages writing to the sync database are detected"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'balance.db')
+        self.db_engine = create_engine('sqlite:///' + self.path)
+        Base.metadata.create_all(self.db_engine)
+        self.db_session = scoped_session(sessionmaker(bind=self.db_engine))
+        self.facade = SimpleNamespace(_db_session=self.db_session)
+
+    def tearDown(self):
+        self.db_session.remove()
+        self.db_engine.dispose()
+        self.tmpdir.cleanup()
+
+    def shares_database(self, storage):
+        return BitcoinBalanceFacade._shares_database(self.facade, storage)
+
+    def test_shares_database(self):
+        self.assertTrue(self.shares_database(SQLBalanceStorage(self.db_session)))
+        self.assertTrue(self.shares_database(SQLiteBalanceStorage(self.path)))
+        
+        other = os.path.join(self.tmpdir.name, 'other.db')
+        self.assertFalse(self.shares_database(SQLiteBalanceStorage(other)))
+        self.assertFalse(self.shares_database(SQLiteBalanceStorage()))
+        self.assertFalse(self.shares_database(MemoryBalanceStorage()))
+
+        self.facade._db_session = None
+        self.assertFalse(self.shares_database(SQLiteBalanceStorage(self.path)))
@@ -0,0 +1,109 @@
+import os
+import tempfile
+
+from unittest import TestCase
+
+from bitbalance.hashtable import MmapHashTable, HEADER_SIZE
+
+
+class TestMmapHashTable(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'table')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_update(self):
+        table = MmapHashTable(self.path, key_size=8, capacity=16)
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.height, -1)
+
+        table.update(put=[(b'a', 1), (b'b', -2), (b'c'*8, 3)], height=5)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table.height, 5)
+        self.assertEqual(table.get(b'a'), 1)
+        self.assertEqual(table.get(b'b'), -2)
+        self.assertEqual(table.get(b'c'*8), 3)
+        self.assertEqual(table.get(b'd'), None)
+        self.assertEqual(table.get(b'd', 0), 0)
+
+        # Update, delete and insert in the same batch
+        table.update(put=[(b'a', 10), (b'd', 4)], delete=[b'b', b'x'], height=6)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(dict(table.items()), {b'a': 10, b'c'*8: 3, b'd': 4})
+        self.assertNotIn(b'b', table)
+
+        # Deleted and inserted again
+        table.update(delete=[b'a'])
+        table.update(put=[(b'a', 7)])
+        self.assertEqual(table.get(b'a'), 7)
+        self.assertEqual(len(table), 3)
+
+        with self.assertRaises(ValueError):
+            table.update(put=[(b'z'*9, 1)])
+        table.close()
+
+    def test_resize(self):
+        table = MmapHashTable(self.path, key_size=8, capacity=16)
+        for n in range(0, 1000, 100):
+            table.update(put=[(str(i).encode(), i) for i in range(n, n+100)])
+        self.assertGreater(table.capacity, 1000)
+        self.assertEqual(len(table), 1000)
+
+        # Many deletions, the table is rebuilt without growing
+        for n in range(20):
+            table.update(delete=[str(i).encode() for i in range(1000)])
+            table.update(put=[(str(i).encode(), i) for i in range(1000)])
+
+        self.assertLess(table.capacity, 10000)
+        for i in range(1000):
+            self.assertEqual(table.get(str(i).encode()), i)
+        table.close()
+
+    def test_persistence(self):
+        table = MmapHashTable(self.path, key_size=8)
+        table.update(put=[(b'a', 1), (b'b', 2)], height=3)
+        table.close()
+
+        table = MmapHashTable(self.path)
+        self.assertEqual(table.key_size, 8)
+        self.assertEqual(table.height, 3)
+        self.assertEqual(dict(table.items()), {b'a': 1, b'b': 2})
+        table.close()
+
+    def test_recovery(self):
+        """Test an interrupted commit is rolled back"""
+        table = MmapHashTable(self.path, key_size=8, capacity=16)
+        table.update(put=[(b'a', 1)], height=1)
+
+        # Journal written and the table partially modified
+        idx, _ = table._find(b'a')
+        table._write_journal({idx: table._pack_slot(b'a', 99)})
+        offset = HEADER_SIZE + idx*table._slot_size
+        table._mm[offset:offset+table._slot_size] = table._pack_slot(b'a', 99)
+        table._height = 2
+        table._write_header()
+        table.close()
+
+        table = MmapHashTable(self.path)
+        self.assertEqual(table.get(b'a'), 1)
+        self.assertEqual(table.height, 1)
+        self.assertFalse(os.path.exists(self.path + '-journal'))
+        table.close()
+
+    def test_incomplete_journal(self):
+        """A journal without checksum is discarded"""
+        table = MmapHashTable(self.path, key_size=8, capacity=16)
+        table.update(put=[(b'a', 1)], height=1)
+        table.close()
+
+        with open(self.path + '-journal', 'wb') as f:
+            f.write(b'\x00'*(HEADER_SIZE+10))
+
+        table = MmapHashTable(self.path)
+        self.assertEqual(table.get(b'a'), 1)
+        self.assertEqual(table.height, 1)
+        self.assertFalse(os.path.exists(self.path + '-journal'))
+        table.close()
@@ -0,0 +1,102 @@
+import os
+import struct
+import tempfile
+
+from unittest import TestCase
+
+import bitcoin
+from bitcoin.core import CBlock
+
+from bitbalance.importer import BlockFileReader, _xor
+
+
+def create_chain(length, prev_hash=b'\x00'*32, nonce=0):
+    """Chain of empty blocks"""
+    blocks = []
+    for n in range(length):
+        block = CBlock(hashPrevBlock=prev_hash, nNonce=nonce+n)
+        blocks.append(block)
+        prev_hash = block.GetHash()
+    return blocks
+
+
+def write_block_file(path, blocks, xor_key=b''):
+    data = b''
+    for block in blocks:
+        serialized = block.serialize()
+        data += bitcoin.params.MESSAGE_START + struct.pack('<I', len(serialized))
+        data += serialized
+
+    # Preallocated space
+    data += b'\x00'*100
+
+    with open(path, 'wb') as f:
+        f.write(_xor(data, xor_key, 0))
+
+
+class TestBlockFileReader(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = self._dir.name
+
+        # Best chain with a shorter fork at height 5
+        self.chain = create_chain(20)
+        self.fork = create_chain(3, self.chain[4].GetHash(), nonce=1000)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def write_files(self, xor_key=b''):
+        # Blocks out of order split in several files
+        blocks = self.chain[10:] + self.fork + self.chain[:10]
+        write_block_file(os.path.join(self.path, 'blk00000.dat'), blocks[:15], xor_key)
+        write_block_file(os.path.join(self.path, 'blk00001.dat'), blocks[15:], xor_key)
+
+    def check_chain(self, reader):
+        self.assertEqual(reader.scan(), 19)
+        self.assertEqual(len(reader), 20)
+
+        heights = []
+        for height, rawblock in reader.iter_blocks(3):
+            self.assertEqual(rawblock.GetHash(), self.chain[height].GetHash())
+            heights.append(height)
+        self.assertEqual(heights, list(range(3, 20)))
+        reader.close()
+
+    def test_read_blocks(self):
+        self.write_files()
+        self.check_chain(BlockFileReader(self.path))
+
+        # Data read must be the serialized block
+        reader = BlockFileReader(self.path)
+        reader.scan()
+        self.assertEqual(reader.read_block(7), self.chain[7].serialize())
+        reader.close()
+
+    def test_xor(self):
+        xor_key = bytes(range(1, 9))
+        with open(os.path.join(self.path, 'xor.dat'), 'wb') as f:
+            f.write(xor_key)
+        self.write_files(xor_key)
+        self.check_chain(BlockFileReader(self.path))
+
+    def test_decode_processes(self):
+        self.write_files()
+        reader = BlockFileReader(self.path)
+        reader.scan()
+        hashes = [b.GetHash() for _, b in reader.iter_blocks(decode_processes=2)]
+        self.assertEqual(hashes, [b.GetHash() for b in self.chain])
+        reader.close()
+
+    def test_truncated_file(self):
+        """Partially written blocks at the end of a file are ignored"""
+        blocks = self.chain[:5]
+        path = os.path.join(self.path, 'blk00000.dat')
+        write_block_file(path, blocks)
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path)-110)
+
+        reader = BlockFileReader(self.path)
+        self.assertEqual(reader.scan(), 3)
+        reader.close()
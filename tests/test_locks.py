@@ -0,0 +1,56 @@
+import threading
+import time
+
+from unittest import TestCase
+
+from bitbalance.locks import SeqLock
+
+
+class TestSeqLock(TestCase):
+
+    def test_read_retry(self):
+        lock = SeqLock()
+        seq = lock.read_begin()
+        self.assertFalse(lock.read_retry(seq))
+
+        with lock:
+            self.assertEqual(lock.sequence % 2, 1)
+        
+        self.assertTrue(lock.read_retry(seq))
+        self.assertFalse(lock.read_retry(lock.read_begin()))
+
+    def test_consistent_reads(self):
+        """Readers never see a partially written state"""
+        lock = SeqLock()
+        data = {'a': 0, 'b': 0}
+        stop = threading.Event()
+        errors = []
+
+        def writer():
+            while not stop.is_set():
+                with lock:
+                    data['a'] += 1
+                    time.sleep(0.0001)
+                    data['b'] += 1
+                time.sleep(0.0001)
+
+        def reader():
+            for _ in range(500):
+                while True:
+                    seq = lock.read_begin()
+                    a, b = data['a'], data['b']
+                    if not lock.read_retry(seq):
+                        break
+                if a != b:
+                    errors.append((a, b))
+
+        writer_thread = threading.Thread(target=writer)
+        writer_thread.start()
+        try:
+            reader()
+        finally:
+            stop.set()
+            writer_thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertGreater(data['a'], 0)
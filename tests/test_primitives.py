@@ -1,6 +1,15 @@
+import random
+from collections import OrderedDict
 from unittest import TestCase
+from unittest.mock import MagicMock
 
+from bitcoin.core import (CBlock, CTransaction, CTxIn, CTxOut, COutPoint, 
+        CScript, x)
 
+from bitbalance.address import script_to_key
+from bitbalance.primitives import TxOut, Block, TxOutCache, BlockFactory
+from bitbalance.utxo import MemoryUtxoIndex
+from bitbalance.exceptions import ChainError
 
 
 class TestTxOut(TestCase):
@@ -16,10 +25,169 @@ class TestBlock(TestCase):
 
 class TestTxOutCache(TestCase):
 
+    def setUp(self):
+        self.proxy = MagicMock()
+        self.proxy.__enter__.return_value = self.proxy
+
     def test_cache(self):
-        raise NotImplementedError
+        """Test outputs are stored and evicted in insertion order"""
+        cache = TxOutCache(self.proxy, size=100)
+
+        for n in range(100):
+            cache.add_txout(TxOut(b'1'*32, n, 'addr{}'.format(n%10), n*1000))
+
+        self.assertEqual(len(cache), 100)
+        for n in range(100):
+            txout = cache.get_txout(b'1'*32, n)
+            self.assertEqual(txout.tx, b'1'*32)
+            self.assertEqual(txout.nout, n)
+            self.assertEqual(txout.addr, 'addr{}'.format(n%10))
+            self.assertEqual(txout.value, n*1000)
+
+        # Outputs without address and max value
+        cache.add_txout(TxOut(b'2'*32, 0, None, 21000000*100000000))
+        txout = cache.get_txout(b'2'*32, 0)
+        self.assertEqual(txout.addr, None)
+        self.assertEqual(txout.value, 21000000*100000000)
+
+        # The oldest output was discarded
+        self.assertEqual(len(cache), 100)
+        self.assertFalse((b'1'*32, 0) in cache)
+        self.assertTrue((b'1'*32, 1) in cache)
+
+        cache.del_txout(TxOut(b'1'*32, 1))
+        self.assertFalse((b'1'*32, 1) in cache)
+        
+        self.proxy.get_transaction.assert_not_called()
+
+    def test_del_txout_eviction(self):
+        """Test deleted outputs don't cause live entries to be evicted early"""
+        cache = TxOutCache(self.proxy, size=10)
+
+        for n in range(10):
+            cache.add_txout(TxOut(b'1'*32, n, 'addr', n))
+
+        for _ in range(5):
+            for n in range(5):
+                cache.del_txout(TxOut(b'1'*32, n))
+            for n in range(5):
+                cache.add_txout(TxOut(b'1'*32, n, 'addr', n))
+
+        self.assertEqual(len(cache), 10)
+        for n in range(10):
+            self.assertTrue((b'1'*32, n) in cache)
+
+        # The oldest live entry is evicted first
+        cache.add_txout(TxOut(b'2'*32, 0, 'addr', 0))
+        self.assertFalse((b'1'*32, 5) in cache)
+        self.assertTrue((b'1'*32, 0) in cache)
+
+    def test_random_operations(self):
+        """Test the cache matches an OrderedDict under random adds and
+        deletes, so the hash index and order list stay consistent"""
+        rnd = random.Random(1)
+        cache = TxOutCache(self.proxy, size=50)
+        reference = OrderedDict()
+
+        for _ in range(20000):
+            outpoint = (bytes([rnd.randrange(4)])*32, rnd.randrange(40))
+            if rnd.random() < 0.6:
+                value = ('addr{}'.format(rnd.randrange(100)), rnd.randrange(10**15))
+                if outpoint not in reference:
+                    while len(reference) >= 50:
+                        reference.popitem(last=False)
+                reference[outpoint] = value
+                cache.add_txout(TxOut(*outpoint, *value))
+            else:
+                reference.pop(outpoint, None)
+                cache.del_txout(TxOut(*outpoint))
+
+            self.assertEqual(len(cache), len(reference))
+
+        for outpoint, (addr, value) in reference.items():
+            txout = cache.get_txout(*outpoint)
+            self.assertEqual((txout.addr, txout.value), (addr, value))
+
+        self.proxy.get_transaction.assert_not_called()
+
+    def test_address_compaction(self):
+        """Test unused addresses are discarded from the address table and 
+        their ids reused"""
+        cache = TxOutCache(self.proxy, size=10)
+
+        for n in range(1000):
+            cache.add_txout(TxOut(b'1'*32, n, 'addr{}'.format(n), n))
+
+        self.assertLessEqual(len(cache._addresses), 11)
+        self.assertEqual(len(cache._address_ids), 10)
+        for n in range(990, 1000):
+            self.assertEqual(cache.get_txout(b'1'*32, n).addr, 'addr{}'.format(n))
+    
+    def test_prefetch(self):
+        """Test outputs are loaded from utxo index first, and the remaining
+        requested to bitcoind"""
+        index = MemoryUtxoIndex()
+        index.add_block(Block('hash', 1, vout=[TxOut(b'1'*32, 0, 'addr1', 10)]))
+        
+        tx = CTransaction(vout=[CTxOut(5, CScript()), CTxOut(6, CScript())])
+        self.proxy.get_transactions.return_value = [tx]
+        
+        cache = TxOutCache(self.proxy, size=10, utxo_index=index)
+        cache.prefetch([(b'1'*32, 0), (b'2'*32, 1)])
+        
+        self.proxy.get_transactions.assert_called_once_with([b'2'*32])
+        self.assertEqual(cache.get_txout(b'1'*32, 0).addr, 'addr1')
+        self.assertEqual(cache.get_txout(b'2'*32, 0).value, 5)
+        self.assertEqual(cache.get_txout(b'2'*32, 1).value, 6)
+
+        # Unknown transaction
+        self.proxy.get_transaction.side_effect = IndexError
+        with self.assertRaises(ChainError):
+            cache.get_txout(b'3'*32, 0)
 
 
 class TestBlockFactory(TestCase):
     def test_contructor(self):
         raise NotImplementedError
+
+    def test_build_block(self):
+        """Test inputs are resolved from the same block and from previous
+        transactions"""
+        script1 = CScript(x('76a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac'))
+        script2 = CScript(x('a914e9c3dd0c07aac76179ebc76a6c78d4d67c6c160a87'))
+
+        prev_tx = CTransaction(vout=[CTxOut(1000, script2)])
+        proxy = MagicMock()
+        proxy.__enter__.return_value = proxy
+        proxy.get_transactions.return_value = [prev_tx]
+
+        coinbase = CTransaction(vin=[CTxIn(COutPoint())], 
+                                vout=[CTxOut(5000, script1), CTxOut(10, script1)])
+        tx1 = CTransaction(vin=[CTxIn(COutPoint(coinbase.GetTxid(), 0)),
+                                CTxIn(COutPoint(prev_tx.GetTxid(), 0))],
+                           vout=[CTxOut(6000, script2)])
+        cblock = CBlock(vtx=[coinbase, tx1])
+
+        factory = BlockFactory(proxy)
+        block = factory.build_block(cblock, 10)
+
+        self.assertEqual(block.height, 10)
+        self.assertEqual(block.block_hash, cblock.GetHash())
+        self.assertTrue(block.check_balance() is False) # Coinbase reward
+        
+        self.assertEqual([(o.tx, o.nout, o.addr, o.value) for o in block.vout], 
+                         [(coinbase.GetTxid(), 0, script_to_key(script1), 5000),
+                          (coinbase.GetTxid(), 1, script_to_key(script1), 10),
+                          (tx1.GetTxid(), 0, script_to_key(script2), 6000)])
+        
+        self.assertEqual([(i.tx, i.nout, i.addr, i.value) for i in block.vin],
+                         [(coinbase.GetTxid(), 0, script_to_key(script1), 5000),
+                          (prev_tx.GetTxid(), 0, script_to_key(script2), 1000)])
+
+        # Only the input from a previous block was requested
+        proxy.get_transactions.assert_called_once_with([prev_tx.GetTxid()])
+
+        # Outputs spent in the same block are not cached
+        self.assertFalse((coinbase.GetTxid(), 0) in factory._cache)
+        self.assertTrue((coinbase.GetTxid(), 1) in factory._cache)
+        self.assertTrue((tx1.GetTxid(), 0) in factory._cache)
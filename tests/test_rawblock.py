@@ -0,0 +1,95 @@
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+from unittest.mock import MagicMock
+
+from bitcoin.core import (CBlock, CTransaction, CTxIn, CTxOut, COutPoint, 
+        CTxWitness, CTxInWitness, CScript, CScriptWitness, x, lx)
+
+from bitbalance.address import script_to_key
+from bitbalance.primitives import BlockFactory
+from bitbalance.rawblock import deserialize_block, read_varint
+
+
+P2PKH_SCRIPT = CScript(x('76a91462e907b15cbf27d5425399ebf6f0fb50ebb88f1888ac'))
+P2WPKH_SCRIPT = CScript(x('0014751e76e8199196d454941c45d1b3a323f1433bd6'))
+
+
+def create_block():
+    """Block with a coinbase, a legacy and a segwit transaction"""
+    coinbase = CTransaction(vin=[CTxIn(COutPoint(), CScript(b'\x01'*300))], 
+                            vout=[CTxOut(5000, P2PKH_SCRIPT)])
+
+    legacy = CTransaction(vin=[CTxIn(COutPoint(coinbase.GetTxid(), 0), 
+                                     CScript(b'\x02'*70))],
+                          vout=[CTxOut(n, P2WPKH_SCRIPT) for n in range(300)])
+
+    witness = CTxWitness([CTxInWitness(CScriptWitness([b'\x03'*72, b'\x04'*33])),
+                          CTxInWitness(CScriptWitness([]))])
+    segwit = CTransaction(vin=[CTxIn(COutPoint(legacy.GetTxid(), 0)),
+                               CTxIn(COutPoint(lx('11'*32), 3))],
+                          vout=[CTxOut(77, P2PKH_SCRIPT), CTxOut(0, CScript(x('6a00')))],
+                          witness=witness)
+
+    return CBlock(hashPrevBlock=lx('22'*32), vtx=[coinbase, legacy, segwit])
+
+
+class TestRawBlock(TestCase):
+
+    def test_read_varint(self):
+        self.assertEqual(read_varint(b'\x05', 0), (5, 1))
+        self.assertEqual(read_varint(b'\x00\xfd\x01\x02', 1), (0x0201, 4))
+        self.assertEqual(read_varint(b'\xfe\x01\x02\x03\x04', 0), (0x04030201, 5))
+        self.assertEqual(read_varint(b'\xff'+b'\x01'*8, 0), (0x0101010101010101, 9))
+
+    def test_deserialize_block(self):
+        cblock = create_block()
+        block = deserialize_block(cblock.serialize())
+
+        self.assertEqual(block.GetHash(), cblock.GetHash())
+        self.assertEqual(block.hashPrevBlock, cblock.hashPrevBlock)
+        self.assertEqual(len(block.vtx), 3)
+        
+        for (txid, prevouts, outputs), tx in zip(block.vtx, cblock.vtx):
+            self.assertEqual(txid, tx.GetTxid())
+            self.assertEqual(prevouts, [(i.prevout.hash, i.prevout.n) for i in tx.vin])
+            self.assertEqual(outputs, [(script_to_key(o.scriptPubKey), o.nValue) 
+                                       for o in tx.vout])
+
+    def test_build_block(self):
+        """Test BlockFactory builds the same block from CBlock and RawBlock"""
+        proxy = MagicMock()
+        proxy.__enter__.return_value = proxy
+        proxy.get_transactions.return_value = [
+                CTransaction(vout=[CTxOut(n, P2PKH_SCRIPT) for n in range(4)])]
+        
+        cblock = create_block()
+        block1 = BlockFactory(proxy).build_block(cblock, 5)
+        block2 = BlockFactory(proxy).build_block(deserialize_block(cblock.serialize()), 5)
+
+        self.assertEqual(block1.block_hash, block2.block_hash)
+        for attr in ('vin', 'vout'):
+            self.assertEqual(
+                [(t.tx, t.nout, t.addr, t.value) for t in getattr(block1, attr)],
+                [(t.tx, t.nout, t.addr, t.value) for t in getattr(block2, attr)])
+
+    def test_import_side_effects(self):
+        """Test the decoding processes can import rawblock without importing
+        core and the database, which creates the database file"""
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        code = ("import sys\n"
+                "from bitbalance.rawblock import deserialize_block\n"
+                "print(' '.join(m for m in sys.modules if m.startswith('bitbalance')))")
+        
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = dict(os.environ, PYTHONPATH=root)
+            output = subprocess.check_output([sys.executable, '-c', code], 
+                                             cwd=tmpdir, env=env)
+            self.assertEqual(os.listdir(tmpdir), [])
+
+        modules = output.decode().split()
+        self.assertIn('bitbalance.rawblock', modules)
+        self.assertNotIn('bitbalance.core', modules)
+        self.assertNotIn('bitbalance.database', modules)
@@ -0,0 +1,249 @@
+import asyncio
+import json
+import threading
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from bitbalance.address import key_to_address, address_to_key
+from bitbalance.server import BalanceServer, HTTPError
+
+
+class FakeFacade(object):
+    """BitcoinBalanceFacade replacement, addresses starting with 'cached'
+    are answered without a storage read"""
+
+    height = 123
+
+    def __init__(self):
+        self.uncached_calls = []
+
+    def _balance(self, address):
+        return len(address)
+
+    def get_balance(self, address):
+        self.uncached_calls.append(threading.current_thread())
+        return self._balance(address)
+
+    def get_cached_balance(self, address):
+        if address.startswith('cached'):
+            return self._balance(address)
+        return None
+
+    def get_balances(self, addresses, cached_only=False):
+        if cached_only and not all(a.startswith('cached') for a in addresses):
+            return None
+        if not cached_only:
+            self.uncached_calls.append(threading.current_thread())
+        return {a: self._balance(a) for a in addresses}
+
+
+async def read_response(reader):
+    """Read HTTP response returning (status, headers, body)"""
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers['content-length']))
+    return status, headers, json.loads(body.decode('utf-8'))
+
+
+def get_request(path, close=False):
+    return ('GET {} HTTP/1.1\r\nHost: localhost\r\n{}\r\n'.format(
+        path, 'Connection: close\r\n' if close else '')).encode('latin-1')
+
+
+def post_request(path, body):
+    data = json.dumps(body).encode('utf-8')
+    return ('POST {} HTTP/1.1\r\nHost: localhost\r\n'
+            'Content-Length: {}\r\n\r\n'.format(path, len(data))).encode('latin-1') + data
+
+
+class TestBalanceServer(TestCase):
+
+    def setUp(self):
+        self.facade = FakeFacade()
+
+        # Addresses starting with 'invalid' aren't valid
+        self.address_to_key = patch('bitbalance.server.address_to_key',
+                lambda addr: None if addr.startswith('invalid') else addr.encode())
+        self.address_to_key.start()
+
+    def tearDown(self):
+        self.address_to_key.stop()
+
+    def run_client(self, client):
+        """Start server in a free port and run client coroutine"""
+        async def main():
+            server = BalanceServer(self.facade, '127.0.0.1', 0)
+            await server.start()
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+                try:
+                    return await client(reader, writer)
+                finally:
+                    writer.close()
+            finally:
+                server.close()
+                await server.wait_closed()
+
+        return asyncio.run(main())
+
+    def test_get_balance(self):
+        async def client(reader, writer):
+            writer.write(get_request('/balance/cached_addr'))
+            cached = await read_response(reader)
+            writer.write(get_request('/balance/other_addr'))
+            uncached = await read_response(reader)
+            writer.write(get_request('/height'))
+            height = await read_response(reader)
+            return cached, uncached, height
+
+        cached, uncached, height = self.run_client(client)
+        self.assertEqual(cached[0], 200)
+        self.assertEqual(cached[2], {'address': 'cached_addr', 'balance': 11})
+        self.assertEqual(uncached[2], {'address': 'other_addr', 'balance': 10})
+        self.assertEqual(height[2], {'height': 123})
+
+        # Only the uncached request was run in a worker thread
+        self.assertEqual(len(self.facade.uncached_calls), 1)
+        self.assertNotEqual(self.facade.uncached_calls[0], threading.main_thread())
+
+    def test_get_balances(self):
+        async def client(reader, writer):
+            writer.write(post_request('/balances', ['cached1', 'cached22']))
+            cached = await read_response(reader)
+            writer.write(post_request('/balances', ['cached1', 'addr']))
+            uncached = await read_response(reader)
+            return cached, uncached
+
+        cached, uncached = self.run_client(client)
+        self.assertEqual(cached[2], {'balances': {'cached1': 7, 'cached22': 8}})
+        self.assertEqual(uncached[2], {'balances': {'cached1': 7, 'addr': 4}})
+        self.assertEqual(len(self.facade.uncached_calls), 1)
+
+    def test_pipelining(self):
+        """Pipelined requests are answered in order"""
+        async def client(reader, writer):
+            addresses = ['cached{}'.format('x'*n) if n % 2 else 'a'*n
+                         for n in range(1, 200)]
+            writer.write(b''.join(get_request('/balance/'+a) for a in addresses))
+            responses = [await read_response(reader) for _ in addresses]
+            return addresses, responses
+
+        addresses, responses = self.run_client(client)
+        for address, (status, _, body) in zip(addresses, responses):
+            self.assertEqual(status, 200)
+            self.assertEqual(body, {'address': address, 'balance': len(address)})
+
+    def test_errors(self):
+        async def client(reader, writer):
+            writer.write(get_request('/unknown'))
+            not_found = await read_response(reader)
+            # Connection is closed after an error
+            eof = await reader.read()
+            return not_found, eof
+
+        (status, headers, body), eof = self.run_client(client)
+        self.assertEqual(status, 404)
+        self.assertEqual(headers['connection'], 'close')
+        self.assertEqual(eof, b'')
+
+        async def client(reader, writer):
+            writer.write(post_request('/balances', {'not': 'a list'}))
+            return await read_response(reader)
+        self.assertEqual(self.run_client(client)[0], 400)
+
+        async def client(reader, writer):
+            writer.write(get_request('/balances'))
+            return await read_response(reader)
+        self.assertEqual(self.run_client(client)[0], 405)
+
+    def test_invalid_address(self):
+        async def client(reader, writer):
+            writer.write(get_request('/balance/invalid_addr'))
+            return await read_response(reader)
+        status, _, body = self.run_client(client)
+        self.assertEqual(status, 400)
+        self.assertEqual(body, {'error': 'Invalid address: invalid_addr'})
+
+        async def client(reader, writer):
+            writer.write(post_request('/balances', ['cached1', 'invalid1', 'invalid2']))
+            return await read_response(reader)
+        status, _, body = self.run_client(client)
+        self.assertEqual(status, 400)
+        self.assertEqual(body, {'error': 'Invalid addresses: invalid1, invalid2'})
+        self.assertEqual(self.facade.uncached_calls, [])
+
+        # Addresses are decoded with the network address format
+        valid = key_to_address(b'\x00' + b'\x01'*20)
+        async def client(reader, writer):
+            writer.write(get_request('/balance/' + valid))
+            valid_response = await read_response(reader)
+            writer.write(get_request('/balance/' + valid[:-1] + 'x'))
+            return valid_response, await read_response(reader)
+        with patch('bitbalance.server.address_to_key', address_to_key):
+            valid_response, invalid_response = self.run_client(client)
+
+        self.assertEqual(valid_response[0], 200)
+        self.assertEqual(invalid_response[0], 400)
+
+    def test_chunked_body(self):
+        """Chunked bodies are rejected instead of being read as the next
+        request"""
+        async def client(reader, writer):
+            writer.write(b'POST /balances HTTP/1.1\r\nHost: localhost\r\n'
+                         b'Transfer-Encoding: chunked\r\n\r\n'
+                         b'0b\r\n["cached1"]\r\n0\r\n\r\n')
+            response = await read_response(reader)
+            return response, await reader.read()
+
+        (status, headers, body), eof = self.run_client(client)
+        self.assertEqual(status, 501)
+        self.assertEqual(headers['connection'], 'close')
+        self.assertEqual(eof, b'')
+
+    def test_http_error(self):
+        self.assertEqual(str(HTTPError(404, "Not found")), "Not found")
+
+    def test_connection_close(self):
+        async def client(reader, writer):
+            writer.write(get_request('/height', close=True))
+            response = await read_response(reader)
+            return response, await reader.read()
+
+        (status, _, _), eof = self.run_client(client)
+        self.assertEqual(status, 200)
+        self.assertEqual(eof, b'')
+
+    def test_cancel_connection(self):
+        """Test cancelling a connection handler propagates the cancellation
+        after closing the connection"""
+        class FakeWriter(object):
+            closed = False
+            wait_closed_called = False
+
+            def close(self):
+                self.closed = True
+
+            async def wait_closed(self):
+                self.wait_closed_called = True
+
+        async def main():
+            server = BalanceServer(self.facade, '127.0.0.1', 0)
+            writer = FakeWriter()
+            task = asyncio.ensure_future(
+                    server._handle_connection(asyncio.StreamReader(), writer))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return writer
+
+        writer = asyncio.run(main())
+        self.assertTrue(writer.closed)
+        self.assertTrue(writer.wait_closed_called)
@@ -0,0 +1,207 @@
+import os
+import struct
+import tempfile
+
+from unittest import TestCase
+from unittest.mock import patch
+
+import bitcoin
+from bitcoin.core import x
+
+from bitbalance.address import script_to_key
+from bitbalance.addressid import MemoryAddressDictionary
+from bitbalance.exceptions import StorageError
+from bitbalance.snapshot import (SNAPSHOT_MAGIC, SNAPSHOT_IMPORT_HEIGHT,
+        decompress_amount, decompress_pubkey, import_utxo_snapshot)
+from bitbalance.storage import MemoryBalanceStorage
+from bitbalance.utxo import MemoryUtxoIndex
+
+
+COIN = 100000000
+
+# secp256k1 generator point
+G_X = x('79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798')
+G_Y = x('483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8')
+
+
+def compress_amount(n):
+    """bitcoind CompressAmount"""
+    if n == 0:
+        return 0
+    e = 0
+    while n % 10 == 0 and e < 9:
+        n //= 10
+        e += 1
+    if e < 9:
+        d = n % 10
+        n //= 10
+        return 1 + (n*9 + d - 1)*10 + e
+    return 1 + (n-1)*10 + 9
+
+
+def write_varint(n):
+    """bitcoind VARINT"""
+    out = []
+    while True:
+        out.append((n & 0x7f) | (0x80 if out else 0))
+        if n <= 0x7f:
+            break
+        n = (n >> 7) - 1
+    return bytes(reversed(out))
+
+
+def serialize_coin(height, value, compressed_script):
+    return write_varint(height*2) + write_varint(compress_amount(value)) + compressed_script
+
+
+def create_coins():
+    """(txhash, nout, compressed script, full script, value, height)"""
+    pkh = b'\x11'*20
+    sh = b'\x22'*20
+    wpkh = bytes([0, 20]) + b'\x33'*20
+    return [
+        (b'\x01'*32, 0, b'\x00'+pkh, b'\x76\xa9\x14'+pkh+b'\x88\xac', 5*COIN, 10),
+        (b'\x01'*32, 3, b'\x01'+sh, b'\xa9\x14'+sh+b'\x87', 12345, 10),
+        (b'\x02'*32, 1, b'\x02'+G_X, b'\x21\x02'+G_X+b'\xac', 50*COIN, 1),
+        (b'\x03'*32, 0, b'\x04'+G_X, b'\x41\x04'+G_X+G_Y+b'\xac', 7, 2),
+        (b'\x04'*32, 2, write_varint(len(wpkh)+6)+wpkh, wpkh, 1000, 20),
+        (b'\x04'*32, 5, b'\x00'+pkh, b'\x76\xa9\x14'+pkh+b'\x88\xac', 10, 20),
+    ]
+
+
+def write_snapshot(path, coins, new_format=True):
+    with open(path, 'wb') as f:
+        if new_format:
+            f.write(SNAPSHOT_MAGIC + struct.pack('<H', 2) + bitcoin.params.MESSAGE_START)
+        f.write(b'\xaa'*32 + struct.pack('<Q', len(coins)))
+
+        if new_format:
+            groups = {}
+            for coin in coins:
+                groups.setdefault(coin[0], []).append(coin)
+            for txhash, group in groups.items():
+                f.write(txhash + bytes([len(group)]))
+                for _, nout, script, _, value, height in group:
+                    f.write(bytes([nout]) + serialize_coin(height, value, script))
+        else:
+            for txhash, nout, script, _, value, height in coins:
+                f.write(txhash + struct.pack('<I', nout))
+                f.write(serialize_coin(height, value, script))
+
+
+class TestSnapshot(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'utxo.dat')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_decompress_amount(self):
+        self.assertEqual(decompress_amount(0), 0)
+        self.assertEqual(decompress_amount(0x9), COIN)
+        self.assertEqual(decompress_amount(0x32), 50*COIN)
+        self.assertEqual(decompress_amount(0x1406f40), 21000000*COIN)
+        for value in (1, 7, 10, 12345, 1000000, 123456789, 10**15):
+            self.assertEqual(decompress_amount(compress_amount(value)), value)
+
+    def test_decompress_pubkey(self):
+        self.assertEqual(decompress_pubkey(2, G_X), b'\x04'+G_X+G_Y)
+        self.assertNotEqual(decompress_pubkey(3, G_X), b'\x04'+G_X+G_Y)
+
+    def check_import(self, new_format):
+        coins = create_coins()
+        write_snapshot(self.path, coins, new_format)
+
+        storage = MemoryBalanceStorage()
+        utxo_index = MemoryUtxoIndex()
+        count = import_utxo_snapshot(self.path, storage, 100, utxo_index,
+                                     flush_size=2)
+        self.assertEqual(count, len(coins))
+        self.assertEqual(storage.height, 100)
+        self.assertEqual(utxo_index.height, 100)
+
+        expected = {}
+        for txhash, nout, _, script, value, _ in coins:
+            key = script_to_key(script)
+            expected[key] = expected.get(key, 0) + value
+            self.assertEqual(utxo_index.get_bulk([(txhash, nout)]),
+                             {(txhash, nout): (key, value)})
+
+        self.assertEqual(dict(storage.get_bulk(expected)), expected)
+
+    def test_import(self):
+        self.check_import(new_format=True)
+
+    def test_import_old_format(self):
+        self.check_import(new_format=False)
+
+    def test_import_address_ids(self):
+        coins = create_coins()
+        write_snapshot(self.path, coins)
+
+        storage = MemoryBalanceStorage()
+        address_ids = MemoryAddressDictionary()
+        import_utxo_snapshot(self.path, storage, 100, flush_size=2, 
+                             address_ids=address_ids)
+
+        expected = {}
+        for _, _, _, script, value, _ in coins:
+            key = script_to_key(script)
+            if key is not None and value:
+                expected[key] = expected.get(key, 0) + value
+
+        ids = address_ids.get_bulk(expected)
+        self.assertEqual(len(ids), len(expected))
+        self.assertEqual(dict(storage.get_bulk(ids.values())),
+                         {ids[key]: value for key, value in expected.items()})
+
+    def test_non_empty_storage(self):
+        write_snapshot(self.path, create_coins())
+        with self.assertRaises(ValueError):
+            import_utxo_snapshot(self.path, MemoryBalanceStorage(10), 100)
+
+    def test_invalid_height(self):
+        write_snapshot(self.path, create_coins())
+        storage = MemoryBalanceStorage()
+        for height in (None, -1, 1.5):
+            with self.assertRaises(ValueError):
+                import_utxo_snapshot(self.path, storage, height)
+        self.assertEqual(storage.height, -1)
+
+    def test_interrupted_import(self):
+        """Test partial imports keep the import height and can't be resumed"""
+        write_snapshot(self.path, create_coins())
+        storage = MemoryBalanceStorage()
+
+        update = storage.update
+        def failing_update(**kwargs):
+            if kwargs['height'] != SNAPSHOT_IMPORT_HEIGHT:
+                raise IOError("Interrupted")
+            update(**kwargs)
+        storage.update = failing_update
+
+        with self.assertRaises(IOError):
+            import_utxo_snapshot(self.path, storage, 100, flush_size=2)
+        self.assertEqual(storage.height, SNAPSHOT_IMPORT_HEIGHT)
+
+        storage.update = update
+        with self.assertRaises(StorageError):
+            import_utxo_snapshot(self.path, storage, 100, flush_size=2)
+
+    @patch('bitbalance.snapshot.SNAPSHOT_READ_BATCH', 2)
+    def test_read_batches(self):
+        """Test stored balances are read in batches"""
+        coins = create_coins()
+        write_snapshot(self.path, coins)
+        storage = MemoryBalanceStorage()
+
+        get_bulk = storage.get_bulk
+        def checked_get_bulk(address):
+            self.assertLessEqual(len(address), 2)
+            return get_bulk(address)
+        storage.get_bulk = checked_get_bulk
+
+        import_utxo_snapshot(self.path, storage, 100, flush_size=4)
+        self.assertEqual(storage.height, 100)
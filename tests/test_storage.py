@@ -1,14 +1,20 @@
+import os
+import tempfile
 import threading
 import time
 
 from unittest import TestCase
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 import sqlalchemy
 
 from bitbalance.storage import (MemoryBalanceStorage, SQLBalanceStorage, 
-        BalanceProxyCache, make_session_scope)
+        SQLiteBalanceStorage, MmapBalanceStorage, ShardedBalanceStorage,
+        AddressFilterStorage, BalanceProxyCache, make_session_scope,
+        COMMIT_MAX_RETRIES)
+from bitbalance.exceptions import StorageError
 from bitbalance.storage import AddressBalance, BlockHeight
+from bitbalance.database import SCHEMA_VERSION, SchemaVersion, check_schema_version
 from .database import create_memory_db
 
 class TestSQLBalanceStorage(TestCase):
@@ -226,6 +232,71 @@ class TestSQLBalanceStorage(TestCase):
         self.assertEqual(block_count, 1)
 
 
+class TestSchemaVersion(TestCase):
+
+    def setUp(self):
+        self.db_engine, self.db_session = create_memory_db()
+
+    def tearDown(self):
+        self.db_session.close()
+        self.db_engine.dispose()
+
+    def test_new_database(self):
+        """Test a database without addresses is marked with the current
+        version"""
+        SQLBalanceStorage(self.db_session).update(insert={b'\x00key': 1}, height=1)
+        check_schema_version(self.db_session)
+        check_schema_version(self.db_session)
+
+        with make_session_scope(self.db_session) as session:
+            self.assertEqual(session.query(SchemaVersion.version).all(),
+                             [(SCHEMA_VERSION,)])
+
+    def test_base58_addresses(self):
+        """Test databases with base58 addresses are refused"""
+        SQLBalanceStorage(self.db_session).update(insert={'1BoatSLRHtKNngkdXEeobR76b53LETtpyT': 1},
+                                                  height=1)
+        with self.assertRaises(StorageError):
+            check_schema_version(self.db_session)
+
+    def test_version_mismatch(self):
+        with make_session_scope(self.db_session) as session:
+            session.add(SchemaVersion(version=SCHEMA_VERSION+1))
+
+        with self.assertRaises(StorageError):
+            check_schema_version(self.db_session)
+
+
+class TestStorageAddresses(TestCase):
+    """Test addresses() iterates all the stored addresses in every backend"""
+
+    def check_addresses(self, storage, key=str):
+        storage.update(insert={key(a): a+1 for a in range(100)}, height=1)
+        storage.update(delete=[key(a) for a in range(10)], height=2)
+        self.assertEqual(sorted(storage.addresses()), 
+                         sorted(key(a) for a in range(10, 100)))
+
+    def test_memory(self):
+        self.check_addresses(MemoryBalanceStorage())
+
+    def test_sql(self):
+        db_engine, db_session = create_memory_db()
+        self.check_addresses(SQLBalanceStorage(db_session))
+        db_session.close()
+        db_engine.dispose()
+
+    def test_sqlite(self):
+        storage = SQLiteBalanceStorage()
+        self.check_addresses(storage)
+        storage.close()
+
+    def test_mmap_sharded(self):
+        with tempfile.TemporaryDirectory() as path:
+            shards = [MmapBalanceStorage(os.path.join(path, str(n))) for n in range(2)]
+            self.check_addresses(ShardedBalanceStorage(shards), 
+                                 key=lambda a: str(a).encode())
+            for shard in shards:
+                shard.close()
 
 
 class TestMemoryBalanceStorage(TestCase):
@@ -355,6 +426,351 @@ class TestMemoryBalanceStorage(TestCase):
 
         
 
+class TestSQLIdBalanceStorage(TestCase):
+
+    def setUp(self):
+        self.db_engine, self.db_session = create_memory_db()
+
+    def tearDown(self):
+        self.db_session.close()
+        self.db_engine.dispose()
+
+    def test_address_ids(self):
+        """Test balances by address id are stored in their own tables"""
+        storage = SQLBalanceStorage(self.db_session, address_ids=True)
+        storage.update(insert={1: 10, 2: 20, 3: 30}, height=5)
+        storage.update(update={1: 11}, delete=[2], height=6)
+
+        self.assertEqual(storage.get(1), 11)
+        self.assertEqual(storage.get(2, 0), 0)
+        self.assertEqual(sorted(storage.get_bulk([1, 2, 3])), [(1, 11), (3, 30)])
+        self.assertEqual(sorted(storage.addresses()), [1, 3])
+
+        self.assertEqual(SQLBalanceStorage(self.db_session, address_ids=True).height, 6)
+        self.assertEqual(SQLBalanceStorage(self.db_session).height, -1)
+
+    def test_large_bulk(self):
+        """Test reads and deletes with more addresses than the max number
+        of SQL variables"""
+        storage = SQLBalanceStorage(self.db_session, address_ids=True)
+        storage.update(insert={a: a+1 for a in range(40000)}, height=1)
+
+        self.assertEqual(len(storage.get_bulk(range(50000))), 40000)
+        storage.update(delete=range(1, 40000), height=2)
+        self.assertEqual(storage.get_bulk(range(50000)), [(0, 1)])
+
+
+class TestSQLiteBalanceStorage(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'balance.db')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_init(self):
+        """Test height and balances are loaded from db"""
+        storage = SQLiteBalanceStorage(self.path)
+        self.assertEqual(storage.height, -1)
+        storage.update(insert={'addr1': 1, b'addr2': 2}, height=12)
+        storage.close()
+
+        storage = SQLiteBalanceStorage(self.path)
+        self.assertEqual(storage.height, 12)
+        self.assertEqual(storage.get('addr1'), 1)
+        self.assertEqual(storage.get(b'addr2'), 2)
+        storage.close()
+
+    def test_get_balance(self):
+        storage = SQLiteBalanceStorage()
+        storage.update(insert={"addr1": 1, "addr2": 2}, height=33)
+
+        self.assertEqual(storage.get("addr1"), 1)
+        self.assertEqual(storage.get("addr1", 77), 1)
+        
+        with self.assertRaises(KeyError):
+            storage.get("addr3")
+
+        self.assertEqual(storage.get("addr3", 77), 77)
+
+    def test_get_bulk_balance(self):
+        storage = SQLiteBalanceStorage()
+        storage.update(insert={str(a): a for a in range(2000)})
+
+        # Larger than a single query chunk
+        address = [str(a) for a in range(1000, 3000)]
+        result = dict(storage.get_bulk(address))
+        self.assertEqual(result, {str(a): a for a in range(1000, 2000)})
+
+        self.assertEqual(storage.get_bulk([]), [])
+
+    def test_mix_ops(self):
+        """Test mixin insert/update/delete operations"""
+        storage = SQLiteBalanceStorage()
+        storage.update(insert={str(a): a for a in range(5000)}, height=77)
+
+        insert = {str(a): a for a in range(10000, 15000)}
+        update = {str(a): 66 for a in range(1000)}
+        delete = [str(a) for a in range(1000, 3000)]
+        storage.update(insert=insert, update=update, delete=delete, height=99)
+
+        result = dict(storage.get_bulk(str(a) for a in range(20000)))
+        expected = {str(a): a for a in range(3000, 5000)}
+        expected.update(insert)
+        expected.update(update)
+        self.assertEqual(result, expected)
+        self.assertEqual(storage.height, 99)
+
+        # Deleting unknown address
+        storage.update(delete=['unknown'], height=100)
+        self.assertEqual(storage.height, 100)
+
+    def test_address_ids(self):
+        """Test integer address ids are stored in their own tables and 
+        read back as integers"""
+        storage = SQLiteBalanceStorage(self.path, address_ids=True)
+        storage.update(insert={1: 10, 2: 20, 3: 30}, height=5)
+        storage.update(update={1: 11}, delete=[2], height=6)
+
+        self.assertEqual(storage.get(1), 11)
+        self.assertEqual(storage.get(2, 0), 0)
+        self.assertEqual(sorted(storage.get_bulk([1, 2, 3])), [(1, 11), (3, 30)])
+        self.assertEqual(sorted(storage.addresses()), [1, 3])
+        storage.close()
+
+        self.assertEqual(SQLiteBalanceStorage(self.path, address_ids=True).height, 6)
+        self.assertEqual(SQLiteBalanceStorage(self.path).height, -1)
+
+        # Stored balances are found by the proxy cache
+        storage = SQLiteBalanceStorage(self.path, address_ids=True)
+        balance_proxy = BalanceProxyCache(storage, 1000)
+        balance_proxy.update(1, 5)
+        balance_proxy.commit(7)
+        self.assertEqual(storage.get(1), 16)
+        storage.close()
+
+    def test_update_height(self):
+        """Test the blocks table has a single row"""
+        storage = SQLiteBalanceStorage(self.path)
+        storage.update(insert={'addr3': 3}, height=11)
+        storage.update(insert={'addr4': 4}, height=12)
+        
+        count = storage._conn.execute('SELECT COUNT(*) FROM blocks').fetchone()[0]
+        self.assertEqual(count, 1)
+        storage.close()
+
+
+class TestMmapBalanceStorage(TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'balance.ht')
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_get_balance(self):
+        storage = MmapBalanceStorage(self.path)
+        self.assertEqual(storage.height, -1)
+        storage.update(insert={"addr1": 1, b"addr2": 2}, height=33)
+
+        self.assertEqual(storage.height, 33)
+        self.assertEqual(storage.get("addr1"), 1)
+        self.assertEqual(storage.get(b"addr2", 77), 2)
+        
+        with self.assertRaises(KeyError):
+            storage.get("addr3")
+
+        self.assertEqual(storage.get("addr3", 77), 77)
+        self.assertEqual(dict(storage.get_bulk(["addr1", b"addr2", "addr3"])),
+                         {"addr1": 1, b"addr2": 2})
+
+        # Reopen
+        storage.close()
+        storage = MmapBalanceStorage(self.path)
+        self.assertEqual(storage.height, 33)
+        self.assertEqual(storage.get("addr1"), 1)
+        storage.close()
+
+    def test_address_ids(self):
+        storage = MmapBalanceStorage(self.path, address_ids=True)
+        self.assertTrue(storage.address_ids)
+        storage.update(insert={1: 10, 2**40: 20}, height=1)
+        self.assertEqual(dict(storage.get_bulk([1, 2, 2**40])), {1: 10, 2**40: 20})
+        storage.close()
+        
+        storage = MmapBalanceStorage(self.path)
+        self.assertFalse(storage.address_ids)
+        storage.close()
+
+    def test_mix_ops(self):
+        storage = MmapBalanceStorage(self.path)
+        storage.update(insert={str(a): a for a in range(5000)}, height=77)
+
+        insert = {str(a): a for a in range(10000, 15000)}
+        update = {str(a): 66 for a in range(1000)}
+        delete = [str(a) for a in range(1000, 3000)]
+        storage.update(insert=insert, update=update, delete=delete, height=99)
+
+        result = dict(storage.get_bulk(str(a) for a in range(20000)))
+        expected = {str(a): a for a in range(3000, 5000)}
+        expected.update(insert)
+        expected.update(update)
+        self.assertEqual(result, expected)
+        self.assertEqual(storage.height, 99)
+        storage.close()
+
+
+class TestShardedBalanceStorage(TestCase):
+
+    def test_init(self):
+        shards = [MemoryBalanceStorage(5) for _ in range(3)]
+        self.assertEqual(ShardedBalanceStorage(shards).height, 5)
+
+        # Shards with different heights
+        shards[1].update(height=6)
+        with self.assertRaises(StorageError):
+            ShardedBalanceStorage(shards)
+
+    def test_mix_ops(self):
+        shards = [MemoryBalanceStorage() for _ in range(4)]
+        storage = ShardedBalanceStorage(shards)
+        storage.update(insert={str(a): a for a in range(5000)}, height=77)
+        
+        # Addresses are spread over all the shards
+        for shard in shards:
+            self.assertEqual(shard.height, 77)
+            self.assertGreater(len(shard.get_bulk(str(a) for a in range(5000))), 1000)
+
+        insert = {str(a): a for a in range(10000, 15000)}
+        update = {str(a): 66 for a in range(1000)}
+        delete = [str(a) for a in range(1000, 3000)]
+        storage.update(insert=insert, update=update, delete=delete, height=99)
+
+        result = dict(storage.get_bulk(str(a) for a in range(20000)))
+        expected = {str(a): a for a in range(3000, 5000)}
+        expected.update(insert)
+        expected.update(update)
+        self.assertEqual(result, expected)
+        self.assertEqual(storage.height, 99)
+
+        self.assertEqual(storage.get('10001'), 10001)
+        self.assertEqual(storage.get('1001', 3), 3)
+        with self.assertRaises(KeyError):
+            storage.get('1001')
+
+    def test_address_ids(self):
+        """Test address_ids is inherited from the shards"""
+        shards = [SQLiteBalanceStorage(address_ids=True) for _ in range(2)]
+        self.assertTrue(ShardedBalanceStorage(shards).address_ids)
+        self.assertFalse(ShardedBalanceStorage([MemoryBalanceStorage()]).address_ids)
+        
+        shards.append(SQLiteBalanceStorage())
+        with self.assertRaises(ValueError):
+            ShardedBalanceStorage(shards)
+
+    def test_sqlite_shards(self):
+        with tempfile.TemporaryDirectory() as path:
+            shards = [SQLiteBalanceStorage(os.path.join(path, str(n))) for n in range(3)]
+            storage = ShardedBalanceStorage(shards)
+            storage.update(insert={str(a).encode(): a for a in range(1000)}, height=1)
+            for shard in shards:
+                shard.close()
+
+            shards = [SQLiteBalanceStorage(os.path.join(path, str(n))) for n in range(3)]
+            storage = ShardedBalanceStorage(shards)
+            self.assertEqual(storage.height, 1)
+            self.assertEqual(len(storage.get_bulk(str(a).encode() for a in range(2000))), 1000)
+            for shard in shards:
+                shard.close()
+
+    def test_update_error(self):
+        shards = [MemoryBalanceStorage() for _ in range(2)]
+        shards[1].update = MagicMock(side_effect=IOError)
+        storage = ShardedBalanceStorage(shards)
+        
+        with self.assertRaises(IOError):
+            storage.update(insert={'addr1': 1}, height=1)
+        self.assertEqual(storage.height, -1)
+
+        # The shard that didn't fail already applied the update, so the
+        # storage can't be used again
+        self.assertEqual(shards[0].height, 1)
+        with self.assertRaises(StorageError):
+            storage.update(insert={'addr1': 1}, height=1)
+        with self.assertRaises(StorageError):
+            storage.get_bulk(['addr1'])
+        with self.assertRaises(StorageError):
+            storage.get('addr1')
+        with self.assertRaises(StorageError):
+            storage.addresses()
+
+
+class TestAddressFilterStorage(TestCase):
+
+    def test_filtered_reads(self):
+        storage = MemoryBalanceStorage()
+        storage.update(insert={'addr1': 1, 'addr2': 2}, height=1)
+        storage.get = MagicMock(wraps=storage.get)
+        storage.get_bulk = MagicMock(wraps=storage.get_bulk)
+
+        filtered = AddressFilterStorage(storage)
+        self.assertEqual(filtered.height, 1)
+        self.assertEqual(filtered.get('addr1'), 1)
+        self.assertEqual(filtered.get('addr2', 0), 2)
+        storage.get.reset_mock()
+
+        # Unknown addresses don't read storage
+        self.assertEqual(filtered.get('unknown', 0), 0)
+        with self.assertRaises(KeyError):
+            filtered.get('unknown')
+        storage.get.assert_not_called()
+
+        self.assertEqual(filtered.get_bulk(['unknown1', 'unknown2']), [])
+        storage.get_bulk.assert_not_called()
+        self.assertEqual(dict(filtered.get_bulk(['addr1', 'unknown'])), {'addr1': 1})
+        storage.get_bulk.assert_called_once_with(['addr1'])
+
+        # Inserted addresses are added to the filter
+        filtered.update(insert={'addr3': 3}, delete=['addr1'], height=2)
+        self.assertEqual(filtered.height, 2)
+        self.assertEqual(filtered.get('addr3'), 3)
+        self.assertEqual(filtered.get('addr1', 0), 0)
+        self.assertIn('addr3', filtered)
+        self.assertNotIn('addr4', filtered)
+
+    def test_persistence(self):
+        with tempfile.TemporaryDirectory() as path:
+            filter_path = os.path.join(path, 'filter')
+            storage = MemoryBalanceStorage()
+            storage.update(insert={'addr1': 1}, height=1)
+
+            filtered = AddressFilterStorage(storage, filter_path)
+            filtered.update(insert={'addr2': 2}, height=2)
+            filtered.save()
+
+            # Filter loaded from file, not rebuilt
+            storage.addresses = MagicMock(side_effect=AssertionError)
+            filtered = AddressFilterStorage(storage, filter_path)
+            self.assertIn('addr1', filtered)
+            self.assertIn('addr2', filtered)
+
+            # Rebuilt when the storage height doesn't match
+            storage.addresses = MagicMock(return_value=iter(['addr1', 'addr3']))
+            storage.update(height=3)
+            filtered = AddressFilterStorage(storage, filter_path)
+            storage.addresses.assert_called_once_with()
+            self.assertIn('addr3', filtered)
+            self.assertNotIn('addr2', filtered)
+
+            # Invalid file
+            with open(filter_path, 'wb') as f:
+                f.write(b'garbage')
+            filtered = AddressFilterStorage(storage, filter_path)
+            self.assertEqual(storage.addresses.call_count, 2)
+
+
 class TestBalanceProxyCache(TestCase):
 
 
@@ -394,6 +810,39 @@ class TestBalanceProxyCache(TestCase):
         for a in range(1000, 2000):
             self.assertEqual(balance_proxy.get(str(a)), 0)
 
+    def test_get_bulk(self):
+        """Test bulk get with cached, committing and uncached addresses"""
+        self.storage.update(insert={str(a): a for a in range(1, 100)})
+        balance_proxy = BalanceProxyCache(self.storage, 1000)
+        
+        for a in range(10):
+            balance_proxy.get(str(a))
+        for a in range(5, 15):
+            balance_proxy.update(str(a), 1000)
+        
+        # Uncached addresses are loaded with a single get_bulk call
+        get_bulk = self.storage.get_bulk
+        self.storage.get_bulk = MagicMock(side_effect=get_bulk)
+        result = balance_proxy.get_bulk(str(a) for a in range(200))
+        self.assertEqual(self.storage.get_bulk.call_count, 1)
+        self.assertEqual(len(self.storage.get_bulk.call_args[0][0]), 190)
+
+        expected = {str(a): a for a in range(200) if a < 100}
+        expected.update({str(a): 0 for a in range(100, 200)})
+        for a in range(5, 15):
+            expected[str(a)] += 1000
+        self.assertEqual(result, expected)
+        
+        # Now they are cached
+        self.storage.get_bulk.reset_mock()
+        self.assertEqual(balance_proxy.get_bulk(['150', '1']), {'150': 0, '1': 1})
+        self.storage.get_bulk.assert_not_called()
+
+        # Larger than the cache
+        balance_proxy = BalanceProxyCache(self.storage, 10)
+        result = balance_proxy.get_bulk(str(a) for a in range(100))
+        self.assertEqual(result, {str(a): a for a in range(100)})
+
     def test_storate_insert_update_delete(self):
         """Test how BalanceProxyCache translate updates into
         insert, update and delete operations"""
@@ -443,6 +892,31 @@ class TestBalanceProxyCache(TestCase):
         self.assertTrue('address_one' in args['delete'])
         self.assertEqual(args['height'], 55)
 
+    def test_update_bulk(self):
+        balance_proxy = BalanceProxyCache(self.storage, 1000)
+        balance_proxy.update('address_one', 5)
+        balance_proxy.update_bulk({'address_one': -5, 'address_two': 3, 'address_three': 0})
+        balance_proxy.update_bulk([('address_two', 1)])
+
+        self.assertEqual(len(balance_proxy), 1)
+        self.assertEqual(balance_proxy.get('address_two'), 4)
+        balance_proxy.commit(3)
+        self.assertEqual(balance_proxy.get('address_two'), 4)
+
+    @patch('bitbalance.storage.UPDATE_SLICE_SIZE', 3)
+    def test_commit_merge_slices(self):
+        """Test committed updates are merged into cache in slices"""
+        balance_proxy = BalanceProxyCache(self.storage, 1000)
+        balance_proxy.update_bulk({str(a): a+1 for a in range(10)})
+        balance_proxy.commit(1)
+        balance_proxy.update_bulk({str(a): 1 for a in range(10)})
+        balance_proxy.commit(2)
+
+        self.assertEqual(balance_proxy.get_bulk(str(a) for a in range(10)),
+                         {str(a): a+2 for a in range(10)})
+        self.assertEqual(dict(self.storage.get_bulk(str(a) for a in range(10))),
+                         {str(a): a+2 for a in range(10)})
+
     def test_cache_trim(self):
         """Test cache is trimed when it reaches max_size"""
         self.storage.get = MagicMock(return_value=0)
@@ -461,18 +935,45 @@ class TestBalanceProxyCache(TestCase):
         
         self.storage.get.assert_not_called()
 
-        # Adding another address will cause the proxy to discard the oldest one
+        # Addresses only updated by a commit don't replace the ones read
         self.assertEqual(len(balance_proxy._cache), 1000)
         balance_proxy.update('new_address', 44)
         balance_proxy.commit(444)
         
-        # This will call storage.get because atleast one addr isn't cached
         self.storage.get.reset_mock()
         for a in range(1000):
-            # WARNING: returned value is mangled because mock get allways 
-            # return 0
             balance_proxy.get(str(a))
-        self.assertGreater(self.storage.get.call_count, 0)
+        self.storage.get.assert_not_called()
+
+        # Reading an address not cached causes the proxy to discard another one
+        balance_proxy.get('new_address')
+        self.storage.get.assert_called_once_with('new_address', 0)
+        self.assertEqual(len(balance_proxy._cache), 1000)
+
+    def test_cache_admission(self):
+        """Test commits don't flush frequently read addresses from cache"""
+        # Record all the reads, with sampling an address read twice may 
+        # not be counted at all
+        with patch('bitbalance.storage.SKETCH_SAMPLE', 1):
+            balance_proxy = BalanceProxyCache(self.storage, 100)
+        for a in range(100):
+            balance_proxy.update('hot'+str(a), a+1)
+        balance_proxy.commit(1)
+        for _ in range(2):
+            for a in range(100):
+                balance_proxy.get('hot'+str(a))
+
+        # Many commits of addresses never read
+        for height in range(2, 12):
+            for a in range(1000):
+                balance_proxy.update('{}-{}'.format(height, a), 1)
+            balance_proxy.commit(height)
+
+        self.assertEqual(len(balance_proxy._cache), 100)
+        for a in range(100):
+            self.assertIn('hot'+str(a), balance_proxy._cache)
+            self.assertEqual(balance_proxy.get('hot'+str(a)), a+1)
+        self.assertEqual(balance_proxy.get('5-5'), 1)
 
     def test_commit(self):
         """Test data is stored correctly"""
@@ -572,3 +1073,112 @@ class TestBalanceProxyCache(TestCase):
 
 
 
+
+    def test_background_commit(self):
+        """Test updates and gets while a background commit is writing"""
+        balance_proxy = BalanceProxyCache(self.storage, 1000, background=True)
+        
+        storage_update = self.storage.update
+        started = threading.Event()
+        release = threading.Event()
+        def slow_update(*args, **kwargs):
+            started.set()
+            release.wait()
+            storage_update(*args, **kwargs)
+        self.storage.update = slow_update
+
+        # The committing balances are loaded by the committer thread
+        storage_get_bulk = self.storage.get_bulk
+        load_threads = []
+        def get_bulk(address):
+            load_threads.append(threading.current_thread())
+            return storage_get_bulk(address)
+        self.storage.get_bulk = get_bulk
+
+        for a in range(100):
+            balance_proxy.update(str(a), a+1)
+        balance_proxy.commit(10)
+        started.wait()
+        self.assertTrue(load_threads)
+        self.assertNotIn(threading.current_thread(), load_threads)
+        self.assertEqual(balance_proxy.height, 10)
+        self.assertEqual(balance_proxy.stored_height, -1)
+
+        # New updates accumulate in a fresh buffer during the commit
+        for a in range(50):
+            balance_proxy.update(str(a), 1)
+        self.assertEqual(len(balance_proxy), 50)
+        
+        for a in range(100):
+            expected = a+2 if a < 50 else a+1
+            self.assertEqual(balance_proxy.get(str(a)), expected)
+        self.assertEqual(self.storage.height, -1)
+
+        release.set()
+        balance_proxy.wait()
+        self.assertEqual(self.storage.height, 10)
+        self.assertEqual(balance_proxy.stored_height, 10)
+        self.assertEqual(self.storage.get('99'), 100)
+
+        for a in range(100):
+            expected = a+2 if a < 50 else a+1
+            self.assertEqual(balance_proxy.get(str(a)), expected)
+        
+        balance_proxy.commit(11)
+        balance_proxy.wait()
+        self.assertEqual(self.storage.get('0'), 2)
+
+    def test_background_commit_error(self):
+        """Test updates are kept when a background commit fails"""
+        balance_proxy = BalanceProxyCache(self.storage, 1000, background=True)
+        self.storage.update = MagicMock(side_effect=IOError)
+        
+        balance_proxy.update('addr1', 5)
+        balance_proxy.commit(10)
+        balance_proxy.update('addr1', 1)
+        
+        with self.assertRaises(IOError):
+            balance_proxy.wait()
+
+        self.assertEqual(balance_proxy.height, -1)
+        self.assertEqual(balance_proxy.get('addr1'), 6)
+        self.assertEqual(len(balance_proxy), 1)
+
+    def test_background_commit_retry(self):
+        """Test the updates of a failed background commit are committed 
+        again by the next commit instead of raising"""
+        balance_proxy = BalanceProxyCache(self.storage, 1000, background=True)
+        storage_update = self.storage.update
+        self.storage.update = MagicMock(side_effect=IOError)
+        
+        balance_proxy.update('addr1', 5)
+        balance_proxy.commit(10)
+        balance_proxy.update('addr1', 1)
+        balance_proxy._commit_thread.join()
+
+        self.storage.update = storage_update
+        balance_proxy.commit(11)
+        balance_proxy.wait()
+        self.assertEqual(self.storage.height, 11)
+        self.assertEqual(self.storage.get('addr1'), 6)
+        self.assertEqual(len(balance_proxy), 0)
+
+    def test_background_commit_max_retries(self):
+        """Test storage errors and repeated background commit failures are
+        raised by the next commit"""
+        balance_proxy = BalanceProxyCache(self.storage, 1000, background=True)
+        self.storage.update = MagicMock(side_effect=StorageError)
+        balance_proxy.update('addr1', 5)
+        balance_proxy.commit(10)
+        with self.assertRaises(StorageError):
+            balance_proxy.commit(11)
+
+        self.storage.update = MagicMock(side_effect=IOError)
+        for height in range(12, 13+COMMIT_MAX_RETRIES):
+            balance_proxy.commit(height)
+        with self.assertRaises(IOError):
+            balance_proxy.commit(13+COMMIT_MAX_RETRIES)
+
+        # Updates are kept
+        self.assertEqual(balance_proxy.get('addr1'), 5)
+        self.assertEqual(len(balance_proxy), 1)
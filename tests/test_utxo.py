@@ -0,0 +1,127 @@
+from unittest import TestCase
+
+from bitbalance.primitives import TxOut, Block
+from bitbalance.utxo import MemoryUtxoIndex, SQLUtxoIndex
+from .database import create_memory_db
+
+
+class UtxoIndexTests(object):
+    """Tests shared by all utxo index implementations"""
+
+    def create_index(self):
+        raise NotImplementedError
+
+    def test_add_block(self):
+        index = self.create_index()
+        self.assertEqual(index.height, -1)
+        
+        txout1 = TxOut(b'1'*32, 0, 'addr1', 100)
+        txout2 = TxOut(b'1'*32, 1, 'addr2', 200)
+        index.add_block(Block(b'hash1', 0, vout=[txout1, txout2]))
+        self.assertEqual(index.height, 0)
+        
+        result = index.get_bulk([(b'1'*32, 0), (b'1'*32, 1), (b'2'*32, 0)])
+        self.assertEqual(result, {(b'1'*32, 0): ('addr1', 100),
+                                  (b'1'*32, 1): ('addr2', 200)})
+        
+        # Spent outputs are available until pruned
+        txout3 = TxOut(b'3'*32, 0, 'addr3', 100)
+        index.add_block(Block(b'hash2', 1, vin=[txout1], vout=[txout3]))
+        self.assertEqual(len(index.get_bulk([(b'1'*32, 0), (b'3'*32, 0)])), 2)
+
+        # Adding an already indexed block is ignored
+        index.add_block(Block(b'hash2', 1, vin=[txout1], vout=[txout3]))
+        self.assertEqual(index.height, 1)
+
+        index.prune(1)
+        self.assertEqual(index.get_bulk([(b'1'*32, 0), (b'3'*32, 0)]),
+                         {(b'3'*32, 0): ('addr3', 100)})
+
+    def test_undo(self):
+        index = self.create_index()
+        
+        txout1 = TxOut(b'1'*32, 0, 'addr1', 100)
+        txout2 = TxOut(b'2'*32, 0, 'addr2', 100)
+        index.add_block(Block(b'hash1', 0, vout=[txout1]))
+        index.add_block(Block(b'hash2', 1, vin=[txout1], vout=[txout2]))
+
+        index.undo(1)
+        self.assertEqual(index.height, 0)
+        self.assertEqual(index.get_bulk([(b'1'*32, 0), (b'2'*32, 0)]),
+                         {(b'1'*32, 0): ('addr1', 100)})
+
+        # The output is no longer spent
+        index.prune(1)
+        self.assertEqual(len(index.get_bulk([(b'1'*32, 0)])), 1)
+
+    def test_reorg(self):
+        """Test a different block at an indexed height undoes the index
+        down to the fork point before it's added"""
+        index = self.create_index()
+
+        txout1 = TxOut(b'1'*32, 0, 'addr1', 100)
+        txout2 = TxOut(b'2'*32, 0, 'addr2', 100)
+        txout3 = TxOut(b'3'*32, 0, 'addr3', 100)
+        txout4 = TxOut(b'4'*32, 0, 'addr4', 100)
+        index.add_block(Block(b'hash1', 0, vout=[txout1]))
+        index.add_block(Block(b'hash2', 1, vin=[txout1], vout=[txout2]))
+        index.add_block(Block(b'hash3', 2, vout=[txout3]))
+
+        index.add_block(Block(b'other2', 1, vout=[txout4]))
+        self.assertEqual(index.height, 1)
+
+        index.prune(1)
+        self.assertEqual(index.get_bulk([(b'1'*32, 0), (b'2'*32, 0),
+                                         (b'3'*32, 0), (b'4'*32, 0)]),
+                         {(b'1'*32, 0): ('addr1', 100),
+                          (b'4'*32, 0): ('addr4', 100)})
+
+        # Undo several blocks at once
+        index.add_block(Block(b'other3', 2, vin=[txout4], vout=[txout3]))
+        index.add_block(Block(b'other4', 3, vout=[txout2]))
+        index.undo(2)
+        self.assertEqual(index.height, 1)
+        self.assertEqual(index.get_bulk([(b'2'*32, 0), (b'3'*32, 0), (b'4'*32, 0)]),
+                         {(b'4'*32, 0): ('addr4', 100)})
+
+    def test_add_outputs(self):
+        index = self.create_index()
+        index.add_outputs([(b'1'*32, 0, 'addr1', 100, 3), 
+                           (b'1'*32, 2, 'addr2', 50, 5)])
+        index.set_height(10)
+        self.assertEqual(index.height, 10)
+
+        # Blocks below the seeded height are ignored
+        txout1 = TxOut(b'1'*32, 0, 'addr1', 100)
+        index.add_block(Block(b'hash1', 10, vin=[txout1]))
+        self.assertEqual(index.height, 10)
+
+        index.add_block(Block(b'hash2', 11, vin=[txout1]))
+        index.prune(11)
+        self.assertEqual(index.get_bulk([(b'1'*32, 0), (b'1'*32, 2)]),
+                         {(b'1'*32, 2): ('addr2', 50)})
+
+
+class TestMemoryUtxoIndex(UtxoIndexTests, TestCase):
+
+    def create_index(self):
+        return MemoryUtxoIndex()
+
+
+class TestSQLUtxoIndex(UtxoIndexTests, TestCase):
+
+    def setUp(self):
+        self.db_engine, self.db_session = create_memory_db()
+
+    def tearDown(self):
+        self.db_session.close()
+        self.db_engine.dispose()
+
+    def create_index(self):
+        return SQLUtxoIndex(self.db_session)
+
+    def test_init(self):
+        """Test height is loaded from db"""
+        index = self.create_index()
+        index.add_block(Block(b'hash1', 7, vout=[TxOut(b'1'*32, 0, 'addr1', 1)]))
+        self.assertEqual(self.create_index().height, 7)